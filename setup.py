@@ -37,6 +37,10 @@ setup(
     entry_points={
         'console_scripts': [
             'wifi_configurator=wifi_configurator.cli:main',
+            'wifi_configurator_build_channel_table='
+            'wifi_configurator.cli:build_channel_table',
+            'wifi_configurator_compile_templates='
+            'wifi_configurator.cli:compile_templates',
         ],
     },
     install_requires=requirements,
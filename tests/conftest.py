@@ -25,6 +25,12 @@ def iw_dev_scan_3():
     p = pathlib.Path("tests/fixtures/iw_dev_scan_3.txt")
     return p.read_text()
 
+@pytest.fixture
+def iw_dev_scan_4():
+    # Newer iw, which also prints when each BSS was last seen since boot
+    p = pathlib.Path("tests/fixtures/iw_dev_scan_4.txt")
+    return p.read_text()
+
 @pytest.fixture
 def regdb_lines():
     p = pathlib.Path("tests/fixtures/reg-db.txt")
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import configobj
+import pytest
+
+from wifi_configurator import adapters
+
+
+@pytest.fixture
+def registry():
+    return adapters.AdapterRegistry.from_file()
+
+
+def registry_from_lines(lines):
+    return adapters.AdapterRegistry.from_config(configobj.ConfigObj(lines))
+
+
+def test_shipped_registry_lookups(registry):
+    def lookup(**uevent):
+        return registry.lookup(uevent).name
+    assert lookup(PRODUCT="bda/b812/0") == "RTL8812BU"
+    assert lookup(PRODUCT="bda/8812/0") == "RTL8812AU"
+    # Listed in upper case, but the kernel writes lower case
+    assert lookup(PRODUCT="b05/b822/0") == "RTL8812BU"
+    # Never matched when this was a list comparison
+    assert lookup(PRODUCT="148f/5372/101") == "Realtek5372"
+    assert lookup(SDIO_ID="02D0:A9A6") == "BCM4343x"
+    assert lookup(PRODUCT="bda/b812/200") == adapters.DEFAULT_PROFILE
+    assert lookup(PRODUCT="garbage") == adapters.DEFAULT_PROFILE
+    assert lookup(SDIO_ID="02D0:4345") == adapters.DEFAULT_PROFILE
+    assert lookup() == adapters.DEFAULT_PROFILE
+
+
+def test_profiles(registry):
+    assert str(registry.default) == "Default wifi adapter"
+    assert registry.default.ht_capab == "[HT20][SHORT-GI-20]"
+    assert registry.default.ac_active == 0
+    rtl8812bu = registry.profiles["RTL8812BU"]
+    assert rtl8812bu.ac_active == 1
+    assert "[RX-STBC1]" in rtl8812bu.ht_capab
+    assert "[RX-STBC1]" not in rtl8812bu.ht_capab_5ghz
+    realtek5372 = registry.profiles["Realtek5372"]
+    assert realtek5372.ht_capab_5ghz == realtek5372.ht_capab
+    assert realtek5372.vht_capab == ""
+
+
+def test_wildcard_versions():
+    registry = registry_from_lines([
+        "[default]",
+        "[any]",
+        "products = 0bda/B812/*",
+        "[exact]",
+        "products = bda/b812/0210",
+    ])
+    assert registry.lookup({"PRODUCT": "bda/b812/210"}).name == "exact"
+    assert registry.lookup({"PRODUCT": "bda/b812/0"}).name == "any"
+    assert registry.lookup({"PRODUCT": "bda/b813/0"}).name == "default"
+
+
+def test_invalid_registries():
+    with pytest.raises(ValueError, match="bda/b812/0 is in both"):
+        registry_from_lines([
+            "[default]",
+            "[RTL8812AU]",
+            "products = bda/8812/0, bda/b812/0",
+            "[RTL8812BU]",
+            "products = 0bda/b812/0",
+        ])
+    with pytest.raises(ValueError, match="Malformed"):
+        registry_from_lines(["[default]", "[x]", "products = bda/b812"])
+    with pytest.raises(ValueError, match="No default"):
+        registry_from_lines(["[x]", "products = bda/b812/0"])
+    with pytest.raises(ValueError):
+        adapters.AdapterRegistry.from_file("/nonexistent/adapters.ini")
+
+
+def test_read_uevent(tmp_path):
+    uevent_file = tmp_path / "uevent"
+    uevent_file.write_text("DEVTYPE=usb_interface\nDRIVER=rtl88x2bu\n"
+                           "PRODUCT=bda/b812/210\nINTERFACE=255/255/255\n")
+    uevent = adapters.read_uevent(str(uevent_file))
+    assert uevent["PRODUCT"] == "bda/b812/210"
+    assert uevent["INTERFACE"] == "255/255/255"
+
+
+def test_factory_without_uevent():
+    assert adapters.factory("no-such-interface").name == \
+        adapters.DEFAULT_PROFILE
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pathlib
+
+from wifi_configurator import bss
+
+
+def test_parse_records_0(iw_dev_scan_0):
+    records = bss.parse_bss_records(iw_dev_scan_0)
+    assert len(records) == 9
+    first = records[0]
+    assert first.bssid == "ea:d8:ab:0d:39:e8"
+    assert first.freq == 2412
+    assert first.signal == -48.0
+    assert first.ssid == "one"
+    assert first.country == ""
+    assert first.ht_primary_channel == 1
+    assert first.ht_secondary_offset == bss.SECONDARY_ABOVE
+    assert first.ht_sta_channel_width == 40
+    assert records[1].ht_secondary_offset == bss.SECONDARY_NONE
+    assert records[1].ht_sta_channel_width == 20
+    assert records[7].last_seen_ms == 4
+    assert [r.country for r in records if r.country] == \
+        ["TR", "TR", "TR", "AL"]
+
+
+def test_parse_records_tabs(iw_dev_scan_3):
+    records = bss.parse_bss_records(iw_dev_scan_3)
+    assert [(r.bssid, r.freq, r.country) for r in records] == [
+        ("6d:94:02:6b:9f:21", 2412, "AU"),
+        ("a4:a8:91:82:19:7e", 2442, ""),
+        ("84:ba:ef:aa:59:5f", 5180, "AU"),
+    ]
+
+
+def test_parse_records_bytes_matches_str(iw_dev_scan_0):
+    raw = pathlib.Path("tests/fixtures/iw_dev_scan_0.txt").read_bytes()
+    assert bss.parse_bss_records(raw) == bss.parse_bss_records(iw_dev_scan_0)
+
+
+def test_parse_records_empty(iw_dev_scan_2):
+    assert bss.parse_bss_records(iw_dev_scan_2) == []
+    assert bss.parse_bss_records(b"") == []
+
+
+def test_bss_load_is_not_a_new_block():
+    scan_output = b"BSS 00:11:22:33:44:55(on wlan0)\n" \
+                  b"\tfreq: 2437.0\n" \
+                  b"\tsignal: -60.00 dBm\n" \
+                  b"\tBSS Load:\n" \
+                  b"\t\t * station count: 3\n"
+    records = bss.parse_bss_records(scan_output)
+    assert len(records) == 1
+    assert records[0].freq == 2437
+    assert records[0].signal == -60.0
+
+
+def test_parse_vht_operation(iw_dev_scan_3):
+    records = bss.parse_bss_records(iw_dev_scan_3)
+    vht = records[2]
+    assert vht.freq == 5180
+    assert vht.vht_channel_width == bss.VHT_WIDTH_80
+    assert (vht.vht_center_seg1, vht.vht_center_seg2) == (42, 0)
+    assert bss.record_occupied_freqs(vht) == (5180, 5200, 5220, 5240)
+    assert records[0].vht_channel_width == bss.VHT_WIDTH_20_40
+
+
+def test_occupied_freqs_ht40(iw_dev_scan_1):
+    record = bss.parse_bss_records(iw_dev_scan_1)[0]
+    assert bss.record_occupied_freqs(record) == (2412, 2432)
+    assert bss.occupied_freqs(2462, bss.SECONDARY_BELOW, 40) == (2442, 2462)
+    # Only a secondary channel the BSS may actually use counts
+    assert bss.occupied_freqs(2462, bss.SECONDARY_BELOW, 20) == (2462,)
+    assert bss.occupied_freqs(0) == ()
+
+
+def test_occupied_freqs_160():
+    # 160MHz as two adjacent segments, and in the deprecated encoding
+    assert bss.occupied_freqs(5180, bss.SECONDARY_ABOVE, 40, bss.VHT_WIDTH_80,
+                              42, 50) == tuple(range(5180, 5340, 20))
+    assert bss.occupied_freqs(5180, bss.SECONDARY_ABOVE, 40,
+                              bss.VHT_WIDTH_160, 50) == \
+        tuple(range(5180, 5340, 20))
+    # 80+80
+    assert bss.occupied_freqs(5180, bss.SECONDARY_ABOVE, 40, bss.VHT_WIDTH_80,
+                              42, 106) == (5180, 5200, 5220, 5240,
+                                           5500, 5520, 5540, 5560)
+
+
+def test_parse_last_seen_boottime(iw_dev_scan_4):
+    records = bss.parse_bss_records(iw_dev_scan_4)
+    assert [(r.bssid, r.freq, r.country, r.last_seen_ms)
+            for r in records] == [
+        ("3c:84:6a:1e:52:c0", 2437, "NZ", 1520),
+        ("50:c7:bf:3d:08:12", 2462, "", 0),
+    ]
+
+
+def test_parse_last_seen_unknown_form():
+    scan_output = b"BSS 00:11:22:33:44:55(on wlan0)\n" \
+                  b"\tfreq: 2437.0\n" \
+                  b"\tlast seen: a while ago\n" \
+                  b"\tlast seen: \n"
+    records = bss.parse_bss_records(scan_output)
+    assert records[0].last_seen_ms == 0
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+
+import pyric.net.wireless.nl80211_h as nl80211h
+
+from wifi_configurator import adapters, capabilities, nl80211
+
+
+# As reported by an RTL8812BU: LDPC, 20/40, SM power save disabled, short
+#  GI 20 and 40, TX STBC and one RX STBC stream
+HT_CAPA_2GHZ = 0x01ef
+# In 5GHz, with static SM power save and no RX STBC
+HT_CAPA_5GHZ = 0x00e3
+VHT_CAPA = (capabilities.VHT_CAP_RXLDPC | capabilities.VHT_CAP_SGI_80 |
+            capabilities.VHT_CAP_SU_BEAMFORMEE |
+            (3 << capabilities.VHT_CAP_BEAMFORMEE_STS_SHIFT) |
+            (1 << capabilities.VHT_CAP_RXSTBC_SHIFT) |
+            (7 << capabilities.VHT_CAP_MAX_AMPDU_LEN_EXP_SHIFT))
+
+WIPHY = nl80211.Wiphy(0, "phy0", {
+    nl80211h.NL80211_BAND_2GHZ: nl80211.Band(HT_CAPA_2GHZ, None),
+    nl80211h.NL80211_BAND_5GHZ: nl80211.Band(HT_CAPA_5GHZ, VHT_CAPA),
+}, frozenset([nl80211h.NL80211_IFTYPE_STATION, nl80211h.NL80211_IFTYPE_AP]))
+
+
+def test_ht_capab():
+    assert capabilities.ht_capab(HT_CAPA_2GHZ) == \
+        "[LDPC][HT40-][HT40+][SHORT-GI-20][SHORT-GI-40][TX-STBC][RX-STBC1]"
+    assert capabilities.ht_capab(HT_CAPA_5GHZ) == \
+        "[LDPC][HT40-][HT40+][SHORT-GI-20][SHORT-GI-40][TX-STBC]" \
+        "[SMPS-STATIC]"
+    assert capabilities.ht_capab(0) == "[SMPS-STATIC]"
+    assert capabilities.ht_capab(None) == ""
+
+
+def test_vht_capab():
+    assert capabilities.vht_capab(VHT_CAPA) == \
+        "[RXLDPC][SHORT-GI-80][SU-BEAMFORMEE][RX-STBC-1][BF-ANTENNA-4]" \
+        "[MAX-A-MPDU-LEN-EXP7]"
+    assert capabilities.vht_capab(
+        2 | (1 << capabilities.VHT_CAP_SUPP_CHAN_WIDTH_SHIFT)) == \
+        "[MAX-MPDU-11454][VHT160][MAX-A-MPDU-LEN-EXP0]"
+    assert capabilities.vht_capab(None) == ""
+
+
+def test_wiphy_capabilities():
+    probed = capabilities.wiphy_capabilities(WIPHY)
+    assert probed["ht_capab"] == capabilities.ht_capab(HT_CAPA_2GHZ)
+    assert probed["ht_capab_5ghz"] == capabilities.ht_capab(HT_CAPA_5GHZ)
+    assert probed["vht_capab"] == capabilities.vht_capab(VHT_CAPA)
+    assert probed["ac_active"] == 1
+    assert probed["ap"]
+    # A 2.4GHz only 802.11n radio
+    probed = capabilities.wiphy_capabilities(WIPHY._replace(bands={
+        nl80211h.NL80211_BAND_2GHZ: nl80211.Band(0x0020, None)}))
+    assert probed["ht_capab_5ghz"] == probed["vht_capab"] == ""
+    assert probed["ac_active"] == 0
+
+
+def fake_phy(monkeypatch, tmp_path):
+    sysfs = tmp_path / "phy80211"
+    sysfs.mkdir()
+    (sysfs / "macaddress").write_text("00:C0:CA:98:7B:1E\n")
+    (sysfs / "index").write_text("0\n")
+    monkeypatch.setattr(capabilities, "phy_sysfs", lambda _: sysfs)
+    probes = []
+
+    def get_wiphy(phy_index):
+        probes.append(phy_index)
+        return WIPHY
+    monkeypatch.setattr(nl80211, "get_wiphy", get_wiphy)
+    return probes
+
+
+def test_probe_is_cached_per_phy(monkeypatch, tmp_path):
+    probes = fake_phy(monkeypatch, tmp_path)
+    cache_dir = str(tmp_path / "cache")
+    probed = capabilities.probe("wlan1", cache_dir)
+    assert probed == capabilities.wiphy_capabilities(WIPHY)
+    assert capabilities.probe("wlan1", cache_dir) == probed
+    assert probes == [0]
+    cache = json.loads(capabilities.cache_path(cache_dir).read_text())
+    assert list(cache["phys"]) == ["00:c0:ca:98:7b:1e"]
+
+    # Another kernel may have another driver
+    cache["kernel"] = "0.0.1"
+    capabilities.cache_path(cache_dir).write_text(json.dumps(cache))
+    capabilities.probe("wlan1", cache_dir)
+    assert probes == [0, 0]
+
+
+def test_unknown_adapters_are_probed(monkeypatch, tmp_path):
+    fake_phy(monkeypatch, tmp_path)
+    adapter = adapters.probed_adapter("wlan1", ("[SMPS-STATIC]",),
+                                      str(tmp_path / "cache"))
+    assert adapter.name == adapters.PROBED_PROFILE
+    assert adapter.ac_active == 1
+    assert "[SMPS-STATIC]" not in adapter.ht_capab_5ghz
+    assert "[HT40+]" in adapter.ht_capab
+    assert adapter.vht_capab == capabilities.vht_capab(VHT_CAPA)
+    assert adapters.get_registry().default.quirks == ("[SMPS-STATIC]",)
+
+
+def test_unprobeable_adapters_get_the_default_profile(tmp_path):
+    assert adapters.probed_adapter("no-such-interface",
+                                   cache_dir=str(tmp_path)) is None
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from wifi_configurator import bss, channel_stats
+from wifi_configurator.scan_result import ScanResult
+
+MAC = "02:00:00:aa:bb:cc"
+
+
+def scan_of(freq_signals):
+    return ScanResult.from_bss_records(
+        bss.BSS("00:00:00:00:00:%02x" % (i,), freq, signal, "", "", 0, 0,
+                bss.SECONDARY_NONE, 20)
+        for i, (freq, signal) in enumerate(freq_signals)
+    )
+
+
+def test_first_scan_seeds_averages():
+    stats = channel_stats.ChannelStats()
+    stats.update(scan_of([(2412, -40), (2412, -60), (2437, -70)]))
+    assert stats.samples == 1
+    assert stats.presence == {2412: 1.0, 2437: 1.0}
+    assert stats.ap_count == {2412: 2, 2437: 1}
+    assert stats.max_signal == {2412: -40, 2437: -70}
+    assert stats.power_mw[2412] == pytest.approx(1e-4 + 1e-6)
+
+
+def test_ewma_smooths_a_missed_ap():
+    stats = channel_stats.ChannelStats(alpha=0.5)
+    stats.update(scan_of([(2412, -40), (2437, -70)]))
+    # The AP on 1 is missed in one scan
+    stats.update(scan_of([(2437, -70)]))
+    assert stats.presence[2412] == 0.5
+    assert stats.ap_count[2412] == 0.5
+    # max_signal is only averaged over scans where the AP was heard
+    assert stats.max_signal[2412] == -40
+    stats.update(scan_of([(2412, -50), (2437, -70)]))
+    assert stats.presence[2412] == 0.75
+    assert stats.max_signal[2412] == -45
+
+
+def test_new_and_departed_aps():
+    stats = channel_stats.ChannelStats(alpha=0.5)
+    stats.update(scan_of([(2412, -40)]))
+    stats.update(scan_of([(2462, -40)]))
+    # Heard once in two scans
+    assert stats.presence[2462] == 0.5
+    for _ in range(4):
+        stats.update(scan_of([(2462, -40)]))
+    # 0.5 ** 5 is below PRESENCE_MIN, so the AP on 1 is forgotten
+    assert 2412 not in stats.presence
+    assert list(stats.power_mw_per_occupied_freq()) == [2462]
+
+
+def test_empty_scan_is_ignored():
+    stats = channel_stats.ChannelStats()
+    stats.update(scan_of([(2412, -40)]))
+    stats.update(ScanResult())
+    assert stats.samples == 1
+    assert stats.presence == {2412: 1.0}
+
+
+def test_40mhz_bss_counts_on_secondary():
+    stats = channel_stats.ChannelStats()
+    stats.update(ScanResult.from_bss_records([
+        bss.BSS("00:00:00:00:00:01", 2412, -40.0, "", "", 0, 1,
+                bss.SECONDARY_ABOVE, 40)
+    ]))
+    assert sorted(stats.presence) == [2412, 2432]
+
+
+def test_save_and_load(tmp_path):
+    stats = channel_stats.ChannelStats()
+    stats.update(scan_of([(2412, -40), (2437, -70)]), now=1000)
+    assert channel_stats.save("wlan0", MAC, stats, str(tmp_path))
+    loaded = channel_stats.load("wlan0", MAC, 60, str(tmp_path), now=1030)
+    assert loaded.to_dict() == stats.to_dict()
+    assert channel_stats.load("wlan0", MAC, 60, str(tmp_path),
+                              now=1061) is None
+    channel_stats.stats_path("wlan0", MAC, str(tmp_path)).write_text("[]")
+    assert channel_stats.load("wlan0", MAC, 60, str(tmp_path),
+                              now=1030) is None
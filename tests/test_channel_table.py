@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from wifi_configurator import channel_table, regdb, scan, spectrum
+from tests.test_regdb import build_regulatory_db
+
+
+@pytest.fixture
+def reg_db(regdb_lines):
+    return regdb.RegDB.from_regdbdump_output(regdb_lines)
+
+
+@pytest.fixture
+def regdb_file(reg_db, tmp_path):
+    db_path = tmp_path / "regulatory.db"
+    db_path.write_bytes(build_regulatory_db(reg_db))
+    return db_path
+
+
+def test_masks_round_trip():
+    band = spectrum.BAND_2GHZ
+    assert channel_table.encode_mask(band, 20, [1, 2, 3]) == 0b111
+    assert channel_table.decode_mask(band, 20, 0b1000000000001) == [1, 13]
+    assert channel_table.decode_mask(
+        band, 20, channel_table.encode_mask(band, 20, range(1, 12))) == \
+        list(range(1, 12))
+    assert channel_table.decode_mask(
+        spectrum.BAND_5GHZ, 80,
+        channel_table.encode_mask(spectrum.BAND_5GHZ, 80, [42, 155])) == \
+        [42, 155]
+
+
+def test_table_matches_per_country_computation(reg_db):
+    table = scan.build_channel_table(reg_db, b"\0" * 32)
+    for alpha2 in reg_db.country_codes():
+        assert table.channels(alpha2) == \
+            scan.channels_for_country(alpha2, reg_db)
+    assert table.channels("JP") == list(range(1, 12))
+    assert table.channels("XX") == []
+    for band, width in scan.CHANNEL_PLANS:
+        assert table.channels("US", band, width) == \
+            scan.channels_for_country("US", reg_db, band, width)
+        assert table.dfs_channels("US", band, width) == \
+            scan.dfs_channels_for_country("US", reg_db, band, width)
+    with pytest.raises(KeyError):
+        table.channels("AU", width=160)
+
+
+def test_table_bytes_round_trip(reg_db):
+    table = scan.build_channel_table(reg_db, bytes(range(32)))
+    data = table.to_bytes()
+    restored = channel_table.ChannelTable.from_bytes(data)
+    assert restored.digest == table.digest
+    assert restored.plans == table.plans
+    assert restored.masks == table.masks
+    assert restored.dfs_masks == table.dfs_masks
+    # A country is 2 bytes plus two 64 bit masks per plan
+    assert len(data) < (2 + 16 * len(table.plans)) * len(reg_db) + 128
+    with pytest.raises(ValueError):
+        channel_table.ChannelTable.from_bytes(data[:-1])
+
+
+def test_get_channel_table_is_persisted(monkeypatch, reg_db, regdb_file,
+                                        tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    table = scan.get_channel_table(str(regdb_file), cache_dir)
+    assert table.channels("US") == list(range(1, 12))
+    assert channel_table.table_path(cache_dir).exists()
+
+    # A new process reads the table without touching the database
+    monkeypatch.setattr(scan, "_channel_table_cache", {})
+    monkeypatch.setattr(regdb, "get_regdb", None)
+    assert scan.get_channel_table(str(regdb_file), cache_dir).masks == \
+        table.masks
+
+
+def test_get_channel_table_rebuilds_on_new_database(monkeypatch, reg_db,
+                                                    regdb_file, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    scan.get_channel_table(str(regdb_file), cache_dir)
+    # The US gains channels 12 and 13
+    us = reg_db.get("US")
+    reg_db.countries["US"] = us._replace(rules=reg_db.get("AU").rules)
+    regdb_file.write_bytes(build_regulatory_db(reg_db))
+    monkeypatch.setattr(scan, "_channel_table_cache", {})
+    assert scan.get_channel_table(str(regdb_file), cache_dir).channels(
+        "US") == list(range(1, 14))
+
+
+def test_load_channel_table_never_builds(monkeypatch, regdb_file, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    get_regdb = regdb.get_regdb
+    monkeypatch.setattr(regdb, "get_regdb", None)
+    assert scan.load_channel_table(str(regdb_file), cache_dir) is None
+    monkeypatch.setattr(regdb, "get_regdb", get_regdb)
+    table = scan.get_channel_table(str(regdb_file), cache_dir)
+    monkeypatch.setattr(regdb, "get_regdb", None)
+    loaded = scan.load_channel_table(str(regdb_file), cache_dir)
+    assert loaded.masks == table.masks
+    # Queries given the table don't look for the installed database
+    monkeypatch.setattr(scan, "get_channel_table", None)
+    assert scan.channels_for_country("US", table=loaded) == \
+        list(range(1, 12))
+    assert scan.choose_band(1, "US", table=loaded) == spectrum.BAND_5GHZ
+    assert scan.dfs_channels_for_country("US", table=loaded) == \
+        table.dfs_channels("US", spectrum.BAND_5GHZ)
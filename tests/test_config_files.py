@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from wifi_configurator import config_files
+
+
+def test_is_changed(tmp_path):
+    path = tmp_path / "hostapd.conf"
+    config_file = config_files.ConfigFile(str(path), b"channel=6\n")
+    assert config_files.is_changed(config_file)
+    path.write_bytes(b"channel=6\n")
+    assert not config_files.is_changed(config_file)
+    assert config_files.is_changed(config_file._replace(data=b"channel=1\n"))
+
+
+def test_write_atomically(tmp_path):
+    path = tmp_path / "hostapd.conf"
+    config_files.write_atomically(str(path), b"channel=6\n")
+    assert path.read_bytes() == b"channel=6\n"
+    assert path.stat().st_mode & 0o777 == config_files.DEFAULT_MODE
+    # Existing files keep their mode
+    path.chmod(0o600)
+    config_files.write_atomically(str(path), b"channel=1\n", sync=False)
+    assert path.read_bytes() == b"channel=1\n"
+    assert path.stat().st_mode & 0o777 == 0o600
+    assert os.listdir(str(tmp_path)) == ["hostapd.conf"]
+
+
+def test_failed_write_leaves_file_alone(tmp_path, monkeypatch):
+    path = tmp_path / "hostapd.conf"
+    path.write_bytes(b"channel=6\n")
+
+    def replace(*_):
+        raise OSError("No space left on device")
+    monkeypatch.setattr(config_files.os, "replace", replace)
+    with pytest.raises(OSError):
+        config_files.write_atomically(str(path), b"channel=1\n")
+    assert path.read_bytes() == b"channel=6\n"
+    assert os.listdir(str(tmp_path)) == ["hostapd.conf"]
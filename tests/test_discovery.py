@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+import pytest
+
+from wifi_configurator import discovery
+
+
+def test_stages_run_concurrently():
+    all_running = threading.Barrier(3, timeout=5)
+
+    def stage(result):
+        def func(_):
+            # Deadlocks (and times out) unless every stage runs at once
+            all_running.wait()
+            return result
+        return func
+    results = discovery.run_stages([
+        discovery.Stage("scan", stage("bsses"), 5, None),
+        discovery.Stage("adapter", stage("RTL8812BU"), 5, None),
+        discovery.Stage("channel table", stage("table"), 5, None),
+    ])
+    assert results == {"scan": "bsses", "adapter": "RTL8812BU",
+                       "channel table": "table"}
+
+
+def test_timed_out_stage_is_cancelled():
+    cancelled = []
+
+    def hung_scan(cancel):
+        cancelled.append(cancel)
+        cancel.wait(5)
+        return "too late"
+    start = time.monotonic()
+    results = discovery.run_stages([
+        discovery.Stage("scan", hung_scan, 0.1, "empty"),
+        discovery.Stage("adapter", lambda _: "default", 5, None),
+    ])
+    assert time.monotonic() - start < 2
+    assert results == {"scan": "empty", "adapter": "default"}
+    assert cancelled[0].is_set()
+
+
+def test_cancelled_stage_stops_before_returning():
+    cleaned_up = threading.Event()
+
+    def scan(cancel):
+        try:
+            cancel.wait(5)
+        finally:
+            # e.g. killing iw and putting the interface back down
+            time.sleep(0.1)
+            cleaned_up.set()
+    results = discovery.run_stages([
+        discovery.Stage("scan", scan, 0.1, "empty"),
+    ])
+    assert results == {"scan": "empty"}
+    assert cleaned_up.is_set()
+
+
+def test_stage_errors_are_raised():
+    def no_regdb(_):
+        raise FileNotFoundError("No regulatory database")
+    with pytest.raises(FileNotFoundError):
+        discovery.run_stages([
+            discovery.Stage("channel table", no_regdb, 5, None),
+            discovery.Stage("adapter", lambda _: "default", 5, None),
+        ])
+
+
+def test_stage_without_cancel_grace_is_not_waited_for():
+    release = threading.Event()
+    start = time.monotonic()
+    results = discovery.run_stages([
+        # Ignores cancelled, e.g. a single blocking call
+        discovery.Stage("channel table", lambda _: release.wait(5), 0.1,
+                        None, cancel_timeout_s=0),
+    ])
+    release.set()
+    assert time.monotonic() - start < 1
+    assert results == {"channel table": None}
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from wifi_configurator import hostapd_ctrl
+
+
+OLD_CONF = b"""\
+# General configuration
+interface=wlan0
+ctrl_interface=/var/run/hostapd
+ssid=ConnectBox - Free Media
+country_code=US
+hw_mode=g
+channel=6
+ht_capab=[HT40-][HT40+][SHORT-GI-20]
+"""
+
+
+class StandInHostapd:
+    """Answers control socket requests the way hostapd does.
+
+    Parameters
+    ----------
+    ctrl_dir : str
+        Where to create the interface's socket.
+    status : dict
+        The initial STATUS.
+    fail : iterable of str
+        Commands to answer with FAIL.
+    """
+
+    def __init__(self, ctrl_dir, interface="wlan0", status=None, fail=()):
+        self.status = dict(status or {
+            "state": "ENABLED", "freq": "2437", "channel": "6",
+            "ssid[0]": "ConnectBox - Free Media"})
+        self.fail = set(fail)
+        self.pending = {}
+        self.requests = []
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(os.path.join(ctrl_dir, interface))
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                data, sender = self.sock.recvfrom(4096)
+            except OSError:
+                return
+            request = data.decode("utf-8")
+            self.requests.append(request)
+            # Clients have to cope with unsolicited events
+            self.sock.sendto(b"<3>AP-STA-CONNECTED 02:00:00:00:00:01",
+                             sender)
+            self.sock.sendto(self.reply(request).encode("utf-8"), sender)
+
+    def reply(self, request):
+        command, _, args = request.partition(" ")
+        if command in self.fail:
+            return "FAIL\n"
+        if command == "PING":
+            return "PONG\n"
+        if command == "STATUS":
+            return "".join("%s=%s\n" % item for item in self.status.items())
+        if command == "SET":
+            name, _, value = args.partition(" ")
+            self.pending[name] = value
+        elif command == "RELOAD":
+            if "ssid" in self.pending:
+                self.status["ssid[0]"] = self.pending["ssid"]
+        elif command == "CHAN_SWITCH":
+            freq = int(args.split()[1])
+            self.status["freq"] = str(freq)
+            self.status["channel"] = str((freq - 2407) // 5)
+        else:
+            return "UNKNOWN COMMAND\n"
+        return "OK\n"
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def hostapd(tmp_path):
+    server = StandInHostapd(str(tmp_path))
+    yield server
+    server.close()
+
+
+def test_requests(hostapd, tmp_path):
+    with hostapd_ctrl.HostapdCtrl("wlan0", str(tmp_path)) as ctrl:
+        assert ctrl.ping()
+        assert ctrl.status()["state"] == "ENABLED"
+        ctrl.set("ssid", "Library")
+        ctrl.reload()
+        assert ctrl.status()["ssid[0]"] == "Library"
+        ctrl.chan_switch(2412, sec_channel_offset=1, center_freq1=2422,
+                         bandwidth=40, ht=True)
+    assert hostapd.requests[-1] == \
+        "CHAN_SWITCH 5 2412 sec_channel_offset=1 center_freq1=2422 " \
+        "bandwidth=40 ht"
+
+
+def test_refused_command(tmp_path):
+    server = StandInHostapd(str(tmp_path), fail=["CHAN_SWITCH"])
+    try:
+        with hostapd_ctrl.HostapdCtrl("wlan0", str(tmp_path)) as ctrl:
+            with pytest.raises(hostapd_ctrl.HostapdCtrlError):
+                ctrl.chan_switch(2412)
+    finally:
+        server.close()
+
+
+def test_no_hostapd(tmp_path):
+    with pytest.raises(hostapd_ctrl.HostapdCtrlError):
+        hostapd_ctrl.HostapdCtrl("wlan0", str(tmp_path))
+    assert not hostapd_ctrl.reconfigure(
+        "wlan0", OLD_CONF, OLD_CONF.replace(b"channel=6", b"channel=1"),
+        str(tmp_path))
+
+
+def test_reconfigure_channel(hostapd, tmp_path):
+    old_conf = OLD_CONF + b"ieee80211n=1\n"
+    new_conf = old_conf.replace(b"channel=6", b"channel=1") \
+        .replace(b"[HT40-][HT40+]", b"[HT40+]")
+    assert hostapd_ctrl.reconfigure("wlan0", old_conf, new_conf,
+                                    str(tmp_path))
+    assert "CHAN_SWITCH 5 2412 sec_channel_offset=1 center_freq1=2422 " \
+        "bandwidth=40 ht" in hostapd.requests
+    assert hostapd.status["channel"] == "1"
+
+
+def test_reconfigure_ssid_and_passphrase(hostapd, tmp_path):
+    old_conf = OLD_CONF + b"wpa=3\nwpa_passphrase=hellokitty\n"
+    new_conf = old_conf.replace(b"ConnectBox", b"Library") \
+        .replace(b"hellokitty", b"goodbyekitty")
+    assert hostapd_ctrl.reconfigure("wlan0", old_conf, new_conf,
+                                    str(tmp_path))
+    assert hostapd.requests[-4:-1] == [
+        "SET ssid Library - Free Media", "SET wpa_passphrase goodbyekitty",
+        "RELOAD"]
+    assert not any(r.startswith("CHAN_SWITCH") for r in hostapd.requests)
+
+
+def test_restart_needed(hostapd, tmp_path):
+    # Not something CHAN_SWITCH or RELOAD can change
+    assert not hostapd_ctrl.reconfigure(
+        "wlan0", OLD_CONF, OLD_CONF.replace(b"US", b"NZ"), str(tmp_path))
+    # Turning on WPA
+    assert not hostapd_ctrl.reconfigure(
+        "wlan0", OLD_CONF, OLD_CONF + b"wpa_passphrase=hellokitty\n",
+        str(tmp_path))
+    # Nothing hostapd's running with to compare to
+    assert not hostapd_ctrl.reconfigure(
+        "wlan0", None, OLD_CONF, str(tmp_path))
+    assert hostapd.requests == []
+
+
+def test_failed_switch_needs_restart(tmp_path, monkeypatch):
+    monkeypatch.setattr(hostapd_ctrl, "VERIFY_TIMEOUT_S", 0.2)
+    server = StandInHostapd(str(tmp_path), fail=["CHAN_SWITCH"])
+    try:
+        assert not hostapd_ctrl.reconfigure(
+            "wlan0", OLD_CONF, OLD_CONF.replace(b"channel=6", b"channel=1"),
+            str(tmp_path))
+    finally:
+        server.close()
+
+
+def test_wait_until_running(tmp_path):
+    deadline = time.monotonic() + 0.2
+    assert not hostapd_ctrl.wait_until_running("wlan0", deadline,
+                                               str(tmp_path))
+    server = StandInHostapd(str(tmp_path), status={"state": "DFS"})
+    try:
+        assert hostapd_ctrl.wait_until_running(
+            "wlan0", time.monotonic(), str(tmp_path))
+    finally:
+        server.close()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from wifi_configurator import bss, ht40, spectrum
+from wifi_configurator.scan_result import ScanResult
+
+
+def scan_result_of(*bsses):
+    """Build a ScanResult from (freq, secondary offset) pairs."""
+    return ScanResult.from_bss_records(
+        bss.BSS("", freq, -50.0, "", "", 0, 0, offset,
+                40 if offset else 20)
+        for freq, offset in bsses)
+
+
+def test_channel_pairs():
+    assert ht40.channel_pairs([3, 38]) == [
+        (1, 5), (5, 1), (36, 40), (40, 36)]
+    assert ht40.ht_capab_flag(ht40.ChannelPair(1, 5)) == ht40.HT40_PLUS
+    assert ht40.ht_capab_flag(ht40.ChannelPair(40, 36)) == ht40.HT40_MINUS
+    assert ht40.centre_channel(ht40.ChannelPair(40, 36)) == 38
+
+
+def test_ht_capab_has_one_ht40_flag():
+    ht_capab = "[HT20][SHORT-GI-20][HT40-][HT40+][RX-STBC1]"
+    assert ht40.supported_flags(ht_capab) == (ht40.HT40_PLUS,
+                                              ht40.HT40_MINUS)
+    assert ht40.supported_flags("[HT20][SHORT-GI-20][HT40]") == ()
+    assert ht40.with_ht40_flag(ht_capab, ht40.ChannelPair(5, 1)) == \
+        "[HT20][SHORT-GI-20][RX-STBC1][HT40-]"
+    assert ht40.with_ht40_flag(ht_capab, None) == \
+        "[HT20][SHORT-GI-20][RX-STBC1]"
+
+
+def test_2ghz_coexistence():
+    band = spectrum.BAND_2GHZ
+    pair = ht40.ChannelPair(1, 5)
+    assert ht40.coexistence_permits(pair, band, ScanResult())
+    # A 20MHz BSS on our primary is fine, one on our secondary isn't
+    assert ht40.coexistence_permits(pair, band, scan_result_of((2412, 0)))
+    assert not ht40.coexistence_permits(pair, band,
+                                        scan_result_of((2432, 0)))
+    # Nor is one within 25MHz of the centre (2422MHz), but beyond is fine
+    assert not ht40.coexistence_permits(pair, band,
+                                        scan_result_of((2447, 0)))
+    assert ht40.coexistence_permits(pair, band, scan_result_of((2452, 0)))
+    # A 40MHz BSS has to match both channels
+    assert ht40.coexistence_permits(pair, band, scan_result_of((2412, 1)))
+    assert not ht40.coexistence_permits(pair, band,
+                                        scan_result_of((2432, -1)))
+    # Its secondary counts too
+    assert not ht40.coexistence_permits(
+        pair, band, scan_result_of((2467, -1)))
+    # 5GHz BSSes don't matter
+    assert ht40.coexistence_permits(pair, band, scan_result_of((5180, 0)))
+
+
+def test_5ghz_coexistence():
+    band = spectrum.BAND_5GHZ
+    # Our secondary mustn't be someone's primary
+    assert not ht40.coexistence_permits(
+        ht40.ChannelPair(36, 40), band, scan_result_of((5200, 0)))
+    assert ht40.coexistence_permits(
+        ht40.ChannelPair(40, 36), band, scan_result_of((5200, 0)))
+    assert ht40.coexistence_permits(
+        ht40.ChannelPair(44, 48), band, scan_result_of((5200, -1)))
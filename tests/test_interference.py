@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from wifi_configurator import interference, spectrum
+
+
+def test_dbm_to_mw():
+    assert interference.dbm_to_mw(0) == 1
+    assert interference.dbm_to_mw(-30) == pytest.approx(0.001)
+
+
+def test_spectral_overlap():
+    assert interference.spectral_overlap(2437, 2437) == 1
+    assert interference.spectral_overlap(2437, 2432) == 0.75
+    assert interference.spectral_overlap(2437, 2452) == 0.25
+    assert interference.spectral_overlap(2437, 2457) == 0
+    assert interference.spectral_overlap(2412, 2472) == 0
+
+
+def test_strong_neighbour_contests_adjacent_channels():
+    # A strong AP on 6 makes 5 (which it overlaps) worse than 1 or 11, even
+    #  though nothing is on 5 itself
+    ranked = interference.rank_channels(
+        [1, 5, 11], {2437: interference.dbm_to_mw(-40)})
+    assert [channel for channel, _ in ranked] == [1, 11, 5]
+    assert ranked[0][1] == ranked[1][1] == 0
+    assert ranked[2][1] > 0
+
+
+def test_signal_strength_weights_cost():
+    # One loud AP on 1 outweighs several quiet ones on 11
+    power = {
+        2412: interference.dbm_to_mw(-35),
+        2462: 3 * interference.dbm_to_mw(-85),
+    }
+    ranked = interference.rank_channels([1, 11], power)
+    assert [channel for channel, _ in ranked] == [11, 1]
+
+
+def test_unknown_channels_are_skipped():
+    assert interference.channel_costs([1, 36], {}) == {1: 0}
+
+
+def test_5ghz_channels_dont_overlap_neighbours():
+    costs = interference.channel_costs(
+        [36, 40, 44], {5200: interference.dbm_to_mw(-40)},
+        band=spectrum.BAND_5GHZ)
+    assert costs[40] > 0
+    assert costs[36] == costs[44] == 0
+
+
+def test_penalties_affect_ranking_only():
+    ranked = interference.rank_channels(
+        [52, 36], {5180: interference.dbm_to_mw(-90)},
+        band=spectrum.BAND_5GHZ,
+        penalties_mw={52: interference.dbm_to_mw(-70)})
+    assert ranked == [(36, interference.dbm_to_mw(-90)), (52, 0)]
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+from wifi_configurator import lazy
+
+
+# Importing the cli module (all --help needs) took 60-80ms here, against
+#  180ms when it imported everything up front. Best of a few runs, to ride
+#  out a busy machine. Wall clock timings depend on the machine, so the
+#  budget is only checked if this is set in the environment
+TIMING_TESTS_ENV = "WIFI_CONFIGURATOR_TIMING_TESTS"
+COLD_START_BUDGET_US = 150000
+COLD_START_RUNS = 3
+HEAVY_MODULES = ("configobj", "jinja2", "pyric.pyw", "subprocess")
+
+IMPORTTIME_OUTPUT = """\
+import time: self [us] | cumulative | imported package
+import time:       127 |        127 |     _locale
+import time:      1338 |       1465 |   locale
+import time:      7986 |      57031 | wifi_configurator.cli
+import time:       536 |      33891 | click.core
+"""
+
+
+def loaded_modules(code):
+    """Return which of HEAVY_MODULES are loaded after running code."""
+    check = ("import sys, types\n%s\n"
+             "print(' '.join(name for name in %r\n"
+             "    if type(sys.modules.get(name)) is types.ModuleType))" %
+             (code, HEAVY_MODULES))
+    result = subprocess.run([sys.executable, "-c", check],
+                            stdout=subprocess.PIPE, check=True,
+                            universal_newlines=True)
+    return set(result.stdout.split())
+
+
+def test_parse_importtime():
+    assert lazy.parse_importtime(IMPORTTIME_OUTPUT) == [
+        lazy.ImportTime("_locale", 127, 127, 2),
+        lazy.ImportTime("locale", 1338, 1465, 1),
+        lazy.ImportTime("wifi_configurator.cli", 7986, 57031, 0),
+        lazy.ImportTime("click.core", 536, 33891, 0),
+    ]
+    times = lazy.parse_importtime(IMPORTTIME_OUTPUT)
+    assert lazy.cumulative_us(times, "wifi_configurator.cli") == 57031
+    assert lazy.cumulative_us(times, "jinja2") == 0
+    assert lazy.package_costs(times) == [
+        ("wifi_configurator.cli", 7986), ("locale", 1338), ("click", 536),
+        ("_locale", 127)]
+
+
+def test_lazy_import_defers_loading():
+    assert loaded_modules(
+        "from wifi_configurator import lazy\n"
+        "lazy.lazy_import('jinja2')") == set()
+    assert loaded_modules(
+        "from wifi_configurator import lazy\n"
+        "lazy.lazy_import('jinja2').Environment") == {"jinja2"}
+    assert loaded_modules(
+        "import os\n"
+        "os.environ[%r] = '1'\n"
+        "from wifi_configurator import lazy\n"
+        "lazy.lazy_import('jinja2')" % (lazy.EAGER_IMPORTS_ENV,)) == \
+        {"jinja2"}
+
+
+def test_help_loads_no_heavy_modules():
+    assert loaded_modules(
+        "from click.testing import CliRunner\n"
+        "from wifi_configurator import cli\n"
+        "assert CliRunner().invoke(cli.main, ['--help']).exit_code == 0") \
+        == set()
+
+
+@pytest.mark.skipif(not os.environ.get(TIMING_TESTS_ENV),
+                    reason="set %s to check timings" % (TIMING_TESTS_ENV,))
+def test_cold_start_budget():
+    cold_start_us = min(
+        lazy.cumulative_us(lazy.import_times([lazy.CLI_MODULE]),
+                           lazy.CLI_MODULE)
+        for _ in range(COLD_START_RUNS))
+    assert 0 < cold_start_us < COLD_START_BUDGET_US
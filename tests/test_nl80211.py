@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import errno
+import socket
+import struct
+
+import pyric.net.netlink_h as nlh
+import pyric.net.wireless.nl80211_h as nl80211h
+import pytest
+
+from wifi_configurator import bss, nl80211
+from wifi_configurator.nl80211 import (
+    pack_genlmsg, pack_nla, pack_nla_u32
+)
+
+
+FAMILY_ID = 0x1c
+SCAN_GROUP = 5
+IFINDEX = 3
+
+
+def ack(seq, error=0):
+    payload = struct.pack("=l", -error) + b"\0" * 16
+    return struct.pack("=LHHLL", 16 + len(payload), nlh.NLMSG_ERROR, 0,
+                       seq, 0) + payload
+
+
+def done(seq):
+    return struct.pack("=LHHLLl", 20, nlh.NLMSG_DONE, nlh.NLM_F_MULTI,
+                       seq, 0, 0)
+
+
+def bss_message(seq, bssid, freq, signal_mbm, ies):
+    bss_attrs = pack_nla(nl80211h.NL80211_BSS_BSSID, bytes(bssid)) + \
+        pack_nla_u32(nl80211h.NL80211_BSS_FREQUENCY, freq) + \
+        pack_nla(nl80211h.NL80211_BSS_SIGNAL_MBM,
+                 struct.pack("=l", signal_mbm)) + \
+        pack_nla_u32(nl80211h.NL80211_BSS_SEEN_MS_AGO, 40) + \
+        pack_nla(nl80211h.NL80211_BSS_INFORMATION_ELEMENTS, ies)
+    attrs = pack_nla_u32(nl80211h.NL80211_ATTR_IFINDEX, IFINDEX) + \
+        pack_nla(nl80211h.NL80211_ATTR_BSS | nlh.NLA_F_NESTED, bss_attrs)
+    return pack_genlmsg(FAMILY_ID, nl80211h.NL80211_CMD_NEW_SCAN_RESULTS,
+                        attrs, nlh.NLM_F_MULTI, seq)
+
+
+def event(cmd, ifindex=IFINDEX):
+    return pack_genlmsg(
+        FAMILY_ID, cmd, pack_nla_u32(nl80211h.NL80211_ATTR_IFINDEX, ifindex))
+
+
+# Recorded dump of two BSSes: an HT40+ AP advertising AU and a plain
+#  HT20 AP with no country element. The third IE set is a VHT80 AP
+DUMP_IES = [
+    bytes([0, 3]) + b"one" +
+    bytes([7, 6]) + b"AU " + bytes([1, 13, 20]) +
+    bytes([61, 22, 1, 0x05]) + bytes(20),
+    bytes([0, 3]) + b"two" +
+    bytes([61, 22, 7, 0x00]) + bytes(20),
+    bytes([0, 5]) + b"three" +
+    bytes([61, 22, 36, 0x05]) + bytes(20) +
+    bytes([192, 5, 1, 42, 0, 0xfc, 0xff]),
+]
+
+
+class RecordedNetlinkSocket:
+    """Stand-in for an AF_NETLINK socket that replays kernel replies.
+
+    replies maps a genl command to a function of the request's seq that
+    returns the datagrams the kernel would send back.  Unsolicited
+    datagrams (multicast events) are queued with push().
+    """
+
+    def __init__(self, replies=None):
+        self.replies = replies or {}
+        self.queue = []
+        self.sent = []
+        self.groups = []
+        self.closed = False
+
+    def push(self, datagram):
+        self.queue.append(datagram)
+
+    def send(self, data):
+        _, _, _, seq, _ = struct.unpack_from("=LHHLL", data)
+        cmd = data[16]
+        self.sent.append((cmd, data))
+        self.queue.extend(self.replies[cmd](seq))
+        return len(data)
+
+    def recv(self, _):
+        if not self.queue:
+            raise socket.timeout()
+        return self.queue.pop(0)
+
+    def settimeout(self, _):
+        pass
+
+    def setsockopt(self, level, option, value):
+        assert (level, option) == (nl80211.SOL_NETLINK,
+                                   nlh.NETLINK_ADD_MEMBERSHIP)
+        self.groups.append(value)
+
+    def close(self):
+        self.closed = True
+
+
+def dump_replies(seq):
+    return [
+        bss_message(seq, [0xea, 0xd8, 0xab, 0x0d, 0x39, 0xe8], 2412,
+                    -4800, DUMP_IES[0]) +
+        bss_message(seq, [0x23, 0xa0, 0xac, 0x8f, 0x44, 0xb7], 2442,
+                    -8150, DUMP_IES[1]),
+        done(seq),
+    ]
+
+
+def nl_socket(sock):
+    return nl80211.NL80211Socket(sock, FAMILY_ID, {"scan": SCAN_GROUP})
+
+
+def test_dump_scan_results():
+    sock = RecordedNetlinkSocket({nl80211h.NL80211_CMD_GET_SCAN: dump_replies})
+    records = list(nl_socket(sock).iter_scan_results(IFINDEX))
+    assert records == [
+        bss.BSS("ea:d8:ab:0d:39:e8", 2412, -48.0, "AU", "one", 40,
+                1, bss.SECONDARY_ABOVE, 40),
+        bss.BSS("23:a0:ac:8f:44:b7", 2442, -81.5, "", "two", 40,
+                7, bss.SECONDARY_NONE, 20),
+    ]
+
+
+def test_trigger_busy_raises_errno():
+    sock = RecordedNetlinkSocket({
+        nl80211h.NL80211_CMD_TRIGGER_SCAN: lambda seq: [ack(seq, errno.EBUSY)]
+    })
+    with pytest.raises(nl80211.NL80211Error) as excinfo:
+        nl_socket(sock).trigger_scan(IFINDEX)
+    assert excinfo.value.errno == errno.EBUSY
+
+
+def test_trigger_scan_is_active():
+    sock = RecordedNetlinkSocket({
+        nl80211h.NL80211_CMD_TRIGGER_SCAN: lambda seq: [ack(seq)]
+    })
+    nl_socket(sock).trigger_scan(IFINDEX)
+    [(cmd, data)] = sock.sent
+    assert cmd == nl80211h.NL80211_CMD_TRIGGER_SCAN
+    # nlmsghdr, genlmsghdr, then IFINDEX and SCAN_SSIDS holding a single
+    #  empty (wildcard) SSID
+    assert data[20:] == \
+        struct.pack("=HHL", 8, nl80211h.NL80211_ATTR_IFINDEX, IFINDEX) + \
+        struct.pack("=HH", 8, nl80211h.NL80211_ATTR_SCAN_SSIDS |
+                    nlh.NLA_F_NESTED) + \
+        struct.pack("=HH", 4, 1)
+
+
+def test_wait_for_scan_ignores_other_interfaces():
+    sock = RecordedNetlinkSocket()
+    nl = nl_socket(sock)
+    nl.join_group("scan")
+    assert sock.groups == [SCAN_GROUP]
+    sock.push(event(nl80211h.NL80211_CMD_TRIGGER_SCAN))
+    sock.push(event(nl80211h.NL80211_CMD_NEW_SCAN_RESULTS, ifindex=9))
+    sock.push(event(nl80211h.NL80211_CMD_NEW_SCAN_RESULTS))
+    assert nl.wait_for_scan(IFINDEX)
+    sock.push(event(nl80211h.NL80211_CMD_SCAN_ABORTED))
+    assert not nl.wait_for_scan(IFINDEX)
+
+
+def test_wait_for_scan_times_out():
+    with pytest.raises(nl80211.NL80211Error) as excinfo:
+        list(nl_socket(RecordedNetlinkSocket()).recv_messages(deadline=0))
+    assert excinfo.value.errno == errno.ETIMEDOUT
+
+
+def test_resolve_family():
+    def getfamily(seq):
+        grp = pack_nla(1, b"scan\0") + pack_nla_u32(2, SCAN_GROUP)
+        attrs = pack_nla(1, struct.pack("=H", FAMILY_ID)) + \
+            pack_nla(2, b"nl80211\0") + \
+            pack_nla(7 | nlh.NLA_F_NESTED,
+                     pack_nla(1 | nlh.NLA_F_NESTED, grp))
+        return [pack_genlmsg(0x10, 1, attrs, 0, seq), ack(seq)]
+
+    nl = nl80211.NL80211Socket(RecordedNetlinkSocket({3: getfamily}))
+    assert nl.family_id == FAMILY_ID
+    assert nl.mcast_groups == {"scan": SCAN_GROUP}
+
+
+def test_bss_from_attrs_vht():
+    record = nl80211.bss_from_attrs({
+        nl80211h.NL80211_BSS_FREQUENCY: struct.pack("=L", 5180),
+        nl80211h.NL80211_BSS_INFORMATION_ELEMENTS: DUMP_IES[2],
+    })
+    assert record.ssid == "three"
+    assert record.vht_channel_width == bss.VHT_WIDTH_80
+    assert (record.vht_center_seg1, record.vht_center_seg2) == (42, 0)
+    assert bss.record_occupied_freqs(record) == (5180, 5200, 5220, 5240)
+
+
+def wiphy_replies(seq):
+    def band(band_id, attrs):
+        return pack_nla(band_id | nlh.NLA_F_NESTED, attrs)
+
+    def message(attrs, phy_index=0):
+        return pack_genlmsg(
+            FAMILY_ID, nl80211h.NL80211_CMD_NEW_WIPHY,
+            pack_nla_u32(nl80211h.NL80211_ATTR_WIPHY, phy_index) + attrs,
+            nlh.NLM_F_MULTI, seq)
+
+    ht_capa = pack_nla(nl80211h.NL80211_BAND_ATTR_HT_CAPA,
+                       struct.pack("=H", 0x01ef))
+    # A split dump: the name, then one band per message, then the
+    #  interface modes. Another phy's message is mixed in
+    return [
+        message(pack_nla(nl80211h.NL80211_ATTR_WIPHY_NAME, b"phy0\0")) +
+        message(pack_nla(nl80211h.NL80211_ATTR_WIPHY_BANDS,
+                         band(nl80211h.NL80211_BAND_2GHZ, ht_capa))) +
+        message(pack_nla(nl80211h.NL80211_ATTR_WIPHY_BANDS,
+                         band(nl80211h.NL80211_BAND_5GHZ, ht_capa)),
+                phy_index=1),
+        message(pack_nla(
+            nl80211h.NL80211_ATTR_WIPHY_BANDS,
+            band(nl80211h.NL80211_BAND_5GHZ, ht_capa + pack_nla_u32(
+                nl80211h.NL80211_BAND_ATTR_VHT_CAPA, 0x03c001b0)))) +
+        message(pack_nla(
+            nl80211h.NL80211_ATTR_SUPPORTED_IFTYPES,
+            pack_nla(nl80211h.NL80211_IFTYPE_STATION, b"") +
+            pack_nla(nl80211h.NL80211_IFTYPE_AP, b""))),
+        done(seq),
+    ]
+
+
+def test_get_wiphy():
+    sock = RecordedNetlinkSocket(
+        {nl80211h.NL80211_CMD_GET_WIPHY: wiphy_replies})
+    wiphy = nl_socket(sock).get_wiphy(0)
+    assert wiphy.name == "phy0"
+    assert wiphy.bands == {
+        nl80211h.NL80211_BAND_2GHZ: nl80211.Band(0x01ef, None),
+        nl80211h.NL80211_BAND_5GHZ: nl80211.Band(0x01ef, 0x03c001b0),
+    }
+    assert wiphy.iftypes == {nl80211h.NL80211_IFTYPE_STATION,
+                             nl80211h.NL80211_IFTYPE_AP}
+    assert nl_socket(sock).get_wiphy(2) is None
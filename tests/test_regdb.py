@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pathlib
+import struct
+
+import pytest
+
+from wifi_configurator import regdb, scan
+
+
+@pytest.fixture
+def reg_db(regdb_lines):
+    return regdb.RegDB.from_regdbdump_output(regdb_lines)
+
+
+def test_countries_are_indexed(reg_db):
+    assert len(reg_db) == 174
+    assert "AU" in reg_db
+    assert "XX" not in reg_db
+    assert reg_db.get("XX") is None
+    assert reg_db.rules("XX") == ()
+    assert reg_db.get("US").dfs_region == "DFS-FCC"
+
+
+def test_rules_are_structured(reg_db):
+    rules = reg_db.rules("AU")
+    assert len(rules) == 5
+    assert rules[0] == regdb.Rule(2402.0, 2482.0, 40.0, 20.0, None,
+                                  frozenset())
+    assert rules[2].flags == {regdb.FLAG_DFS, regdb.FLAG_AUTO_BW}
+    assert reg_db.rules("00")[2].flags == {regdb.FLAG_NO_OFDM,
+                                           regdb.FLAG_NO_IR}
+    # 60GHz rule with no EIRP
+    assert reg_db.rules("00")[-1].max_eirp is None
+
+
+def test_parse_rule_units():
+    rule = regdb.parse_rule(
+        "\t(5250.000 - 5330.000 @ 80.000), (100 mW), (60000), DFS")
+    assert rule.max_eirp == pytest.approx(20.0)
+    assert rule.dfs_cac_ms == 60000
+    assert rule.flags == {regdb.FLAG_DFS}
+    with pytest.raises(ValueError):
+        regdb.parse_rule("country US: DFS-FCC")
+
+
+def test_lookup_matches_header_only(reg_db):
+    # 'US' appears in other countries' lines (e.g. AU), but only the US
+    #  block may match
+    assert scan.get_country_rules_block("US", pathlib.Path(
+        "tests/fixtures/reg-db.txt").read_text().split("\n"))[0] == \
+        "country US: DFS-FCC"
+    assert scan.channels_for_country("US", reg_db) == list(range(1, 12))
+    assert scan.channels_for_country("AU", reg_db) == list(range(1, 14))
+    assert scan.channels_for_country("XX", reg_db) == []
+
+
+def test_get_regdb_parses_once(monkeypatch, tmp_path):
+    db_path = tmp_path / "regulatory.bin"
+    db_path.write_bytes(b"binary")
+    loads = []
+
+    def fake_from_file(path, regdbdump):
+        loads.append(path)
+        return regdb.RegDB.from_regdbdump_output(
+            pathlib.Path("tests/fixtures/reg-db.txt").read_text())
+
+    monkeypatch.setattr(regdb.RegDB, "from_file", fake_from_file)
+    first = regdb.get_regdb(str(db_path))
+    assert regdb.get_regdb(str(db_path)) is first
+    assert loads == [str(db_path)]
+    # A new database is picked up
+    db_path.write_bytes(b"updated binary")
+    assert regdb.get_regdb(str(db_path)) is not first
+    assert len(loads) == 2
+
+
+CRDA_FLAG_BITS = {
+    regdb.FLAG_NO_OFDM: 1 << 0,
+    regdb.FLAG_NO_OUTDOOR: 1 << 3,
+    regdb.FLAG_DFS: 1 << 4,
+    regdb.FLAG_NO_IR: 1 << 7,
+    regdb.FLAG_AUTO_BW: 1 << 11,
+}
+
+
+def build_regulatory_bin(reg_db, signature=b"\0" * 128):
+    """Encode reg_db in CRDA's regulatory.bin format, as db2bin.py does."""
+    header_len = 20
+    body = bytearray()
+
+    def offset():
+        return header_len + len(body)
+
+    collection_ptrs = {}
+    for alpha2 in reg_db.country_codes():
+        rule_ptrs = []
+        for rule in reg_db.rules(alpha2):
+            range_ptr = offset()
+            body.extend(struct.pack(
+                ">III", int(rule.start_freq * 1000), int(rule.end_freq * 1000),
+                int(rule.max_bandwidth * 1000)))
+            power_ptr = offset()
+            body.extend(struct.pack(
+                ">II", 0, int(round((rule.max_eirp or 0) * 100))))
+            rule_ptrs.append(offset())
+            body.extend(struct.pack(
+                ">III", range_ptr, power_ptr,
+                sum(CRDA_FLAG_BITS[flag] for flag in rule.flags)))
+        collection_ptrs[alpha2] = offset()
+        body.extend(struct.pack(">I", len(rule_ptrs)))
+        for rule_ptr in rule_ptrs:
+            body.extend(struct.pack(">I", rule_ptr))
+    countries_ptr = offset()
+    for alpha2 in sorted(reg_db.country_codes()):
+        dfs_region = regdb.DFS_REGIONS.index(reg_db.get(alpha2).dfs_region)
+        body.extend(struct.pack(">2sxBI", alpha2.encode("ascii"), dfs_region,
+                                collection_ptrs[alpha2]))
+    header = struct.pack(">IIIII", regdb.REGDB_MAGIC, regdb.CRDA_VERSION,
+                         countries_ptr, len(reg_db), len(signature))
+    return header + bytes(body) + signature
+
+
+def test_crda_reader_matches_regdbdump_text(reg_db):
+    crda_db = regdb.CRDARegDB(build_regulatory_bin(reg_db))
+    assert len(crda_db) == len(reg_db)
+    assert sorted(crda_db.country_codes()) == sorted(reg_db.country_codes())
+    for alpha2 in reg_db.country_codes():
+        assert crda_db.get(alpha2) == reg_db.get(alpha2)
+    assert "XX" not in crda_db
+    assert crda_db.rules("XX") == ()
+    assert scan.channels_for_country("US", crda_db) == list(range(1, 12))
+
+
+def test_crda_reader_maps_file(reg_db, tmp_path):
+    db_path = tmp_path / "regulatory.bin"
+    db_path.write_bytes(build_regulatory_bin(reg_db))
+    crda_db = regdb.load_regdb(str(db_path), regdbdump="/nonexistent")
+    assert isinstance(crda_db, regdb.CRDARegDB)
+    assert crda_db.get("JP") == reg_db.get("JP")
+
+
+def test_binary_readers_index_countries(reg_db, monkeypatch):
+    for db in (regdb.CRDARegDB(build_regulatory_bin(reg_db)),
+               regdb.FirmwareRegDB(build_regulatory_db(reg_db))):
+        # Lookups go straight to the country, without scanning the list
+        monkeypatch.setattr(db, "_iter_countries", None)
+        assert db.get("JP") == reg_db.get("JP")
+        assert "XX" not in db
+
+
+def test_crda_reader_rejects_garbage(reg_db):
+    data = build_regulatory_bin(reg_db)
+    for bad in (b"", b"XXXX" + data[4:], data[:100]):
+        with pytest.raises(ValueError):
+            regdb.CRDARegDB(bad)
+
+
+def test_unreadable_binary_falls_back_to_regdbdump(tmp_path):
+    db_path = tmp_path / "regulatory.bin"
+    db_path.write_bytes(b"not a regdb")
+    regdbdump = tmp_path / "regdbdump"
+    regdbdump.write_text("#!/bin/sh\ncat %s\n" % (
+        pathlib.Path("tests/fixtures/reg-db.txt").resolve(),))
+    regdbdump.chmod(0o755)
+    reg_db = regdb.load_regdb(str(db_path), str(regdbdump))
+    assert isinstance(reg_db, regdb.RegDB)
+    assert "AU" in reg_db
+
+
+FWDB_FLAG_BITS = {
+    regdb.FLAG_NO_OFDM: 1 << 0,
+    regdb.FLAG_NO_OUTDOOR: 1 << 1,
+    regdb.FLAG_DFS: 1 << 2,
+    regdb.FLAG_NO_IR: 1 << 3,
+    regdb.FLAG_AUTO_BW: 1 << 4,
+}
+
+
+def build_regulatory_db(reg_db, cac_s=0):
+    """Encode reg_db in the kernel's regulatory.db format, as db2fw.py does.
+
+    With cac_s, DFS rules carry the optional CAC timeout field.
+    """
+    alpha2s = sorted(reg_db.country_codes())
+    data = bytearray(struct.pack(">II", regdb.REGDB_MAGIC,
+                                 regdb.FWDB_VERSION))
+    country_list = len(data)
+    data.extend(bytes(4 * (len(alpha2s) + 1)))
+    for index, alpha2 in enumerate(alpha2s):
+        country = reg_db.get(alpha2)
+        rule_ptrs = []
+        for rule in country.rules:
+            rule_ptrs.append(len(data) >> 2)
+            with_cac = cac_s and regdb.FLAG_DFS in rule.flags
+            data.extend(struct.pack(
+                ">BBHIII", 18 if with_cac else 16,
+                sum(FWDB_FLAG_BITS[flag] for flag in rule.flags),
+                int(round((rule.max_eirp or 0) * 100)),
+                int(rule.start_freq * 1000), int(rule.end_freq * 1000),
+                int(rule.max_bandwidth * 1000)))
+            if with_cac:
+                data.extend(struct.pack(">H", cac_s) + bytes(2))
+        collection_ptr = len(data) >> 2
+        data.extend(struct.pack(
+            ">BBBx", 3, len(rule_ptrs),
+            regdb.DFS_REGIONS.index(country.dfs_region)))
+        for rule_ptr in rule_ptrs:
+            data.extend(struct.pack(">H", rule_ptr))
+        data.extend(bytes(-len(data) % 4))
+        struct.pack_into(">2sH", data, country_list + 4 * index,
+                         alpha2.encode("ascii"), collection_ptr)
+    return bytes(data)
+
+
+def test_firmware_reader_matches_regdbdump_text(reg_db):
+    fw_db = regdb.FirmwareRegDB(build_regulatory_db(reg_db))
+    assert len(fw_db) == len(reg_db)
+    assert fw_db.country_codes() == sorted(reg_db.country_codes())
+    for alpha2 in reg_db.country_codes():
+        assert fw_db.get(alpha2) == reg_db.get(alpha2)
+    assert "XX" not in fw_db
+    assert scan.channels_for_country("AU", fw_db) == list(range(1, 14))
+
+
+def test_firmware_reader_optional_fields(reg_db):
+    fw_db = regdb.FirmwareRegDB(build_regulatory_db(reg_db, cac_s=60))
+    rules = fw_db.rules("AU")
+    assert rules[2].flags == {regdb.FLAG_DFS, regdb.FLAG_AUTO_BW}
+    assert rules[2].dfs_cac_ms == 60000
+    assert rules[0].dfs_cac_ms is None
+    assert rules[0].start_freq == 2402
+
+
+def test_firmware_reader_rejects_other_formats(reg_db):
+    with pytest.raises(ValueError):
+        regdb.FirmwareRegDB(build_regulatory_bin(reg_db))
+    with pytest.raises(ValueError):
+        regdb.CRDARegDB(build_regulatory_db(reg_db))
+
+
+def test_available_database_is_picked(monkeypatch, reg_db, tmp_path):
+    db_path = tmp_path / "regulatory.db"
+    bin_path = tmp_path / "regulatory.bin"
+    monkeypatch.setattr(regdb, "REGULATORY_DATABASES",
+                        (str(db_path), str(bin_path)))
+    with pytest.raises(FileNotFoundError):
+        regdb.find_regdb()
+    bin_path.write_bytes(build_regulatory_bin(reg_db))
+    assert isinstance(regdb.load_regdb(), regdb.CRDARegDB)
+    db_path.write_bytes(build_regulatory_db(reg_db))
+    reg_db = regdb.load_regdb(regdbdump="/nonexistent")
+    assert isinstance(reg_db, regdb.FirmwareRegDB)
+    assert reg_db.get("US").dfs_region == "DFS-FCC"
@@ -1,7 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from wifi_configurator import scan
+import errno
+import os
+import subprocess
+import threading
+import time
+
+import pytest
+
+from wifi_configurator import bss, ht40, regdb, scan, spectrum
 
 
 def freq_signal_dict_as_scan_output(cs_dict):
@@ -288,3 +296,358 @@ def test_uncontested_channels():
         range(1, 14),
         freq_signal_dict_as_scan_output({2422: -50, 2452: -50})
     ) == 13
+
+
+def test_max_signal_at_each_freq(iw_dev_scan_3):
+    assert scan.get_max_signal_at_each_freq(iw_dev_scan_3) == {
+        2412: -32.0,
+        2442: -36.0,
+        5180: -25.0,
+    }
+
+
+def test_stream_bss_records_matches_batch_parse(iw_dev_scan_0):
+    read_fd, write_fd = os.pipe()
+    # Leave the writer open so only the deadline ends the read
+    os.write(write_fd, iw_dev_scan_0.encode("utf-8"))
+    try:
+        records = list(scan.stream_bss_records(
+            read_fd, deadline=time.monotonic() + 0.2))
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+    assert records == bss.parse_bss_records(iw_dev_scan_0)
+
+
+def test_stream_bss_records_partial_on_timeout(iw_dev_scan_3):
+    raw = iw_dev_scan_3.encode("utf-8")
+    # Cut the output off part way through the third BSS block
+    cutoff = raw.index(b"\tsignal: -25.00 dBm")
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, raw[:cutoff])
+    try:
+        records = list(scan.stream_bss_records(
+            read_fd, deadline=time.monotonic() + 0.2))
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+    assert [(r.freq, r.signal) for r in records] == [
+        (2412, -32.0),
+        (2442, -36.0),
+        (5180, 0.0),
+    ]
+
+
+def test_stream_bss_records_eof(iw_dev_scan_1):
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, iw_dev_scan_1.encode("utf-8").rstrip(b"\n"))
+    os.close(write_fd)
+    with os.fdopen(read_fd, "rb") as stream:
+        records = list(scan.stream_bss_records(stream))
+    assert [r.bssid for r in records] == ["ea:d8:ab:0d:39:e8"]
+
+
+def test_country_consensus_is_decisive(iw_dev_scan_0, iw_dev_scan_3):
+    # TR 3, AL 1
+    assert not scan.country_consensus_is_decisive(
+        scan.as_scan_result(iw_dev_scan_0))
+    assert scan.country_consensus_is_decisive(
+        scan.as_scan_result(iw_dev_scan_0), margin=2)
+    assert scan.country_consensus_is_decisive(
+        scan.as_scan_result(iw_dev_scan_3), margin=2)
+    assert not scan.country_consensus_is_decisive(scan.ScanResult())
+
+
+def test_backoff_delays_are_capped():
+    delays = scan.backoff_delays(0.25, 2)
+    assert [next(delays) for _ in range(6)] == [0.25, 0.5, 1, 2, 2, 2]
+
+
+class FakeCard:  # pylint: disable=too-few-public-methods
+    dev = "wlan9"
+    idx = 9
+
+
+def test_iw_scan_retries_busy_then_succeeds(monkeypatch, iw_dev_scan_3):
+    # First attempt: iw reports EBUSY. Second: the fixture output.
+    commands = [
+        "echo 'command failed: Device or resource busy (-16)' >&2; exit 240",
+        "cat tests/fixtures/iw_dev_scan_3.txt",
+    ]
+    real_popen = subprocess.Popen
+    delays = []
+
+    def fake_popen(_, **kwargs):
+        return real_popen(["sh", "-c", commands.pop(0)], **kwargs)
+
+    monkeypatch.setattr(scan.subprocess, "Popen", fake_popen)
+    monkeypatch.setattr(scan.pyw, "isup", lambda _: True)
+    monkeypatch.setattr(scan, "sleep_until",
+                        lambda delay, *_: delays.append(delay))
+    scan_result = scan.get_scan_result(
+        FakeCard(), timeout=5, backend=scan.SCAN_BACKEND_IW)
+    assert scan_result.freq_signal_tuples() == \
+        scan.get_freq_signal_tuples_from_iw_output(iw_dev_scan_3)
+    assert delays == [scan.SCAN_BACKOFF_INITIAL_S]
+    assert not commands
+
+
+def test_iw_scan_error_carries_errno(monkeypatch):
+    real_popen = subprocess.Popen
+
+    def fake_popen(_, **kwargs):
+        return real_popen(
+            ["sh", "-c", "echo 'command failed: Network is down (-100)' >&2;"
+                         "exit 156"], **kwargs)
+
+    monkeypatch.setattr(scan.subprocess, "Popen", fake_popen)
+    with pytest.raises(scan.ScanError) as excinfo:
+        scan._iw_scan(  # pylint: disable=protected-access
+            FakeCard(), scan.ScanResult(), time.monotonic() + 5, None, 10)
+    assert excinfo.value.errno == errno.ENETDOWN
+
+
+def test_fresh_cache_skips_scan(monkeypatch, iw_dev_scan_0):
+    real_popen = subprocess.Popen
+    commands = []
+
+    def fake_popen(cmd, **kwargs):
+        commands.append(cmd[3:])
+        return real_popen(["cat", "tests/fixtures/iw_dev_scan_0.txt"],
+                          **kwargs)
+
+    monkeypatch.setattr(scan.subprocess, "Popen", fake_popen)
+    monkeypatch.setattr(scan.pyw, "isup", lambda _: True)
+    scan_result = scan.get_scan_result(
+        FakeCard(), timeout=5, backend=scan.SCAN_BACKEND_IW,
+        cached_max_age_s=1)
+    assert commands == [["scan", "dump"]]
+    assert len(scan_result) == len(bss.parse_bss_records(iw_dev_scan_0))
+
+
+def test_sparse_cache_triggers_scan(monkeypatch):
+    real_popen = subprocess.Popen
+    commands = []
+
+    def fake_popen(cmd, **kwargs):
+        commands.append(cmd[3:])
+        return real_popen(["cat", "tests/fixtures/iw_dev_scan_1.txt"],
+                          **kwargs)
+
+    monkeypatch.setattr(scan.subprocess, "Popen", fake_popen)
+    monkeypatch.setattr(scan.pyw, "isup", lambda _: True)
+    scan_result = scan.get_scan_result(
+        FakeCard(), timeout=5, backend=scan.SCAN_BACKEND_IW,
+        cached_max_age_s=1)
+    assert commands == [["scan", "dump"], ["scan"]]
+    assert len(scan_result) == 1
+
+
+def test_disk_cache_skips_scan(monkeypatch, tmp_path):
+    real_popen = subprocess.Popen
+    commands = []
+
+    def fake_popen(cmd, **kwargs):
+        commands.append(cmd[3:])
+        return real_popen(["cat", "tests/fixtures/iw_dev_scan_3.txt"],
+                          **kwargs)
+
+    monkeypatch.setattr(scan.subprocess, "Popen", fake_popen)
+    monkeypatch.setattr(scan.pyw, "isup", lambda _: True)
+    first = scan.get_scan_result(
+        FakeCard(), timeout=5, backend=scan.SCAN_BACKEND_IW,
+        max_scan_age_s=60, cache_dir=str(tmp_path))
+    second = scan.get_scan_result(
+        FakeCard(), timeout=5, backend=scan.SCAN_BACKEND_IW,
+        max_scan_age_s=60, cache_dir=str(tmp_path))
+    assert commands == [["scan"]]
+    assert second.freq_signal_tuples() == first.freq_signal_tuples()
+
+
+def test_partial_scan_is_not_cached(monkeypatch, tmp_path):
+    real_popen = subprocess.Popen
+    monkeypatch.setattr(
+        scan.subprocess, "Popen",
+        lambda cmd, **kwargs: real_popen(
+            ["cat", "tests/fixtures/iw_dev_scan_3.txt"], **kwargs))
+    monkeypatch.setattr(scan.pyw, "isup", lambda _: True)
+    scan_result = scan.get_scan_result(
+        FakeCard(), timeout=5, backend=scan.SCAN_BACKEND_IW,
+        stop_when=lambda sr: len(sr) >= 1, max_scan_age_s=60,
+        cache_dir=str(tmp_path))
+    assert scan_result.partial
+    assert not list(tmp_path.iterdir())
+
+
+def test_complete_scan_is_cached_if_iw_lingers(monkeypatch, tmp_path):
+    real_popen = subprocess.Popen
+    # iw has written everything and closed its output, but hasn't exited
+    monkeypatch.setattr(
+        scan.subprocess, "Popen",
+        lambda cmd, **kwargs: real_popen(
+            ["sh", "-c", "cat tests/fixtures/iw_dev_scan_3.txt; "
+             "exec >&-; sleep 0.2"], **kwargs))
+    monkeypatch.setattr(scan.pyw, "isup", lambda _: True)
+    scan_result = scan.get_scan_result(
+        FakeCard(), timeout=5, backend=scan.SCAN_BACKEND_IW,
+        max_scan_age_s=60, cache_dir=str(tmp_path))
+    assert len(scan_result) == 3
+    assert not scan_result.partial
+    assert list(tmp_path.iterdir())
+
+
+def test_timed_out_scan_is_partial(monkeypatch, tmp_path):
+    real_popen = subprocess.Popen
+    monkeypatch.setattr(
+        scan.subprocess, "Popen",
+        lambda cmd, **kwargs: real_popen(
+            ["sh", "-c", "cat tests/fixtures/iw_dev_scan_3.txt; exec sleep 5"],
+            **kwargs))
+    monkeypatch.setattr(scan.pyw, "isup", lambda _: True)
+    start = time.monotonic()
+    scan_result = scan.get_scan_result(
+        FakeCard(), timeout=0.3, backend=scan.SCAN_BACKEND_IW,
+        max_scan_age_s=60, cache_dir=str(tmp_path))
+    assert time.monotonic() - start < 2
+    assert len(scan_result) == 3
+    assert scan_result.partial
+    assert not list(tmp_path.iterdir())
+
+
+def test_cancelled_scan_kills_iw(monkeypatch, tmp_path):
+    real_popen = subprocess.Popen
+    processes = []
+
+    def fake_popen(cmd, **kwargs):
+        processes.append(real_popen(
+            ["sh", "-c", "cat tests/fixtures/iw_dev_scan_3.txt; "
+             "exec sleep 5"], **kwargs))
+        return processes[-1]
+    monkeypatch.setattr(scan.subprocess, "Popen", fake_popen)
+    monkeypatch.setattr(scan.pyw, "isup", lambda _: True)
+    cancelled = threading.Event()
+    threading.Timer(0.2, cancelled.set).start()
+    start = time.monotonic()
+    scan_result = scan.get_scan_result(
+        FakeCard(), timeout=5, backend=scan.SCAN_BACKEND_IW,
+        max_scan_age_s=60, cache_dir=str(tmp_path), cancelled=cancelled)
+    assert time.monotonic() - start < 2
+    assert len(scan_result) == 3
+    assert scan_result.partial
+    assert [process.returncode for process in processes] == [-9]
+    assert not list(tmp_path.iterdir())
+
+
+def test_rank_channels_prefers_quiet_channels():
+    scan_output = freq_signal_dict_as_scan_output({2437: -40, 2412: -90})
+    ranked = scan.rank_channels(range(1, 14), scan_output)
+    # 10 is the first channel clear of both the loud AP on 6 and the quiet
+    #  one on 1
+    assert ranked[0] == (10, 0)
+    assert scan.get_available_uncontested_channel(
+        range(1, 14), scan_output) == 10
+    # Everything is contested. 2 only partly overlaps a quiet AP on 1, and
+    #  is clear of the loud one on 6
+    scan_output = freq_signal_dict_as_scan_output(
+        {2437: -40, 2412: -90, 2462: -90, 2472: -90})
+    assert scan.get_available_uncontested_channel(
+        range(1, 14), scan_output) == scan.NO_CHANNEL
+    assert scan.get_least_contested_channel(range(1, 14), scan_output) == 2
+
+
+def test_secondary_channel_of_40mhz_neighbour_is_contested(iw_dev_scan_1):
+    # The only AP is on 1, but at 40MHz with its secondary channel on 5
+    ranked = dict(scan.rank_channels([5, 9], iw_dev_scan_1))
+    assert ranked[5] > 0
+    assert ranked[9] == 0
+    assert scan.get_available_uncontested_channel(
+        [5, 9], iw_dev_scan_1) == 9
+
+
+def test_sample_channel_stats(monkeypatch, tmp_path):
+    real_popen = subprocess.Popen
+    outputs = [
+        freq_signal_dict_as_scan_output({2412: -40}),
+        "",
+        freq_signal_dict_as_scan_output({2412: -40, 2462: -80}),
+    ]
+
+    def fake_popen(_, **kwargs):
+        return real_popen(["printf", "%s", outputs.pop(0)], **kwargs)
+
+    monkeypatch.setattr(scan.subprocess, "Popen", fake_popen)
+    monkeypatch.setattr(scan.pyw, "isup", lambda _: True)
+    stats, scan_result = scan.sample_channel_stats(
+        FakeCard(), 2, 0, cache_dir=str(tmp_path), timeout=5,
+        backend=scan.SCAN_BACKEND_IW)
+    # The empty second scan is retried, not counted
+    assert stats.samples == 2
+    assert len(scan_result) == 2
+    assert stats.presence[2462] < stats.presence[2412] == 1
+    assert scan.rank_channels([1, 11], stats)[0][0] == 11
+    assert list(tmp_path.iterdir())
+
+
+def test_5ghz_selection_avoids_dfs(regdb_lines):
+    reg_db = regdb.RegDB.from_regdbdump_output(regdb_lines)
+    band = spectrum.BAND_5GHZ
+    legal = scan.channels_for_country("US", reg_db, band)
+    dfs = scan.dfs_channels_for_country("US", reg_db, band)
+    # Every non-DFS channel hears something, but only faintly. 2.4GHz APs
+    #  don't count
+    scan_output = freq_signal_dict_as_scan_output({
+        freq: -90 for freq in (5180, 5200, 5220, 5240, 5745, 5765, 5785,
+                               5805, 5825)})
+    scan_output += freq_signal_dict_as_scan_output({2412: -30})
+    assert scan.get_available_uncontested_channel(
+        legal, scan_output, band, dfs) == scan.NO_CHANNEL
+    assert scan.get_least_contested_channel(
+        legal, scan_output, band, dfs) == 36
+    # Until they get loud enough that waiting for radar detection is
+    #  worth it
+    scan_output = freq_signal_dict_as_scan_output({
+        freq: -60 for freq in (5180, 5200, 5220, 5240, 5745, 5765, 5785,
+                               5805, 5825)})
+    assert scan.get_least_contested_channel(
+        legal, scan_output, band, dfs) == 52
+    # Without DFS preference, any clear channel is uncontested
+    assert scan.get_available_uncontested_channel(
+        legal, scan_output, band) == 52
+
+
+def test_choose_band(regdb_lines):
+    reg_db = regdb.RegDB.from_regdbdump_output(regdb_lines)
+    assert scan.choose_band(1, "US", reg_db) == spectrum.BAND_5GHZ
+    assert scan.choose_band(0, "US", reg_db) == spectrum.BAND_2GHZ
+    # No 5GHz access points without a country
+    assert scan.choose_band(1, "00", reg_db) == spectrum.BAND_2GHZ
+
+
+def test_uncontested_ht40_pair():
+    band = spectrum.BAND_2GHZ
+    centres = list(range(3, 10))
+    scan_output = freq_signal_dict_as_scan_output({2462: -60})
+    scan_result = scan.as_scan_result(scan_output)
+    pair = scan.get_uncontested_ht40_pair(centres, scan_output, scan_result)
+    assert pair == ht40.ChannelPair(1, 5)
+    assert scan.get_uncontested_ht40_pair(
+        centres, scan_output, scan_result, band,
+        flags=(ht40.HT40_MINUS,)) == ht40.ChannelPair(5, 1)
+    assert scan.get_uncontested_ht40_pair(
+        centres, scan_output, scan_result, primary=7) == \
+        ht40.ChannelPair(7, 3)
+    # 9's only legal pair is 9 and 5, and the AP on 11 overlaps 9
+    assert scan.get_uncontested_ht40_pair(
+        centres, scan_output, scan_result, primary=9) is None
+    # Anything within 25MHz of the centre (2422MHz) forbids 40MHz there
+    scan_output = freq_signal_dict_as_scan_output({2462: -60, 2447: -95})
+    assert scan.get_uncontested_ht40_pair(
+        [3], scan_output, scan.as_scan_result(scan_output)) is None
+
+
+def test_uncontested_ht40_pair_avoids_dfs():
+    band = spectrum.BAND_5GHZ
+    scan_output = freq_signal_dict_as_scan_output({5180: -60})
+    assert scan.get_uncontested_ht40_pair(
+        [38, 46, 54], scan_output, scan.as_scan_result(scan_output), band,
+        dfs_centres=[54]) == ht40.ChannelPair(44, 48)
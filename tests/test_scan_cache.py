@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from wifi_configurator import bss, scan_cache
+from wifi_configurator.scan_result import ScanResult
+
+MAC = "02:00:00:aa:bb:cc"
+
+
+def scan_result_from(iw_output):
+    return ScanResult.from_bss_records(bss.iter_bss_records(iw_output))
+
+
+def test_cache_path_is_keyed_by_interface_and_mac(tmp_path):
+    assert scan_cache.cache_path("wlan0", MAC, str(tmp_path)) == \
+        tmp_path / "scan-wlan0-020000aabbcc.bin"
+    assert scan_cache.cache_path("wlan0", "", str(tmp_path)) == \
+        tmp_path / "scan-wlan0-unknown.bin"
+
+
+def test_store_then_load(tmp_path, iw_dev_scan_0):
+    sr = scan_result_from(iw_dev_scan_0)
+    assert scan_cache.store("wlan0", MAC, sr, cache_dir=str(tmp_path),
+                            now=1000)
+    cached = scan_cache.load("wlan0", MAC, 60, str(tmp_path), now=1030)
+    assert cached.freq_signal_tuples() == sr.freq_signal_tuples()
+    # No temporary files are left behind
+    assert [p.name for p in tmp_path.iterdir()] == \
+        ["scan-wlan0-020000aabbcc.bin"]
+
+
+def test_load_honours_max_age_and_ttl(tmp_path, iw_dev_scan_0):
+    sr = scan_result_from(iw_dev_scan_0)
+    scan_cache.store("wlan0", MAC, sr, ttl_s=100, cache_dir=str(tmp_path),
+                     now=1000)
+    assert scan_cache.load("wlan0", MAC, 60, str(tmp_path), now=1061) is None
+    assert scan_cache.load("wlan0", MAC, 600, str(tmp_path), now=1099)
+    assert scan_cache.load("wlan0", MAC, 600, str(tmp_path), now=1101) is None
+    # Clock went backwards
+    assert scan_cache.load("wlan0", MAC, 600, str(tmp_path), now=900) is None
+
+
+def test_load_misses(tmp_path, iw_dev_scan_0):
+    scan_cache.store("wlan0", MAC, scan_result_from(iw_dev_scan_0),
+                     cache_dir=str(tmp_path), now=1000)
+    # A different adapter on the same interface name
+    assert scan_cache.load("wlan0", "02:00:00:dd:ee:ff", 60, str(tmp_path),
+                           now=1000) is None
+    scan_cache.cache_path("wlan0", MAC, str(tmp_path)).write_bytes(b"junk")
+    assert scan_cache.load("wlan0", MAC, 60, str(tmp_path), now=1000) is None
+
+
+def test_store_failure_is_not_fatal(tmp_path, iw_dev_scan_0):
+    blocker = tmp_path / "file"
+    blocker.write_text("")
+    assert not scan_cache.store("wlan0", MAC,
+                                scan_result_from(iw_dev_scan_0),
+                                cache_dir=str(blocker / "cache"))
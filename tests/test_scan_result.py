@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from wifi_configurator import bss
+from wifi_configurator.scan_result import ScanResult
+
+
+def scan_result_from(iw_output):
+    return ScanResult.from_bss_records(bss.iter_bss_records(iw_output))
+
+
+def test_arrays_are_typed(iw_dev_scan_0):
+    sr = scan_result_from(iw_dev_scan_0)
+    assert len(sr) == 9
+    assert sr.freqs.typecode == "H"
+    assert sr.signals.typecode == "f"
+    assert sr.country_ids.typecode == "H"
+    assert len(sr.bssids) == 9 * ScanResult.BSSID_LEN
+    assert sr.bssid(0) == "ea:d8:ab:0d:39:e8"
+    assert sr.bssid(8) == "46:23:8d:4e:f0:62"
+    assert sr.country(8) == "AL"
+    assert sr.country(0) == ""
+    # Country codes are interned, not stored per BSS
+    assert sr.countries == ["", "TR", "AL"]
+
+
+def test_max_signal_per_freq(iw_dev_scan_0):
+    assert scan_result_from(iw_dev_scan_0).max_signal_per_freq() == {
+        2412: -48.0,
+        2432: -84.0,
+        2442: -42.0,
+        2452: -88.0,
+        2462: -85.0,
+        5180: -89.0,
+    }
+
+
+def test_country_counts(iw_dev_scan_0):
+    counts = scan_result_from(iw_dev_scan_0).country_counts()
+    assert counts == {"TR": 3, "AL": 1}
+
+
+def test_aps_per_channel(iw_dev_scan_0):
+    assert scan_result_from(iw_dev_scan_0).aps_per_channel() == {
+        1: 2, 5: 1, 7: 3, 9: 1, 11: 1, 36: 1,
+    }
+
+
+def test_empty(iw_dev_scan_2):
+    sr = scan_result_from(iw_dev_scan_2)
+    assert len(sr) == 0
+    assert sr.max_signal_per_freq() == {}
+    assert not sr.country_counts()
+
+
+def test_seen_within():
+    records = [
+        bss.BSS("00:00:00:00:00:01", 2412, -40.0, "AU", "a", 100,
+                0, bss.SECONDARY_NONE, 0),
+        bss.BSS("00:00:00:00:00:02", 2437, -50.0, "", "b", 45000,
+                0, bss.SECONDARY_NONE, 0),
+        bss.BSS("00:00:00:00:00:03", 2462, -60.0, "NZ", "c", 2000,
+                0, bss.SECONDARY_NONE, 0),
+    ]
+    fresh = ScanResult.from_bss_records(records).seen_within(5000)
+    assert len(fresh) == 2
+    assert list(fresh.freqs) == [2412, 2462]
+    assert list(fresh.last_seen_ms) == [100, 2000]
+    assert fresh.bssid(1) == "00:00:00:00:00:03"
+    assert fresh.country_counts() == {"AU": 1, "NZ": 1}
+
+
+def test_bytes_round_trip(iw_dev_scan_0):
+    sr = scan_result_from(iw_dev_scan_0)
+    restored = ScanResult.from_bytes(sr.to_bytes())
+    assert restored.countries == sr.countries
+    assert restored.freq_signal_tuples() == sr.freq_signal_tuples()
+    assert restored.country_counts() == sr.country_counts()
+    assert [restored.bssid(i) for i in range(len(restored))] == \
+        [sr.bssid(i) for i in range(len(sr))]
+    assert [restored.occupied_freqs(i) for i in range(len(restored))] == \
+        [sr.occupied_freqs(i) for i in range(len(sr))]
+
+
+def test_many_countries():
+    countries = ["%c%c" % (65 + i // 26, 65 + i % 26) for i in range(300)]
+    sr = ScanResult.from_bss_records(
+        bss.BSS("00:00:00:00:01:%02x" % (i % 256,), 2412, -40.0, country,
+                "", 0, 0, bss.SECONDARY_NONE, 0)
+        for i, country in enumerate(countries))
+    assert [sr.country(i) for i in range(len(sr))] == countries
+    restored = ScanResult.from_bytes(sr.to_bytes())
+    assert restored.country(299) == countries[299]
+    assert len(restored.country_counts()) == 300
+
+
+def test_from_bytes_rejects_garbage(iw_dev_scan_0):
+    data = scan_result_from(iw_dev_scan_0).to_bytes()
+    for bad in (b"", b"XXXX" + data[4:], data[:-1], data + b"\0"):
+        with pytest.raises(ValueError):
+            ScanResult.from_bytes(bad)
+
+
+def test_power_mw_per_freq(iw_dev_scan_3):
+    power = scan_result_from(iw_dev_scan_3).power_mw_per_freq()
+    assert sorted(power) == [2412, 2442, 5180]
+    assert power[2412] == pytest.approx(10 ** -3.2, rel=1e-3)
+
+
+def test_power_mw_per_occupied_freq(iw_dev_scan_1):
+    sr = scan_result_from(iw_dev_scan_1)
+    assert list(sr.power_mw_per_freq()) == [2412]
+    power = sr.power_mw_per_occupied_freq()
+    assert sorted(power) == [2412, 2432]
+    assert power[2412] == power[2432]
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+import pytest
+
+from wifi_configurator import services
+
+
+def hostapd_plan(ready=None):
+    plan = services.ServicePlan()
+    ifdown = plan.add("ifdown", "wlan0")
+    ifup = plan.add("ifup", "wlan0", after=[ifdown])
+    plan.add("stop", "hostapd")
+    plan.add("start", "hostapd", after=[ifup], ready=ready)
+    plan.add("restart", "hostapd", after=[ifup])
+    plan.add("restart", "dnsmasq", after=[ifup])
+    plan.add("restart", "wpa_supplicant")
+    return plan
+
+
+class RecordingRunner:
+    """Records commands, which fail if they're in failing."""
+
+    def __init__(self, failing=()):
+        self.commands = []
+        self.failing = failing
+        self.lock = threading.Lock()
+
+    def __call__(self, argv):
+        with self.lock:
+            self.commands.append(argv)
+        return "exited with 1" if argv in self.failing else ""
+
+
+def test_duplicates_are_merged():
+    plan = hostapd_plan()
+    assert list(plan.actions) == [
+        ("ifdown", "wlan0"), ("ifup", "wlan0"), ("restart", "hostapd"),
+        ("restart", "dnsmasq"), ("restart", "wpa_supplicant")]
+    assert plan.actions[("restart", "hostapd")].after == \
+        {("ifup", "wlan0")}
+    plan.add("stop", "dnsmasq")
+    assert ("stop", "dnsmasq") in plan.actions
+    with pytest.raises(ValueError):
+        plan.add("reboot", "now")
+
+
+def test_waves():
+    waves = hostapd_plan().waves()
+    assert [[services.action_key(a) for a in wave] for wave in waves] == [
+        [("ifdown", "wlan0"), ("restart", "wpa_supplicant")],
+        [("ifup", "wlan0")],
+        [("restart", "hostapd"), ("restart", "dnsmasq")],
+    ]
+    # Systemd actions are batched
+    assert [argv for argv, _ in services.commands(waves[2])] == [
+        ["systemctl", "restart", "hostapd", "dnsmasq"]]
+    assert [argv for argv, _ in services.commands(waves[0])] == [
+        ["systemctl", "restart", "wpa_supplicant"], ["ifdown", "wlan0"]]
+
+
+def test_circular_dependencies():
+    plan = services.ServicePlan()
+    plan.add("ifdown", "wlan0", after=[("ifup", "wlan0")])
+    plan.add("ifup", "wlan0", after=[("ifdown", "wlan0")])
+    with pytest.raises(ValueError):
+        plan.waves()
+
+
+def test_run():
+    runner = RecordingRunner()
+    ready_at = []
+    plan = hostapd_plan(ready=lambda deadline: ready_at.append(deadline)
+                        or True)
+    results = services.run(plan, runner)
+    assert all(result.ok for result in results)
+    assert len(results) == len(plan)
+    assert len(ready_at) == 1
+    assert runner.commands.index(["ifup", "wlan0"]) < \
+        runner.commands.index(["systemctl", "restart", "hostapd",
+                               "dnsmasq"])
+
+
+def test_independent_actions_run_concurrently():
+    both_running = threading.Barrier(2, timeout=5)
+
+    def runner(argv):
+        # Deadlocks (and times out) unless both commands run at once
+        both_running.wait()
+        return ""
+    plan = services.ServicePlan()
+    plan.add("restart", "wpa_supplicant")
+    plan.add("ifdown", "wlan0")
+    assert all(result.ok for result in services.run(plan, runner))
+
+
+def test_failures_skip_dependents():
+    runner = RecordingRunner(failing=[["ifup", "wlan0"]])
+    results = {services.action_key(result.action): result
+               for result in services.run(hostapd_plan(), runner)}
+    assert not results[("ifup", "wlan0")].ok
+    assert "skipped" in results[("restart", "hostapd")].detail
+    assert results[("restart", "wpa_supplicant")].ok
+    assert ["systemctl", "restart", "hostapd", "dnsmasq"] not in \
+        runner.commands
+
+
+def test_not_ready():
+    start = time.monotonic()
+    results = services.run(hostapd_plan(ready=lambda deadline: False),
+                           RecordingRunner(), ready_timeout=0.1)
+    assert [services.action_key(result.action) for result in results
+            if not result.ok] == [("restart", "hostapd")]
+    assert time.monotonic() - start < 5
+
+
+def test_follows_orders_without_depending():
+    plan = services.ServicePlan()
+    ifdown = plan.add("ifdown", "wlan0")
+    ifup = plan.add("ifup", "wlan0", follows=[ifdown])
+    plan.add("restart", "hostapd", follows=[ifup])
+    plan.add("restart", "dnsmasq", after=[ifup], follows=[ifup])
+    assert plan.actions[("restart", "dnsmasq")].follows == frozenset()
+    assert [[services.action_key(a) for a in wave]
+            for wave in plan.waves()] == [
+        [("ifdown", "wlan0")],
+        [("ifup", "wlan0")],
+        [("restart", "hostapd"), ("restart", "dnsmasq")],
+    ]
+    runner = RecordingRunner(failing=[["ifdown", "wlan0"]])
+    results = {services.action_key(result.action): result
+               for result in services.run(plan, runner)}
+    assert not results[("ifdown", "wlan0")].ok
+    assert results[("ifup", "wlan0")].ok
+    assert results[("restart", "hostapd")].ok
+    assert runner.commands == [
+        ["ifdown", "wlan0"], ["ifup", "wlan0"],
+        ["systemctl", "restart", "hostapd", "dnsmasq"]]
+
+
+def test_follows_survives_merging():
+    plan = services.ServicePlan()
+    plan.add("stop", "hostapd")
+    plan.add("ifup", "wlan0", follows=[("stop", "hostapd")])
+    plan.add("start", "hostapd")
+    assert plan.actions[("ifup", "wlan0")].follows == \
+        {("restart", "hostapd")}
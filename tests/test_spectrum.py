@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from wifi_configurator import regdb, spectrum
+
+
+@pytest.fixture
+def reg_db(regdb_lines):
+    return regdb.RegDB.from_regdbdump_output(regdb_lines)
+
+
+def rule(start, end, max_bandwidth, *flags):
+    return regdb.Rule(start, end, max_bandwidth, 20.0, None, frozenset(flags))
+
+
+def test_band_channels():
+    assert spectrum.band_channels(spectrum.BAND_2GHZ) == tuple(range(1, 14))
+    assert spectrum.band_channels(spectrum.BAND_2GHZ, 40) == \
+        tuple(range(3, 12))
+    assert spectrum.band_channels(spectrum.BAND_2GHZ, 80) == ()
+    assert spectrum.band_channels(spectrum.BAND_5GHZ, 160) == (50, 114)
+
+
+def test_spectrum_merges_and_contains():
+    allowed = spectrum.Spectrum([(5250, 5330), (5170, 5250), (5490, 5730),
+                                 (5500, 5600)])
+    assert allowed.intervals == [(5170, 5330), (5490, 5730)]
+    assert allowed.contains(5170, 5330)
+    assert allowed.contains(5200, 5220)
+    assert not allowed.contains(5160, 5180)
+    assert not allowed.contains(5320, 5340)
+    assert not allowed.contains(5330, 5490)
+    assert not spectrum.Spectrum([]).contains(2402, 2422)
+
+
+def test_spectrum_subtract():
+    allowed = spectrum.Spectrum([(2402, 2494)]).subtract([(2474, 2494)])
+    assert allowed.intervals == [(2402, 2474)]
+    allowed = spectrum.Spectrum([(2402, 2494)]).subtract([(2430, 2440)])
+    assert allowed.intervals == [(2402, 2430), (2440, 2494)]
+
+
+def test_legal_channels_2ghz(reg_db):
+    band = spectrum.BAND_2GHZ
+    assert spectrum.legal_channels(reg_db.rules("US"), band) == \
+        list(range(1, 12))
+    # NO-OFDM spectrum (channel 14) is cut out, taking channels 12 and 13
+    #  with it
+    assert spectrum.legal_channels(reg_db.rules("JP"), band) == \
+        list(range(1, 12))
+    assert spectrum.legal_channels(reg_db.rules("US"), band, 40) == \
+        list(range(3, 10))
+    assert spectrum.legal_channels(reg_db.rules("AU"), band, 40) == \
+        list(range(3, 12))
+
+
+def test_legal_channels_5ghz(reg_db):
+    band = spectrum.BAND_5GHZ
+    assert spectrum.legal_channels(reg_db.rules("US"), band, 80) == \
+        [42, 58, 106, 122, 138, 155]
+    # 5650-5730MHz is beyond AU's 5710MHz limit
+    assert spectrum.legal_channels(reg_db.rules("AU"), band, 80) == \
+        [42, 58, 106, 122, 155]
+    # Channel 50 straddles two 80MHz AUTO-BW rules
+    assert spectrum.legal_channels(reg_db.rules("US"), band, 160) == \
+        [50, 114]
+
+
+def test_max_bandwidth_is_respected():
+    rules = [rule(5170, 5250, 20), rule(5250, 5330, 80)]
+    band = spectrum.BAND_5GHZ
+    assert spectrum.legal_channels(rules, band, 20) == \
+        [36, 40, 44, 48, 52, 56, 60, 64]
+    assert spectrum.legal_channels(rules, band, 40) == [54, 62]
+    assert spectrum.legal_channels(rules, band, 160) == []
+    rules[0] = rule(5170, 5250, 20, regdb.FLAG_AUTO_BW)
+    rules[1] = rule(5250, 5330, 80, regdb.FLAG_AUTO_BW)
+    assert spectrum.legal_channels(rules, band, 160) == [50]
+
+
+def test_overlapping_rules_give_no_duplicates():
+    rules = [rule(2402, 2482, 40), rule(2402, 2472, 40)]
+    assert spectrum.legal_channels(rules, spectrum.BAND_2GHZ) == \
+        list(range(1, 14))
+
+
+def test_no_ir_spectrum_is_excluded(reg_db):
+    # The world domain only allows passive use of 5GHz
+    assert spectrum.legal_channels(reg_db.rules("00"),
+                                   spectrum.BAND_5GHZ) == []
+    rules = [rule(5170, 5250, 80), rule(5250, 5330, 80, regdb.FLAG_NO_IR)]
+    assert spectrum.legal_channels(rules, spectrum.BAND_5GHZ) == \
+        [36, 40, 44, 48]
+
+
+def test_dfs_channels(reg_db):
+    band = spectrum.BAND_5GHZ
+    assert spectrum.dfs_channels(reg_db.rules("US"), band) == \
+        [52, 56, 60, 64] + list(range(100, 145, 4))
+    # 80MHz channels touching the edge of DFS spectrum don't need it
+    assert spectrum.dfs_channels(reg_db.rules("US"), band, 80) == \
+        [58, 106, 122, 138]
+    assert spectrum.dfs_channels(reg_db.rules("US"), band, 160) == [50, 114]
+    assert spectrum.dfs_channels(reg_db.rules("US"),
+                                 spectrum.BAND_2GHZ) == []
+
+
+def test_spectrum_overlaps():
+    allowed = spectrum.Spectrum([(5250, 5330), (5490, 5730)])
+    assert allowed.overlaps(5240, 5260)
+    assert allowed.overlaps(5330 - 1, 5500)
+    assert not allowed.overlaps(5230, 5250)
+    assert not allowed.overlaps(5330, 5490)
+    assert not allowed.overlaps(5730, 5750)
+
+
+def test_band_lookups():
+    assert spectrum.freq_band(2412) == spectrum.BAND_2GHZ
+    assert spectrum.freq_band(5180) == spectrum.BAND_5GHZ
+    assert spectrum.freq_band(5955) is None
+    assert spectrum.channel_band(11) == spectrum.BAND_2GHZ
+    assert spectrum.channel_band(149) == spectrum.BAND_5GHZ
+    assert spectrum.channel_band(14) is None
+    assert spectrum.channel_to_freq(spectrum.BAND_2GHZ, 14) == 2484
+    assert spectrum.channel_to_freq(spectrum.BAND_5GHZ, 36) == 5180
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+
+import jinja2
+import pytest
+
+from wifi_configurator import adapters, templates
+
+
+# Wall clock timings depend on the machine, so the benchmark only runs if
+#  this is set in the environment (as for test_lazy's cold start budget)
+TIMING_TESTS_ENV = "WIFI_CONFIGURATOR_TIMING_TESTS"
+BENCHMARK_RUNS = 5
+
+
+class CountingEnvironment(jinja2.Environment):
+    """An Environment that counts how many templates it compiles."""
+
+    compiled = 0
+
+    def compile(self, *args, **kwargs):
+        CountingEnvironment.compiled += 1
+        return super().compile(*args, **kwargs)
+
+
+def hostapd_params():
+    rtl8812au = adapters.get_registry().profiles["RTL8812AU"]
+    return dict(interface="wlan0", ssid="x", channel=6, country_code="US",
+                wifi_adapter=rtl8812au, wpa_passphrase="", hw_mode="g",
+                ht_capab=rtl8812au.ht_capab, ieee80211ac=False, dfs=False)
+
+
+def render_hostapd_conf(cache_dir):
+    """Render hostapd.conf as a fresh run would, returning seconds taken."""
+    templates.get_environment.cache_clear()
+    start = time.perf_counter()
+    templates.get_environment(cache_dir).get_template(
+        templates.HOSTAPD_TEMPLATE).render(**hostapd_params())
+    return time.perf_counter() - start
+
+
+def test_templates_are_cached(tmp_path):
+    templates.get_environment.cache_clear()
+    env = templates.get_environment(str(tmp_path))
+    rendered = env.get_template(templates.HOSTAPD_TEMPLATE).render(
+        **hostapd_params())
+    assert "channel=6\n" in rendered
+    assert len(list((tmp_path / templates.CACHE_SUBDIR).iterdir())) == 1
+    assert templates.precompile(str(tmp_path)) == [templates.HOSTAPD_TEMPLATE]
+
+
+def test_changed_templates_are_recompiled(tmp_path):
+    CountingEnvironment.compiled = 0
+    cache = templates.BytecodeCache(str(tmp_path))
+
+    def render(source):
+        env = CountingEnvironment(
+            loader=jinja2.DictLoader({"t": source}), bytecode_cache=cache)
+        return env.get_template("t").render(x=1)
+
+    assert render("a{{ x }}") == "a1"
+    assert render("a{{ x }}") == "a1"
+    assert CountingEnvironment.compiled == 1
+    assert render("b{{ x }}") == "b1"
+    assert CountingEnvironment.compiled == 2
+
+
+def test_unwritable_cache_still_renders(tmp_path):
+    not_a_dir = tmp_path / "file"
+    not_a_dir.write_text("")
+    assert templates.bytecode_cache(str(not_a_dir)) is None
+    cache = templates.BytecodeCache(str(not_a_dir))
+    env = jinja2.Environment(loader=jinja2.DictLoader({"t": "{{ x }}"}),
+                             bytecode_cache=cache)
+    assert env.get_template("t").render(x=1) == "1"
+
+
+@pytest.mark.skipif(not os.environ.get(TIMING_TESTS_ENV),
+                    reason="set %s to check timings" % (TIMING_TESTS_ENV,))
+def test_benchmark_cached_render(tmp_path):
+    """Compare a fresh run's render latency with and without the cache."""
+    uncached = min(render_hostapd_conf(None) for _ in range(BENCHMARK_RUNS))
+    templates.precompile(str(tmp_path))
+    cached = min(render_hostapd_conf(str(tmp_path))
+                 for _ in range(BENCHMARK_RUNS))
+    templates.get_environment.cache_clear()
+    assert cached < uncached
@@ -4,12 +4,14 @@
 """Tests for `wifi_configurator` package."""
 
 import sys
+import types
 import unittest
 from click.testing import CliRunner
 import click
+import jinja2
 import pytest
 
-from wifi_configurator import cli
+from wifi_configurator import adapters, cli, discovery, ht40, scan
 
 
 class MockCtx:  # pylint: disable=too-few-public-methods
@@ -88,3 +90,72 @@ class TestWifi_configurator(unittest.TestCase):
             cli.cb_handle_wpa_passphrase,
             ctx, "wpa_passphrase", "short"
         )
+
+    def test_hostapd_template_bands(self):
+        """Test hw_mode, VHT and DFS settings follow the band"""
+        env = jinja2.Environment(
+            loader=jinja2.PackageLoader('wifi_configurator'),
+            trim_blocks=True,
+            lstrip_blocks=True,
+        )
+        template = env.get_template('hostapd.conf.j2')
+        rtl8812au = adapters.get_registry().profiles["RTL8812AU"]
+        params = dict(interface="wlan0", ssid="x", country_code="US",
+                      wifi_adapter=rtl8812au, wpa_passphrase="")
+        rendered = template.render(
+            channel=6, hw_mode="g",
+            ht_capab=rtl8812au.ht_capab, ieee80211ac=False,
+            dfs=False, **params)
+        self.assertIn("hw_mode=g\n", rendered)
+        self.assertIn("[RX-STBC1]", rendered)
+        self.assertNotIn("ieee80211ac", rendered)
+        self.assertNotIn("ieee80211h", rendered)
+        rendered = template.render(
+            channel=52, hw_mode="a",
+            ht_capab=rtl8812au.ht_capab_5ghz, ieee80211ac=True,
+            dfs=True, **params)
+        self.assertIn("hw_mode=a\n", rendered)
+        self.assertNotIn("[RX-STBC1]", rendered)
+        self.assertIn("ieee80211ac=1\n", rendered)
+        self.assertIn("vht_oper_chwidth=0\n", rendered)
+        self.assertIn("ieee80211h=1\n", rendered)
+
+    def test_hostapd_template_ht40(self):
+        """Test a 2.4GHz HT40 pair turns on HT, so hostapd uses it"""
+        env = jinja2.Environment(
+            loader=jinja2.PackageLoader('wifi_configurator'),
+            trim_blocks=True,
+            lstrip_blocks=True,
+        )
+        template = env.get_template('hostapd.conf.j2')
+        rtl8812bu = adapters.get_registry().profiles["RTL8812BU"]
+        params = dict(interface="wlan0", ssid="x", country_code="US",
+                      wifi_adapter=rtl8812bu, wpa_passphrase="",
+                      hw_mode="g", ieee80211ac=False, dfs=False)
+        rendered = template.render(
+            channel=1,
+            ht_capab=ht40.with_ht40_flag(rtl8812bu.ht_capab,
+                                         ht40.ChannelPair(1, 5)),
+            **params)
+        self.assertIn("ieee80211n=1\n", rendered)
+        self.assertIn("[HT40+]", rendered)
+        self.assertNotIn("[HT40-]", rendered)
+        self.assertNotIn("ieee80211ac", rendered)
+        rendered = template.render(channel=1, ht_capab="", **params)
+        self.assertNotIn("ieee80211n", rendered)
+
+
+def test_timed_out_scan_keeps_country_code(monkeypatch, capsys):
+    """A scan stage that times out leaves the country code as it was"""
+    # No REGDOMAIN override in /etc/default/crda
+    monkeypatch.setattr(scan, "configobj",
+                        types.SimpleNamespace(ConfigObj=lambda _: {}))
+    found = discovery.run_stages([
+        discovery.Stage("scan", lambda cancelled: cancelled.wait(5), 0.1,
+                        (None, scan.ScanResult())),
+    ])
+    _, scan_result = found["scan"]
+    assert cli.choose_country_code(
+        scan.detect_regdomain(scan_result), "NZ") == "NZ"
+    assert "Using previous country code" in capsys.readouterr().out
+    assert cli.choose_country_code("AU", "NZ") == "AU"
@@ -1,235 +1,312 @@
 # -*- coding: utf-8 -*-
 
+"""Wifi adapter identification.
+
+Adapters and their capabilities are listed in adapters.ini, which is loaded
+once into an AdapterRegistry: a dict from each USB PRODUCT or SDIO_ID to
+the adapter's capability profile.  Identifying an adapter is then one (or,
+for wildcard versions, two) dict lookups on the ids in its uevent file.
+
+Adapters that aren't listed get the capabilities their wiphy reports over
+nl80211 (see the capabilities module), less the default profile's quirks.
+"""
+
+import functools
+import logging
 import os
+from pathlib import Path
 import configobj
-import logging
 
-class DefaultAdapter:
-    """Conservative fallback adapter used when the chipset cannot be identified.
 
-    Returned by factory() when /sys/class/net/<if>/device/uevent is absent or
-    contains a PRODUCT/SDIO_ID that does not match any known entry.  Advertises
-    only HT20 + SHORT-GI-20 so hostapd can always start, even if capabilities
-    are under-reported relative to the actual hardware.
+REGISTRY_FILE = Path(__file__).with_name("adapters.ini")
+DEFAULT_PROFILE = "default"
+PROBED_PROFILE = "probed"
+ANY_VERSION = "*"
+
+
+class Adapter:
+    """A wifi adapter's capabilities, as passed to the hostapd.conf template.
+
+    Parameters
+    ----------
+    name : str
+        The profile name, e.g. 'RTL8812BU'.
+    description : str
+    ht_capab : str
+        hostapd ht_capab.
+    ht_capab_5ghz : str
+        hostapd ht_capab when running in 5GHz.
+    vht_capab : str
+        hostapd vht_capab.
+    ac_active : int
+        1 if the adapter supports 802.11ac, and therefore 5GHz.
+    quirks : tuple of str
+        ht_capab/vht_capab flags the driver reports but hostapd can't use.
     """
-    ht_capab = "[HT20][SHORT-GI-20]"
-    vht_capab = ""
-    ac_active = 0
 
-    def __str__(self):
-        return "Default wifi adapter"
-
-
-class RTL8812BU:
-    """RTL 8812BU 802.11ac"""
-    PRODUCT_list = [
-        "bda/b812/0",
-        "bda/b82c/0",
-        "b05/1812/0",
-        "b05/B822/0"
-    ]
-    # iw list reports "Static SM Power Save" in capabilities for
-    #  this device, but hostapd is unable to start if SMPS-STATIC
-    #  is set. It's unclear why and thus we exclude it.
-    # Deliberately do not advertise 40Mhz channels even though they're
-    #  supported because we never want to use them given rapid
-    #  performance degradation under non-ideal conditions and the
-    #  difficulty of configuration across regulatory domains
-    # Note that RX-STBC1 is not available for 5GHz on this device
-    #  so we may need to remove it if we enable that band.
-    ht_capab = "[HT20][SHORT-GI-20][HT40-][HT40+][RX-STBC1][MAX-AMSDU-7935]"
-    # None of the vht_capab advertised by the hardware (iw list) are
-    #  supported (seemingly, by the driver)
-    vht_capab = ""
-    ac_active = 1
+    def __init__(self, name, description, ht_capab, ht_capab_5ghz, vht_capab,
+                 ac_active, quirks=()):
+        self.name = name
+        self.description = description
+        self.ht_capab = ht_capab
+        self.ht_capab_5ghz = ht_capab_5ghz
+        self.vht_capab = vht_capab
+        self.ac_active = ac_active
+        self.quirks = tuple(quirks)
 
-    def __str__(self):
-        return "RTL 8812bu 802.11ac wifi adapter"
-
-class RTL8812AU:
-    """RTL 8812AU 802.11ac"""
-    PRODUCT_list = [
-        "bda/8812/0",
-        "bda/881a/0",
-        "bda/b812/0"
-    ]
-    # iw list reports "Static SM Power Save" in capabilities for
-    #  this device, but hostapd is unable to start if SMPS-STATIC
-    #  is set. It's unclear why and thus we exclude it.
-    # Deliberately do not advertise 40Mhz channels even though they're
-    #  supported because we never want to use them given rapid
-    #  performance degradation under non-ideal conditions and the
-    #  difficulty of configuration across regulatory domains
-    # Note that RX-STBC1 is not available for 5GHz on this device
-    #  so we may need to remove it if we enable that band.
-    ht_capab = "[HT20][SHORT-GI-20][HT40-][HT40+][RX-STBC1][MAX-AMSDU-7935]"
-    # None of the vht_capab advertised by the hardware (iw list) are
-    #  supported (seemingly, by the driver)
-    vht_capab = ""
-    ac_active = 1
+    def __repr__(self):
+        return "<Adapter: %s>" % (self.name,)
 
     def __str__(self):
-        return "RTL 8812au 802.11ac wifi adapter"    
-
-
-class RTL8812CU:
-    """RTL 8812AU 802.11ac"""
-    PRODUCT_list = [
-        "bda/c811/0"
-    ]
-    # iw list reports "Static SM Power Save" in capabilities for
-    #  this device, but hostapd is unable to start if SMPS-STATIC
-    #  is set. It's unclear why and thus we exclude it.
-    # Deliberately do not advertise 40Mhz channels even though they're
-    #  supported because we never want to use them given rapid
-    #  performance degradation under non-ideal conditions and the
-    #  difficulty of configuration across regulatory domains
-    # Note that RX-STBC1 is not available for 5GHz on this device
-    #  so we may need to remove it if we enable that band.
-    ht_capab = "[HT20][SHORT-GI-20][HT40-][HT40+][RX-STBC1][MAX-AMSDU-7935]"
-    # None of the vht_capab advertised by the hardware (iw list) are
-    #  supported (seemingly, by the driver)
-    vht_capab = ""
-    ac_active = 1
+        return self.description
 
-    def __str__(self):
-        return "RTL 8812cu 802.11ac wifi adapter"        
 
-class Realtek5372:
-    """
-    Realtek 5372 (external USB shipped with Neo Connectbox)
-    """
-    PRODUCT_list = [
-        "148f/5372/101"
-    ]
-    # Realtek 5372 (external USB shipped with Neo Connectbox)dd
-    # Deliberately do not advertise 40Mhz channels even though they're
-    #  supported because we never want to use them given rapid
-    #  performance degradation under non-ideal conditions and the
-    #  difficulty of configuration across regulatory domains
-    ht_capab = "[HT20][GF][SHORT-GI-20][TX-STBC][RX-STBC12]"
+def normalise_product(product):
+    """Return a USB 'vendor/product/version' id in the kernel's form.
 
-    def __str__(self):
-        return "Realtek 5372 802.11n wifi adapter"
+    The kernel writes each part as lower case hex without leading zeros.
 
-class MT7601:
-    """
-    Media Teck 7601U (external USB shipped with Neo Connectbox for Client Side)
+    Raises
+    ------
+    ValueError
+        If product isn't a vendor/product/version id.
     """
-    PRODUCT_list = [
-        "148f/7601/0",
-        "148f/2878/0"
-    ]          
-    #Media Teck (external USB shipped with NEO Connectbox)
-    WirelessMode = 5
-    # Set Wireless Mode to 11ABGN mixed
-    ht_capab = "[HT20][SHORT-GI-20][HT40]"
-    vht_capab = ""
-    ac_active = 0
-    
-    def __str__(self):
-        return "Media Teck 7601U series 802.11n wifi adapter"
-        
-        
-class BCM4343x:
-    """
-    Broadcom 4343x series
+    vendor, product_id, version = product.strip().split("/")
+    if version != ANY_VERSION:
+        version = "%x" % (int(version, 16),)
+    return "%x/%x/%s" % (int(vendor, 16), int(product_id, 16), version)
+
+
+def normalise_sdio_id(sdio_id):
+    """Return an SDIO 'vendor:device' id in the kernel's form (upper case).
 
-    BCM43438 is a part of BCM2835 on RPi0w
-    BCM43438 is part of the BCM2837 on RPi3b
-    BCM43430 is a part of the AP6212 on OPi0+2
+    Raises
+    ------
+    ValueError
+        If sdio_id isn't a vendor:device id.
     """
-    SDIO_ID = "02D0:A9A6"
-    # iw list reports "Static SM Power Save" in capabilities for
-    #  this device, but hostapd is unable to start if SMPS-STATIC
-    #  is set. It's unclear why and thus we exclude it.
-    ht_capab = "[HT20][SHORT-GI-20][DDDS_CCK-40]"
-    vht_capab = ""
-    ac_active = 0
+    vendor, device = sdio_id.strip().split(":")
+    return "%04X:%04X" % (int(vendor, 16), int(device, 16))
 
-    def __str__(self):
-        return "Broadcom 4343x series 802.11n wifi adapter"
 
+class AdapterRegistry:
+    """Every known adapter profile, indexed by USB PRODUCT and SDIO_ID.
 
-class BCM43455:
+    Parameters
+    ----------
+    profiles : dict
+        {name: Adapter}, including DEFAULT_PROFILE.
+    products : dict
+        {normalised USB product id: profile name}. Ids may have ANY_VERSION
+        as their version.
+    sdio_ids : dict
+        {normalised SDIO id: profile name}.
     """
-    Broadcom 43455 series
 
-    Cypress43455 is a rebadged BCM43455 and is on RPi3b+
+    def __init__(self, profiles, products, sdio_ids):
+        self.profiles = profiles
+        self.products = products
+        self.sdio_ids = sdio_ids
+
+    def __repr__(self):
+        return "<AdapterRegistry: %d profiles, %d devices>" % (
+            len(self.profiles), len(self.products) + len(self.sdio_ids))
+
+    @classmethod
+    def from_config(cls, config):
+        """Build a registry from adapters.ini, parsed by configobj.
+
+        Raises
+        ------
+        ValueError
+            If there's no default profile, a device id is malformed or a
+            device is in more than one profile.
+        """
+        if DEFAULT_PROFILE not in config:
+            raise ValueError("No %s adapter profile" % (DEFAULT_PROFILE,))
+        default = config[DEFAULT_PROFILE]
+        profiles = {}
+        products = {}
+        sdio_ids = {}
+        for name, section in config.items():
+            ht_capab = section.get("ht_capab", default.get("ht_capab", ""))
+            profiles[name] = Adapter(
+                name,
+                section.get("description", name),
+                ht_capab,
+                section.get("ht_capab_5ghz", ht_capab),
+                section.get("vht_capab", ""),
+                int(section.get("ac_active", 0)),
+                section.as_list("quirks") if "quirks" in section else (),
+            )
+            if "products" in section:
+                _index_devices(products, normalise_product, name,
+                               section.as_list("products"))
+            if "sdio_ids" in section:
+                _index_devices(sdio_ids, normalise_sdio_id, name,
+                               section.as_list("sdio_ids"))
+        return cls(profiles, products, sdio_ids)
+
+    @classmethod
+    def from_file(cls, path=REGISTRY_FILE):
+        """Load a registry from an adapters.ini file. See from_config()."""
+        try:
+            config = configobj.ConfigObj(str(path), file_error=True)
+        except (OSError, configobj.ConfigObjError) as e:
+            raise ValueError("Unable to read %s: %s" % (path, e))
+        return cls.from_config(config)
+
+    @property
+    def default(self):
+        """The profile for adapters that can't be identified."""
+        return self.profiles[DEFAULT_PROFILE]
+
+    def lookup(self, uevent):
+        """Return the Adapter for a device's uevent.
+
+        Parameters
+        ----------
+        uevent : dict
+            The device's uevent keys and values (see read_uevent()).
+
+        Returns
+        -------
+        Adapter
+            The default profile if the device isn't known.
+        """
+        if "SDIO_ID" in uevent:
+            try:
+                sdio_id = normalise_sdio_id(uevent["SDIO_ID"])
+            except ValueError:
+                return self.default
+            name = self.sdio_ids.get(sdio_id)
+            return self.profiles[name] if name else self.default
+        try:
+            product = normalise_product(uevent.get("PRODUCT", ""))
+        except ValueError:
+            return self.default
+        name = self.products.get(product)
+        if name is None:
+            name = self.products.get(
+                product.rsplit("/", 1)[0] + "/" + ANY_VERSION)
+        return self.profiles[name] if name else self.default
+
+
+def _index_devices(index, normalise, name, device_ids):
+    """Add {normalised device id: name} to index, rejecting duplicates."""
+    for device_id in device_ids:
+        try:
+            normalised = normalise(device_id)
+        except ValueError:
+            raise ValueError("Malformed device id %r in %s" %
+                             (device_id, name))
+        if normalised in index:
+            raise ValueError("%s is in both %s and %s" % (
+                device_id, index[normalised], name))
+        index[normalised] = name
+
+
+@functools.lru_cache()
+def get_registry(path=REGISTRY_FILE):
+    """Load and cache the adapter registry."""
+    return AdapterRegistry.from_file(path)
+
+
+def read_uevent(path):
+    """Return a uevent file's KEY=value lines as a dict."""
+    uevent = {}
+    with open(path) as f:
+        for line in f:
+            key, sep, value = line.rstrip("\n").partition("=")
+            if sep:
+                uevent[key] = value
+    return uevent
+
+
+def probed_adapter(interface, quirks=(), cache_dir=None):
+    """Return an Adapter with the capabilities interface's wiphy reports.
 
-    Currently indistinguishable from BCM4343x, which is confusing given
-    this chipset is actually 802.11ac capable
-    """
+    Parameters
+    ----------
+    interface : str
+    quirks : iterable of str
+        Flags to leave out of ht_capab and vht_capab.
+    cache_dir : str, optional
+        Where capabilities are cached. Defaults to the scan cache directory.
 
-    def __str__(self):
-        return "Broadcom 43455 series 802.11ac wifi adapter"
+    Returns
+    -------
+    Adapter or None
+        None if the capabilities can't be probed.
+    """
+    from wifi_configurator import capabilities
+    kwargs = {} if cache_dir is None else {"cache_dir": cache_dir}
+    try:
+        probed = capabilities.probe(interface, **kwargs)
+    except (EnvironmentError, ValueError) as e:
+        logging.warning("Unable to probe %s capabilities: %s" %
+                        (interface, e))
+        return None
+    if not probed["ap"]:
+        logging.warning("%s doesn't report access point support" %
+                        (interface,))
+    return Adapter(
+        PROBED_PROFILE,
+        "Unrecognised wifi adapter, with capabilities probed from nl80211",
+        capabilities.without_quirks(probed["ht_capab"], quirks),
+        capabilities.without_quirks(probed["ht_capab_5ghz"], quirks),
+        capabilities.without_quirks(probed["vht_capab"], quirks),
+        probed["ac_active"],
+        quirks,
+    )
 
 
-def factory(interface):
-    """Return the adapter object that matches the WiFi chipset on the given interface.
+def factory(interface, registry=None, probe=True):
+    """Return the adapter that matches the WiFi chipset on the given interface.
 
     Reads /sys/class/net/<interface>/device/uevent, which the kernel populates
     with the USB PRODUCT string (vendor/product/version) or SDIO_ID for SDIO
-    devices.  Each known adapter class carries a PRODUCT_list or SDIO_ID class
-    attribute used for matching.
+    devices, and looks it up in the adapter registry.
 
-    The returned object exposes ht_capab, vht_capab, and ac_active attributes
-    that cli.py passes into the hostapd.conf Jinja2 template so the AP
-    advertises the correct 802.11n/ac capabilities for the actual hardware.
+    The returned Adapter exposes ht_capab, ht_capab_5ghz, vht_capab, and
+    ac_active attributes that cli.py passes into the hostapd.conf Jinja2
+    template so the AP advertises the correct 802.11n/ac capabilities for
+    the actual hardware.
 
-    Falls back to DefaultAdapter() in two cases:
-    - The uevent file does not exist (interface is not a USB/SDIO device).
-    - The PRODUCT/SDIO_ID does not match any known chipset.
+    If the PRODUCT/SDIO_ID does not match any known chipset, or there's no
+    uevent file (the interface is not a USB/SDIO device), the capabilities
+    are probed from the interface's wiphy instead.  Only if that fails too
+    does it fall back to the default profile.
 
     Parameters
     ----------
     interface : str
         Network interface name, e.g. 'wlan0' or 'wlan1'.
+    registry : AdapterRegistry, optional
+        Defaults to the one in adapters.ini.
+    probe : bool
+        Whether to probe unrecognised adapters' capabilities.
 
     Returns
     -------
-    One of: RTL8812BU, RTL8812AU, RTL8812CU, Realtek5372, MT7601,
-            BCM4343x, BCM43455, DefaultAdapter
+    Adapter
     """
+    if registry is None:
+        registry = get_registry()
     uevent_file = os.path.join(
         "/sys/class/net",
         interface,
         "device/uevent"
     )
-    if not os.path.exists(uevent_file):
-        # Be conservative... we can't be sure what's going on
-        return DefaultAdapter()
-
-    # Parse the uevent file as a key=value config (configobj handles the format).
-    config = configobj.ConfigObj(uevent_file)
-    logging.info("the config is:"+str(config)+" the uevent_file is: "+str(uevent_file))
-
-    # SDIO devices (RPi built-in BCM) identify by SDIO_ID rather than PRODUCT.
-    if config.get("SDIO_ID") == BCM4343x.SDIO_ID:
-        logging.info("we got BCM4343x")
-        return BCM4343x()
-
-    # USB adapters identify by PRODUCT in 'vendor/product/version' format.
-    if config.get("PRODUCT") == Realtek5372.PRODUCT_list:
-        logging.info("we got Realtek 5372")
-        return Realtek5372()
-
-    if config.get("PRODUCT") in RTL8812AU.PRODUCT_list:
-        logging.info("we got RTL8812au")
-        return RTL8812AU()
-
-    if config.get("PRODUCT") in RTL8812BU.PRODUCT_list:
-        logging.info("we got RTL8812bu")
-        return RTL8812BU()
-
-    if config.get("PRODUCT") in RTL8812CU.PRODUCT_list:
-        logging.info("we got RTL8812cu")
-        return RTL8812CU()
-
-    if config.get("PRODUCT") in MT7601.PRODUCT_list:
-        logging.info("we got MT7601")
-        return MT7601()
-
-    logging.info("We didn't match any device so we default")
-    # Can't identify the adapter. Let's be conservative
-    return DefaultAdapter()
+    try:
+        uevent = read_uevent(uevent_file)
+    except OSError:
+        uevent = {}
+    adapter = registry.lookup(uevent)
+    logging.info("uevent %s matched %s adapter profile" %
+                 (uevent_file, adapter.name))
+    if adapter is registry.default and probe:
+        # Be conservative if we can't be sure what's going on
+        adapter = probed_adapter(interface, registry.default.quirks) or \
+            registry.default
+    return adapter
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+
+"""Single-pass parser for 'iw dev <if> scan' output.
+
+The scan text is consumed as bytes, one line at a time, and turned into one
+BSS record per access point.  Everything downstream (country consensus,
+channel selection) works from these records so the scan output is only ever
+walked once.
+"""
+
+import collections
+
+
+# HT operation 'secondary channel offset' values, as a signed channel offset
+SECONDARY_NONE = 0
+SECONDARY_ABOVE = 1
+SECONDARY_BELOW = -1
+
+_SECONDARY_OFFSETS = {
+    b"no secondary": SECONDARY_NONE,
+    b"above": SECONDARY_ABOVE,
+    b"below": SECONDARY_BELOW,
+}
+
+# VHT operation 'channel width' values, as advertised. 20_40 defers to the
+#  HT operation element; 160 and 80P80 are deprecated encodings that some
+#  APs still use
+VHT_WIDTH_20_40 = 0
+VHT_WIDTH_80 = 1
+VHT_WIDTH_160 = 2
+VHT_WIDTH_80P80 = 3
+
+SUBCHANNEL_WIDTH_MHZ = 20
+
+BSS = collections.namedtuple("BSS", [
+    "bssid",                 # str, e.g. 'ea:d8:ab:0d:39:e8'
+    "freq",                  # int, primary channel centre frequency in MHz
+    "signal",                # float, dBm
+    "country",               # str, two-letter country code or ''
+    "ssid",                  # str
+    "last_seen_ms",          # int, ms since the BSS was last heard
+    "ht_primary_channel",    # int, 0 if no HT operation element
+    "ht_secondary_offset",   # one of the SECONDARY_* constants
+    "ht_sta_channel_width",  # int, 20 or 40 (MHz), 0 if no HT operation
+    "vht_channel_width",     # one of the VHT_WIDTH_* constants
+    "vht_center_seg1",       # int, channel number, 0 if none
+    "vht_center_seg2",       # int, channel number, 0 if none
+])
+# No VHT operation element unless a parser says otherwise
+BSS.__new__.__defaults__ = (VHT_WIDTH_20_40, 0, 0)
+
+
+def _value(line):
+    """Return the stripped text after the first ':' in a bytes line."""
+    return line.split(b":", 1)[1].strip()
+
+
+def _last_seen_ms(value):
+    """Return the age in a 'last seen:' value, or None if it isn't one.
+
+    'last seen: 4 ms ago' is the age. Newer iw also prints when the BSS was
+    last seen as a time since boot, e.g. 'last seen: 503.776s [boottime]',
+    which isn't an age and is ignored, as is anything else.
+    """
+    words = value.split()
+    if len(words) == 3 and words[1:] == [b"ms", b"ago"]:
+        try:
+            return int(words[0])
+        except ValueError:
+            pass
+    return None
+
+
+class BSSParser:
+    """Incremental, line-oriented parser for 'iw dev scan' output.
+
+    Feed it raw (bytes) lines with feed_line().  Whenever a line starts a new
+    BSS block, the record for the previous block is returned; otherwise
+    feed_line() returns None.  Call close() at the end of the input to
+    collect the final record.
+
+    Only the fields we use are decoded, so the bulk of the scan text (rates,
+    RSN, WMM etc) is never turned into str objects.
+    """
+
+    def __init__(self):
+        self._fields = None
+
+    def _new_block(self, line):
+        # e.g. 'BSS ea:d8:ab:0d:39:e8(on wlan0)' or '... -- associated'
+        bssid = line[4:].split(b"(", 1)[0].strip()
+        self._fields = {
+            "bssid": bssid.decode("ascii", "replace"),
+            "freq": 0,
+            "signal": 0.0,
+            "country": "",
+            "ssid": "",
+            "last_seen_ms": 0,
+            "ht_primary_channel": 0,
+            "ht_secondary_offset": SECONDARY_NONE,
+            "ht_sta_channel_width": 0,
+            "vht_channel_width": VHT_WIDTH_20_40,
+            "vht_center_seg1": 0,
+            "vht_center_seg2": 0,
+        }
+
+    def _finish_block(self):
+        if self._fields is None:
+            return None
+        record = BSS(**self._fields)
+        self._fields = None
+        return record
+
+    def feed_line(self, line):
+        """Consume one line of scan output.
+
+        Parameters
+        ----------
+        line : bytes
+            A single line, with or without its trailing newline.
+
+        Returns
+        -------
+        BSS or None
+            The completed record of the previous block when line starts a new
+            BSS block, otherwise None.
+        """
+        # BSS headers are the only unindented lines. Indented lines such as
+        #  'BSS Load:' must not be mistaken for the start of a new block.
+        if line.startswith(b"BSS"):
+            record = self._finish_block()
+            self._new_block(line)
+            return record
+
+        fields = self._fields
+        if fields is None:
+            return None
+
+        line = line.strip()
+        if line.startswith(b"freq:"):
+            # Older iw prints 'freq: 2412', newer prints 'freq: 2412.0'
+            fields["freq"] = int(float(_value(line)))
+        elif line.startswith(b"signal:"):
+            # signal: -48.00 dBm
+            fields["signal"] = float(_value(line).split()[0])
+        elif line.startswith(b"last seen:"):
+            last_seen_ms = _last_seen_ms(_value(line))
+            if last_seen_ms is not None:
+                fields["last_seen_ms"] = last_seen_ms
+        elif line.startswith(b"SSID:"):
+            fields["ssid"] = _value(line).decode("utf-8", "replace")
+        elif line.startswith(b"Country:"):
+            # Country: TR     Environment: Indoor/Outdoor
+            country_fields = line.split()
+            if len(country_fields) > 1:
+                fields["country"] = country_fields[1].decode("ascii", "replace")
+        elif line.startswith(b"* primary channel:"):
+            fields["ht_primary_channel"] = int(_value(line))
+        elif line.startswith(b"* secondary channel offset:"):
+            fields["ht_secondary_offset"] = _SECONDARY_OFFSETS.get(
+                _value(line), SECONDARY_NONE)
+        elif line.startswith(b"* STA channel width:"):
+            # '20 MHz' or 'any' (i.e. the BSS may use 40MHz)
+            fields["ht_sta_channel_width"] = \
+                20 if _value(line).startswith(b"20") else 40
+        elif line.startswith(b"* channel width:"):
+            # VHT operation, e.g. 'channel width: 1 (80 MHz)'
+            fields["vht_channel_width"] = int(_value(line).split()[0])
+        elif line.startswith(b"* center freq segment 1:"):
+            fields["vht_center_seg1"] = int(_value(line))
+        elif line.startswith(b"* center freq segment 2:"):
+            fields["vht_center_seg2"] = int(_value(line))
+        return None
+
+    def close(self):
+        """Return the record for the final BSS block, if there is one."""
+        return self._finish_block()
+
+
+def iter_bss_records(iw_output):
+    """Yield a BSS record for each block in 'iw dev scan' output.
+
+    Parameters
+    ----------
+    iw_output : bytes or str
+        Raw stdout from 'iw dev <if> scan'.  str is accepted for convenience
+        and encoded once before parsing.
+
+    Yields
+    ------
+    BSS
+    """
+    if isinstance(iw_output, str):
+        iw_output = iw_output.encode("utf-8")
+    parser = BSSParser()
+    for line in iw_output.splitlines():
+        record = parser.feed_line(line)
+        if record is not None:
+            yield record
+    record = parser.close()
+    if record is not None:
+        yield record
+
+
+def parse_bss_records(iw_output):
+    """Return a list of BSS records parsed from 'iw dev scan' output.
+
+    Parameters
+    ----------
+    iw_output : bytes or str
+        Raw stdout from 'iw dev <if> scan'.
+
+    Returns
+    -------
+    list of BSS
+    """
+    return list(iter_bss_records(iw_output))
+
+
+def _channel_to_freq(channel, freq):
+    """Return the centre frequency of a channel number in freq's band."""
+    if freq < 5000:
+        return 2407 + 5 * channel if channel < 14 else 2484
+    return 5000 + 5 * channel
+
+
+def _subchannel_freqs(center_freq, width_mhz):
+    """Return the 20MHz subchannel centres of a width_mhz wide channel."""
+    first = center_freq - width_mhz // 2 + SUBCHANNEL_WIDTH_MHZ // 2
+    return tuple(range(first, first + width_mhz, SUBCHANNEL_WIDTH_MHZ))
+
+
+def occupied_freqs(freq, ht_secondary_offset=SECONDARY_NONE,
+                   ht_sta_channel_width=0, vht_channel_width=VHT_WIDTH_20_40,
+                   vht_center_seg1=0, vht_center_seg2=0):
+    """Return the centres of every 20MHz subchannel a BSS may transmit on.
+
+    A BSS advertising 40MHz (HT operation) or 80/160MHz (VHT operation)
+    occupies, and interferes with, more than its primary channel.  The
+    arguments are the corresponding BSS record fields.
+
+    Returns
+    -------
+    tuple of int
+        Subchannel centre frequencies in MHz, primary channel included.
+        Just (freq,) for 20MHz BSSes, or () if freq is unknown.
+    """
+    if not freq:
+        return ()
+    if vht_center_seg1 and vht_channel_width != VHT_WIDTH_20_40:
+        seg1 = _channel_to_freq(vht_center_seg1, freq)
+        seg2 = _channel_to_freq(vht_center_seg2, freq) \
+            if vht_center_seg2 else 0
+        if vht_channel_width == VHT_WIDTH_160:
+            return _subchannel_freqs(seg1, 160)
+        if vht_channel_width == VHT_WIDTH_80P80 and seg2:
+            return _subchannel_freqs(seg1, 80) + _subchannel_freqs(seg2, 80)
+        if seg2 and abs(seg2 - seg1) == 40:
+            # 160MHz: segment 2 is the centre of the whole channel
+            return _subchannel_freqs(seg2, 160)
+        if seg2 and abs(seg2 - seg1) > 80:
+            return _subchannel_freqs(seg1, 80) + _subchannel_freqs(seg2, 80)
+        return _subchannel_freqs(seg1, 80)
+    if ht_secondary_offset != SECONDARY_NONE and ht_sta_channel_width == 40:
+        secondary = freq + ht_secondary_offset * SUBCHANNEL_WIDTH_MHZ
+        return (min(freq, secondary), max(freq, secondary))
+    return (freq,)
+
+
+def record_occupied_freqs(record):
+    """occupied_freqs() for a BSS record."""
+    return occupied_freqs(record.freq, record.ht_secondary_offset,
+                          record.ht_sta_channel_width,
+                          record.vht_channel_width, record.vht_center_seg1,
+                          record.vht_center_seg2)
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+"""hostapd ht_capab/vht_capab derived from what the wiphy reports.
+
+Adapters that aren't in adapters.ini used to get only the conservative
+default profile.  Instead, the HT and VHT capabilities info fields that
+nl80211 reports for each band (as 'iw phy info' shows) are translated into
+the corresponding hostapd flags.  Some drivers report capabilities that
+hostapd then can't use (e.g. SMPS-STATIC), so a profile's quirks are
+removed from the result.
+
+Probing takes a netlink round trip, so results are cached per phy MAC
+address, alongside the scan cache, until the kernel changes.
+"""
+
+import json
+import os
+from pathlib import Path
+import pyric.net.wireless.nl80211_h as nl80211h
+from wifi_configurator import nl80211
+from wifi_configurator import scan_cache
+
+
+CACHE_FILENAME = "phy-capabilities.json"
+_VERSION = 1
+
+# HT capabilities info field (802.11n 7.3.2.56.2)
+HT_CAP_LDPC = 0x0001
+HT_CAP_SUP_WIDTH_20_40 = 0x0002
+HT_CAP_SM_PS = 0x000c
+HT_CAP_SM_PS_SHIFT = 2
+HT_CAP_GRN_FLD = 0x0010
+HT_CAP_SGI_20 = 0x0020
+HT_CAP_SGI_40 = 0x0040
+HT_CAP_TX_STBC = 0x0080
+HT_CAP_RX_STBC = 0x0300
+HT_CAP_RX_STBC_SHIFT = 8
+HT_CAP_DELAY_BA = 0x0400
+HT_CAP_MAX_AMSDU = 0x0800
+HT_CAP_DSSSCCK40 = 0x1000
+HT_CAP_40MHZ_INTOLERANT = 0x4000
+HT_CAP_LSIG_TXOP_PROT = 0x8000
+
+# Single bit HT capabilities and their hostapd flags, in hostapd's order
+_HT_FLAGS = (
+    (HT_CAP_LDPC, "[LDPC]"),
+    (HT_CAP_SUP_WIDTH_20_40, "[HT40-][HT40+]"),
+    (HT_CAP_GRN_FLD, "[GF]"),
+    (HT_CAP_SGI_20, "[SHORT-GI-20]"),
+    (HT_CAP_SGI_40, "[SHORT-GI-40]"),
+    (HT_CAP_TX_STBC, "[TX-STBC]"),
+    (HT_CAP_DELAY_BA, "[DELAYED-BA]"),
+    (HT_CAP_MAX_AMSDU, "[MAX-AMSDU-7935]"),
+    (HT_CAP_DSSSCCK40, "[DSSS_CCK-40]"),
+    (HT_CAP_40MHZ_INTOLERANT, "[40-INTOLERANT]"),
+    (HT_CAP_LSIG_TXOP_PROT, "[LSIG-TXOP-PROT]"),
+)
+_HT_SM_PS_FLAGS = {0: "[SMPS-STATIC]", 1: "[SMPS-DYNAMIC]"}
+_HT_RX_STBC_FLAGS = {1: "[RX-STBC1]", 2: "[RX-STBC12]", 3: "[RX-STBC123]"}
+
+# VHT capabilities info field (802.11ac 8.4.2.160.2)
+VHT_CAP_MAX_MPDU = 0x00000003
+VHT_CAP_SUPP_CHAN_WIDTH = 0x0000000c
+VHT_CAP_SUPP_CHAN_WIDTH_SHIFT = 2
+VHT_CAP_RXLDPC = 0x00000010
+VHT_CAP_SGI_80 = 0x00000020
+VHT_CAP_SGI_160 = 0x00000040
+VHT_CAP_TXSTBC = 0x00000080
+VHT_CAP_RXSTBC = 0x00000700
+VHT_CAP_RXSTBC_SHIFT = 8
+VHT_CAP_SU_BEAMFORMER = 0x00000800
+VHT_CAP_SU_BEAMFORMEE = 0x00001000
+VHT_CAP_BEAMFORMEE_STS = 0x0000e000
+VHT_CAP_BEAMFORMEE_STS_SHIFT = 13
+VHT_CAP_SOUNDING_DIMENSION = 0x00070000
+VHT_CAP_SOUNDING_DIMENSION_SHIFT = 16
+VHT_CAP_MU_BEAMFORMER = 0x00080000
+VHT_CAP_MU_BEAMFORMEE = 0x00100000
+VHT_CAP_TXOP_PS = 0x00200000
+VHT_CAP_HTC_VHT = 0x00400000
+VHT_CAP_MAX_AMPDU_LEN_EXP = 0x03800000
+VHT_CAP_MAX_AMPDU_LEN_EXP_SHIFT = 23
+VHT_CAP_LINK_ADAPT = 0x0c000000
+VHT_CAP_LINK_ADAPT_SHIFT = 26
+VHT_CAP_RX_ANTENNA_PATTERN = 0x10000000
+VHT_CAP_TX_ANTENNA_PATTERN = 0x20000000
+
+_VHT_MAX_MPDU_FLAGS = {1: "[MAX-MPDU-7991]", 2: "[MAX-MPDU-11454]"}
+_VHT_CHAN_WIDTH_FLAGS = {1: "[VHT160]", 2: "[VHT160-80PLUS80]"}
+_VHT_FLAGS = (
+    (VHT_CAP_RXLDPC, "[RXLDPC]"),
+    (VHT_CAP_SGI_80, "[SHORT-GI-80]"),
+    (VHT_CAP_SGI_160, "[SHORT-GI-160]"),
+    (VHT_CAP_TXSTBC, "[TX-STBC-2BY1]"),
+    (VHT_CAP_SU_BEAMFORMER, "[SU-BEAMFORMER]"),
+    (VHT_CAP_SU_BEAMFORMEE, "[SU-BEAMFORMEE]"),
+    (VHT_CAP_MU_BEAMFORMER, "[MU-BEAMFORMER]"),
+    (VHT_CAP_MU_BEAMFORMEE, "[MU-BEAMFORMEE]"),
+    (VHT_CAP_TXOP_PS, "[VHT-TXOP-PS]"),
+    (VHT_CAP_HTC_VHT, "[HTC-VHT]"),
+    (VHT_CAP_RX_ANTENNA_PATTERN, "[RX-ANTENNA-PATTERN]"),
+    (VHT_CAP_TX_ANTENNA_PATTERN, "[TX-ANTENNA-PATTERN]"),
+)
+_VHT_RXSTBC_FLAGS = {1: "[RX-STBC-1]", 2: "[RX-STBC-12]", 3: "[RX-STBC-123]",
+                     4: "[RX-STBC-1234]"}
+_VHT_LINK_ADAPT_FLAGS = {2: "[VHT-LINK-ADAPT2]", 3: "[VHT-LINK-ADAPT3]"}
+
+
+def _field(capa, mask, shift):
+    return (capa & mask) >> shift
+
+
+def ht_capab(ht_capa):
+    """Return the hostapd ht_capab for an HT capabilities info field.
+
+    Parameters
+    ----------
+    ht_capa : int or None
+        None if the band doesn't support HT, which gives ''.
+    """
+    if ht_capa is None:
+        return ""
+    flags = [flag for bit, flag in _HT_FLAGS if ht_capa & bit]
+    flags.append(_HT_SM_PS_FLAGS.get(
+        _field(ht_capa, HT_CAP_SM_PS, HT_CAP_SM_PS_SHIFT), ""))
+    flags.append(_HT_RX_STBC_FLAGS.get(
+        _field(ht_capa, HT_CAP_RX_STBC, HT_CAP_RX_STBC_SHIFT), ""))
+    return "".join(flags)
+
+
+def vht_capab(vht_capa):
+    """Return the hostapd vht_capab for a VHT capabilities info field.
+
+    Parameters
+    ----------
+    vht_capa : int or None
+        None if the band doesn't support VHT, which gives ''.
+    """
+    if vht_capa is None:
+        return ""
+    flags = [
+        _VHT_MAX_MPDU_FLAGS.get(vht_capa & VHT_CAP_MAX_MPDU, ""),
+        _VHT_CHAN_WIDTH_FLAGS.get(_field(
+            vht_capa, VHT_CAP_SUPP_CHAN_WIDTH,
+            VHT_CAP_SUPP_CHAN_WIDTH_SHIFT), ""),
+    ]
+    flags.extend(flag for bit, flag in _VHT_FLAGS if vht_capa & bit)
+    flags.append(_VHT_RXSTBC_FLAGS.get(
+        _field(vht_capa, VHT_CAP_RXSTBC, VHT_CAP_RXSTBC_SHIFT), ""))
+    if vht_capa & VHT_CAP_SU_BEAMFORMEE:
+        flags.append("[BF-ANTENNA-%d]" % (_field(
+            vht_capa, VHT_CAP_BEAMFORMEE_STS,
+            VHT_CAP_BEAMFORMEE_STS_SHIFT) + 1,))
+    if vht_capa & VHT_CAP_SU_BEAMFORMER:
+        flags.append("[SOUNDING-DIMENSION-%d]" % (_field(
+            vht_capa, VHT_CAP_SOUNDING_DIMENSION,
+            VHT_CAP_SOUNDING_DIMENSION_SHIFT) + 1,))
+    flags.append("[MAX-A-MPDU-LEN-EXP%d]" % (_field(
+        vht_capa, VHT_CAP_MAX_AMPDU_LEN_EXP,
+        VHT_CAP_MAX_AMPDU_LEN_EXP_SHIFT),))
+    flags.append(_VHT_LINK_ADAPT_FLAGS.get(_field(
+        vht_capa, VHT_CAP_LINK_ADAPT, VHT_CAP_LINK_ADAPT_SHIFT), ""))
+    return "".join(flags)
+
+
+def without_quirks(capab, quirks):
+    """Return a ht_capab/vht_capab string without the flags in quirks."""
+    for flag in quirks:
+        capab = capab.replace(flag, "")
+    return capab
+
+
+def wiphy_capabilities(wiphy):
+    """Return the hostapd capabilities of a wiphy, before quirks.
+
+    Parameters
+    ----------
+    wiphy : nl80211.Wiphy
+
+    Returns
+    -------
+    dict
+        ht_capab (2.4GHz, or 5GHz for 5GHz only radios), ht_capab_5ghz,
+        vht_capab (5GHz), ac_active (1 if VHT is supported in 5GHz) and ap
+        (whether the radio supports access point mode).
+    """
+    band_2ghz = wiphy.bands.get(nl80211h.NL80211_BAND_2GHZ)
+    band_5ghz = wiphy.bands.get(nl80211h.NL80211_BAND_5GHZ)
+    ht_capab_5ghz = ht_capab(band_5ghz.ht_capa) if band_5ghz else ""
+    vht_capa = band_5ghz.vht_capa if band_5ghz else None
+    return {
+        "ht_capab": ht_capab(band_2ghz.ht_capa) if band_2ghz
+                    else ht_capab_5ghz,
+        "ht_capab_5ghz": ht_capab_5ghz,
+        "vht_capab": vht_capab(vht_capa),
+        "ac_active": int(vht_capa is not None),
+        "ap": nl80211h.NL80211_IFTYPE_AP in wiphy.iftypes,
+    }
+
+
+def phy_sysfs(interface):
+    """Return the sysfs directory of interface's wiphy."""
+    return Path("/sys/class/net", interface, "phy80211")
+
+
+def cache_path(cache_dir=scan_cache.CACHE_DIR):
+    """Return the path of the persisted capabilities."""
+    return Path(cache_dir, CACHE_FILENAME)
+
+
+def _load_cache(cache_dir):
+    try:
+        cache = json.loads(cache_path(cache_dir).read_text())
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict) or cache.get("version") != _VERSION or \
+            cache.get("kernel") != os.uname().release:
+        # A new kernel may have new drivers
+        return {}
+    return cache.get("phys", {})
+
+
+def probe(interface, cache_dir=scan_cache.CACHE_DIR):
+    """Return the hostapd capabilities of interface's wiphy.
+
+    Parameters
+    ----------
+    interface : str
+        Network interface name, e.g. 'wlan0'.
+    cache_dir : str
+        Directory holding the per-phy cache.
+
+    Returns
+    -------
+    dict
+        See wiphy_capabilities().
+
+    Raises
+    ------
+    EnvironmentError
+        If interface isn't a wifi interface, or nl80211 can't be queried.
+    """
+    sysfs = phy_sysfs(interface)
+    mac = (sysfs / "macaddress").read_text().strip().lower()
+    cache = _load_cache(cache_dir)
+    if mac in cache:
+        return cache[mac]
+    capabilities = wiphy_capabilities(
+        nl80211.get_wiphy(int((sysfs / "index").read_text())))
+    cache[mac] = capabilities
+    scan_cache.write_atomically(cache_path(cache_dir), json.dumps({
+        "version": _VERSION,
+        "kernel": os.uname().release,
+        "phys": cache,
+    }).encode("utf-8"))
+    return capabilities
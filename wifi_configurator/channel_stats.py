@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+"""Per-channel statistics aggregated over many scans.
+
+A single scan is noisy: APs are missed, and signal strengths swing by 10dB
+or more between scans.  ChannelStats keeps an exponentially weighted moving
+average (EWMA) of what was heard on each 20MHz subchannel frequency:
+
+- max_signal: the strongest signal (dBm), averaged over the scans in which
+  the frequency was occupied
+- ap_count: number of BSSes occupying it
+- presence: the fraction of scans in which it was occupied
+- power_mw: received power (mW), which is what channel selection uses
+
+Frequencies whose presence decays below PRESENCE_MIN are forgotten, so an AP
+that's gone away stops counting against its channel.  Stats are persisted
+next to the scan cache so later runs can build on earlier ones.
+"""
+
+import json
+from pathlib import Path
+import time
+from wifi_configurator import scan_cache
+
+
+DEFAULT_ALPHA = 0.3
+PRESENCE_MIN = 0.05
+# Stats not updated for this long describe a different RF environment
+STATS_MAX_AGE_S = 3600
+
+_VERSION = 1
+
+
+class ChannelStats:
+    """EWMA statistics per occupied frequency.
+
+    Parameters
+    ----------
+    alpha : float
+        Weight (0 to 1) given to each new scan. Higher reacts faster, lower
+        is steadier.
+    """
+
+    def __init__(self, alpha=DEFAULT_ALPHA):
+        self.alpha = alpha
+        self.samples = 0
+        self.updated_at = 0.0
+        self.max_signal = {}
+        self.ap_count = {}
+        self.presence = {}
+        self.power_mw = {}
+
+    def __repr__(self):
+        return "<ChannelStats: %d samples, %d frequencies>" % (
+            self.samples, len(self.presence))
+
+    def _ewma(self, averages, freq, value, initial):
+        """Fold value into averages[freq], starting from initial if unset."""
+        previous = averages.get(freq, initial)
+        averages[freq] = previous + self.alpha * (value - previous)
+
+    def update(self, scan_result, now=None):
+        """Fold one scan into the statistics.
+
+        Parameters
+        ----------
+        scan_result : ScanResult
+            An empty scan is ignored rather than counted as silence, as it
+            almost always means the scan failed.
+        now : float, optional
+            Current time.time(); for testing.
+        """
+        if not len(scan_result):
+            return
+        max_signal = {}
+        ap_count = {}
+        power_mw = {}
+        for index, signal in enumerate(scan_result.signals):
+            if not signal:
+                continue
+            for freq in scan_result.occupied_freqs(index):
+                if signal > max_signal.get(freq, float("-inf")):
+                    max_signal[freq] = signal
+                ap_count[freq] = ap_count.get(freq, 0) + 1
+                power_mw[freq] = power_mw.get(freq, 0.0) + 10 ** (signal / 10)
+
+        first = not self.samples
+        for freq in set(self.presence) | set(power_mw):
+            # The first scan seeds the averages. After that, a frequency
+            #  heard for the first time was absent from every earlier scan
+            present = 1.0 if freq in power_mw else 0.0
+            self._ewma(self.presence, freq, present, present if first else 0)
+            count = ap_count.get(freq, 0)
+            self._ewma(self.ap_count, freq, count, count if first else 0)
+            power = power_mw.get(freq, 0.0)
+            self._ewma(self.power_mw, freq, power, power if first else 0)
+            # Only averaged over the scans in which the frequency was heard
+            if freq in max_signal:
+                self._ewma(self.max_signal, freq, max_signal[freq],
+                           max_signal[freq])
+            if self.presence[freq] < PRESENCE_MIN:
+                for averages in (self.presence, self.ap_count, self.power_mw,
+                                 self.max_signal):
+                    averages.pop(freq, None)
+        self.samples += 1
+        self.updated_at = time.time() if now is None else now
+
+    def power_mw_per_occupied_freq(self):
+        """Return {freq_MHz: average received power in mW}.
+
+        The counterpart of ScanResult.power_mw_per_occupied_freq(), so
+        channel selection can rank channels from either.
+        """
+        return dict(self.power_mw)
+
+    def to_dict(self):
+        """Return the statistics as a JSON-serialisable dict."""
+        return {
+            "version": _VERSION,
+            "alpha": self.alpha,
+            "samples": self.samples,
+            "updated_at": self.updated_at,
+            "freqs": {
+                str(freq): [self.presence[freq], self.ap_count[freq],
+                            self.power_mw[freq],
+                            self.max_signal.get(freq)]
+                for freq in self.presence
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, stats_dict):
+        """Inverse of to_dict(). Raises ValueError if stats_dict is invalid."""
+        try:
+            if stats_dict["version"] != _VERSION:
+                raise ValueError("Not version %d channel stats" % (_VERSION,))
+            stats = cls(float(stats_dict["alpha"]))
+            stats.samples = int(stats_dict["samples"])
+            stats.updated_at = float(stats_dict["updated_at"])
+            for freq, values in stats_dict["freqs"].items():
+                presence, ap_count, power_mw, max_signal = values
+                freq = int(freq)
+                stats.presence[freq] = float(presence)
+                stats.ap_count[freq] = float(ap_count)
+                stats.power_mw[freq] = float(power_mw)
+                if max_signal is not None:
+                    stats.max_signal[freq] = float(max_signal)
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError("Invalid channel stats: %s" % (e,))
+        return stats
+
+
+def stats_path(dev, mac, cache_dir=scan_cache.CACHE_DIR):
+    """Return the stats file path for interface dev with the given MAC."""
+    return Path(cache_dir, "channel-stats-%s-%s.json" % (
+        dev, mac.replace(":", "").lower() or "unknown"))
+
+
+def load(dev, mac, max_age_s=STATS_MAX_AGE_S, cache_dir=scan_cache.CACHE_DIR,
+         now=None):
+    """Return the persisted ChannelStats for dev/mac if they're recent.
+
+    Returns
+    -------
+    ChannelStats or None
+        None if there are no stats, they're older than max_age_s or they
+        can't be read.
+    """
+    try:
+        stats = ChannelStats.from_dict(
+            json.loads(stats_path(dev, mac, cache_dir).read_text()))
+    except (OSError, ValueError):
+        return None
+    age = (time.time() if now is None else now) - stats.updated_at
+    if not 0 <= age <= max_age_s:
+        return None
+    return stats
+
+
+def save(dev, mac, stats, cache_dir=scan_cache.CACHE_DIR):
+    """Atomically persist stats for dev/mac. Returns whether it worked."""
+    return scan_cache.write_atomically(
+        stats_path(dev, mac, cache_dir),
+        json.dumps(stats.to_dict()).encode("utf-8"))
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+"""Precomputed table of the legal channels in every country.
+
+Legal channels only change when the regulatory database does, so rather
+than working them out from a country's rules on every run, they're worked
+out for every country at once and stored on disk, keyed by a hash of the
+database file.  Each country's entry is one bitmask per (band, channel
+width) plan: bit i is set if the i'th of spectrum.band_channels(band,
+width) is legal.  A second bitmask per plan marks the DFS channels.
+
+Serialised form (native byte order; the table never leaves the machine):
+
+- header: magic, version, regdb SHA-256, number of plans and countries
+- each plan: band name (8 bytes) and channel width in MHz
+- each country: alpha2 followed by a 64 bit legal channel mask per plan,
+  then a 64 bit DFS channel mask per plan
+"""
+
+import hashlib
+import struct
+from pathlib import Path
+from wifi_configurator import scan_cache
+from wifi_configurator import spectrum
+
+
+TABLE_FILENAME = "channel-table.bin"
+
+_MAGIC = b"WCCT"
+_VERSION = 3
+_HEADER = struct.Struct("=4sB32sHH")
+_PLAN = struct.Struct("=8sH")
+_MASK = struct.Struct("=Q")
+
+
+def content_hash(path):
+    """Return the SHA-256 digest of the file at path."""
+    return hashlib.sha256(Path(path).read_bytes()).digest()
+
+
+class ChannelTable:
+    """Legal channels per country, as bitmasks per (band, width) plan.
+
+    Parameters
+    ----------
+    digest : bytes
+        SHA-256 of the regulatory database the table was computed from.
+    plans : list of (str, int)
+        (band, channel width MHz) for each mask, in order.
+    masks : dict
+        {alpha2: tuple of int}, one legal channel bitmask per plan.
+    dfs_masks : dict
+        {alpha2: tuple of int}, one DFS channel bitmask per plan.
+    """
+
+    def __init__(self, digest, plans, masks, dfs_masks):
+        self.digest = digest
+        self.plans = list(plans)
+        self.masks = masks
+        self.dfs_masks = dfs_masks
+        self._plan_index = {plan: index for index, plan in enumerate(plans)}
+
+    def __repr__(self):
+        return "<ChannelTable: %d countries, %d plans>" % (
+            len(self.masks), len(self.plans))
+
+    @classmethod
+    def from_channel_lists(cls, digest, plans, channel_lists, dfs_lists):
+        """Build a table from {alpha2: [list of channels per plan]}.
+
+        channel_lists has the legal channels and dfs_lists the DFS ones.
+        """
+        def to_masks(lists):
+            return {
+                alpha2: tuple(
+                    encode_mask(band, width, plan_channel_list)
+                    for (band, width), plan_channel_list in zip(
+                        plans, plan_channels)
+                )
+                for alpha2, plan_channels in lists.items()
+            }
+        return cls(digest, plans, to_masks(channel_lists),
+                   to_masks(dfs_lists))
+
+    def channels(self, alpha2, band=spectrum.BAND_2GHZ, width=20):
+        """Return the legal channels for alpha2 in band at width MHz.
+
+        Returns
+        -------
+        list of int
+            Empty if the country isn't in the table.
+
+        Raises
+        ------
+        KeyError
+            If the table doesn't cover (band, width).
+        """
+        return self._decode(self.masks, alpha2, band, width)
+
+    def dfs_channels(self, alpha2, band=spectrum.BAND_5GHZ, width=20):
+        """Return alpha2's channels in band at width MHz that need DFS.
+
+        Raises KeyError like channels().
+        """
+        return self._decode(self.dfs_masks, alpha2, band, width)
+
+    def _decode(self, masks, alpha2, band, width):
+        plan = self._plan_index[(band, width)]
+        country_masks = masks.get(alpha2)
+        if country_masks is None:
+            return []
+        return decode_mask(band, width, country_masks[plan])
+
+    def to_bytes(self):
+        """Serialise to a compact bytes form that from_bytes() can read."""
+        parts = [_HEADER.pack(_MAGIC, _VERSION, self.digest, len(self.plans),
+                              len(self.masks))]
+        for band, width in self.plans:
+            parts.append(_PLAN.pack(band.encode("ascii"), width))
+        for alpha2, country_masks in self.masks.items():
+            parts.append(alpha2.encode("ascii")[:2].ljust(2))
+            parts.extend(_MASK.pack(mask) for mask in
+                         country_masks + self.dfs_masks[alpha2])
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Inverse of to_bytes(). Raises ValueError if data is malformed."""
+        try:
+            magic, version, digest, n_plans, n_countries = \
+                _HEADER.unpack_from(data)
+            if magic != _MAGIC or version != _VERSION:
+                raise ValueError("Not a version %d channel table" %
+                                 (_VERSION,))
+            offset = _HEADER.size
+            plans = []
+            for _ in range(n_plans):
+                band, width = _PLAN.unpack_from(data, offset)
+                plans.append((band.rstrip(b"\0").decode("ascii"), width))
+                offset += _PLAN.size
+            masks = {}
+            dfs_masks = {}
+            for _ in range(n_countries):
+                alpha2 = data[offset:offset + 2].decode("ascii")
+                offset += 2
+                country_masks = tuple(
+                    _MASK.unpack_from(data, offset + index * _MASK.size)[0]
+                    for index in range(2 * n_plans)
+                )
+                masks[alpha2] = country_masks[:n_plans]
+                dfs_masks[alpha2] = country_masks[n_plans:]
+                offset += 2 * n_plans * _MASK.size
+        except (struct.error, UnicodeDecodeError) as e:
+            raise ValueError("Truncated channel table: %s" % (e,))
+        if offset != len(data):
+            raise ValueError("Channel table length mismatch")
+        return cls(digest, plans, masks, dfs_masks)
+
+
+def encode_mask(band, width, legal_channels):
+    """Return the bitmask of legal_channels among band's width MHz channels."""
+    mask = 0
+    for bit, channel in enumerate(spectrum.band_channels(band, width)):
+        if channel in legal_channels:
+            mask |= 1 << bit
+    return mask
+
+
+def decode_mask(band, width, mask):
+    """Inverse of encode_mask(), returning channels in increasing order."""
+    return [channel
+            for bit, channel in enumerate(spectrum.band_channels(band, width))
+            if mask & (1 << bit)]
+
+
+def table_path(cache_dir=scan_cache.CACHE_DIR):
+    """Return the path of the persisted table."""
+    return Path(cache_dir, TABLE_FILENAME)
+
+
+def load(digest, cache_dir=scan_cache.CACHE_DIR):
+    """Return the persisted table if it was built from a database with digest.
+
+    Returns
+    -------
+    ChannelTable or None
+        None if there's no table, it's unreadable or it's stale.
+    """
+    try:
+        table = ChannelTable.from_bytes(table_path(cache_dir).read_bytes())
+    except (OSError, ValueError):
+        return None
+    return table if table.digest == digest else None
+
+
+def store(table, cache_dir=scan_cache.CACHE_DIR):
+    """Atomically persist table. Returns whether it worked."""
+    return scan_cache.write_atomically(table_path(cache_dir),
+                                       table.to_bytes())
@@ -2,17 +2,22 @@
 """Console script for wifi_configurator."""
 import functools
 import os
-import random
-import subprocess
 import sys
 import json
 import click
-import configobj
-import jinja2
-import pyric
-import pyric.pyw as pyw
 import logging
-import time
+from wifi_configurator import lazy
+
+# Loaded when first used, so --help and runs that don't scan start quickly
+configobj = lazy.lazy_import("configobj")
+pyric = lazy.lazy_import("pyric")
+pyw = lazy.lazy_import("pyric.pyw")
+random = lazy.lazy_import("random")
+config_files = lazy.lazy_import("wifi_configurator.config_files")
+hostapd_ctrl = lazy.lazy_import("wifi_configurator.hostapd_ctrl")
+services = lazy.lazy_import("wifi_configurator.services")
+discovery = lazy.lazy_import("wifi_configurator.discovery")
+templates = lazy.lazy_import("wifi_configurator.templates")
 
 
 
@@ -20,6 +25,15 @@ SYSLOG_TAG = "wifi-configurator"
 DEFAULT_SSID = " - Free Media"
 DEFAULT_CHANNEL = "7"
 INTERFACE = 'wlan0'
+BAND_AUTO = "auto"
+WPA_SUPPLICANT_CONF = "/etc/wpa_supplicant/wpa_supplicant.conf"
+# How long each discovery stage may take before main() carries on without
+#  it. The scan has its own --scan-timeout; this covers bringing the
+#  interface up and retries around it
+SCAN_STAGE_GRACE_S = 10
+ADAPTER_STAGE_TIMEOUT_S = 10
+# Rebuilding the table from a new regulatory database is the slow case
+CHANNEL_TABLE_STAGE_TIMEOUT_S = 30
 
 
 
@@ -76,24 +90,24 @@ def get_current_ssid(config):
     str
         Full SSID string, e.g. 'MyOrg - Free Media'.
     """
-# Using a dictionary and json to store Branding stuff
-# Set a fallback name in case the file is 'busted'
-  brand_name = "ConnectBox"
-
-# Read the dictionary
-  try:
-    with open('/usr/local/connectbox/brand.j2') as f:
-      try:
-          data = f.read()
-          f.close()
-          js = json.loads(data)
-          brand_name = js["Brand"]
-      except (FileNotFoundError, json.JSONDecoderError, KeyError) as e:
-          Logging.warning(f"Config busted or missing: {e}, Using fallback  ")
-    return (brand_name + DEFAULT_SSID)
-  except (FileNotFoundError) as e:
-    Logging.warning(f"Config file missing: {e}, using fallback ")
-    return ("ConnectBox" + DEFAULT_SSID)
+    # Using a dictionary and json to store Branding stuff
+    # Set a fallback name in case the file is 'busted'
+    brand_name = "ConnectBox"
+
+    # Read the dictionary
+    try:
+        with open('/usr/local/connectbox/brand.j2') as f:
+            try:
+                data = f.read()
+                f.close()
+                js = json.loads(data)
+                brand_name = js["Brand"]
+            except (FileNotFoundError, json.JSONDecodeError, KeyError) as e:
+                logging.warning(f"Config busted or missing: {e}, Using fallback  ")
+        return (brand_name + DEFAULT_SSID)
+    except (FileNotFoundError) as e:
+        logging.warning(f"Config file missing: {e}, using fallback ")
+        return ("ConnectBox" + DEFAULT_SSID)
 
 
 def get_current_interface(config):
@@ -185,6 +199,28 @@ def get_current_country_code(config):
     """
     return config.get("country_code", "")
 
+
+def choose_country_code(scanned_cc, current_cc):
+    """Return the country code to use after trying to infer it by scanning.
+
+    Parameters
+    ----------
+    scanned_cc : str
+        What scan.detect_regdomain() inferred, or '' if it couldn't, e.g.
+        because the scan failed, heard nothing or timed out.
+    current_cc : str
+        The country code in hostapd.conf.
+
+    Returns
+    -------
+    str
+    """
+    # Only use the scanned cc if it's non-empty
+    if scanned_cc:
+        return scanned_cc
+    click.echo("Could not do wifi scan. Using previous country code")
+    return current_cc
+
 def get_current_ac_mode(config):
     """Return the ieee80211ac flag from hostapd.conf (0 = disabled, 1 = enabled).
 
@@ -327,6 +363,30 @@ def cb_handle_output(ctx, _, value):
     return value
 
 
+def cb_handle_import_times(ctx, _, value):
+    """Click callback that reports import times and exits, for --import-times.
+
+    Times importing this module, which is all --help needs, and then every
+    import main() may make on its way to rendering hostapd.conf.  Both are
+    timed in a fresh interpreter, so modules already loaded by this one
+    don't hide their cost.
+
+    Parameters
+    ----------
+    ctx : click.Context
+    _ : click.Option (unused)
+    value : bool
+        Whether --import-times was given.
+    """
+    if not value or ctx.resilient_parsing:
+        return
+    cold_start = lazy.import_times([lazy.CLI_MODULE])
+    click.echo(lazy.format_report(
+        lazy.cumulative_us(cold_start, lazy.CLI_MODULE),
+        lazy.import_times(lazy.MAIN_PATH_MODULES, eager=True)))
+    ctx.exit()
+
+
 @click.command()
 # This must be an eager option because other options reference it in their
 #  callbacks
@@ -360,11 +420,63 @@ def cb_handle_output(ctx, _, value):
                    "code by sniffing for other APs")
 @click.option('--sync/--no-sync',
               default=True,
-              help="Performs a filesystem sync after writing changes")
+              help="Makes sure changed configuration files are on disk "
+                   "before restarting services")
+@click.option('--scan-timeout',
+              type=float,
+              default=20,
+              help="Seconds to wait for a wifi scan before using whatever "
+                   "partial results have arrived. Defaults to 20")
+@click.option('--max-scan-age',
+              type=float,
+              default=120,
+              help="Reuse a scan saved by an earlier run if it is at most "
+                   "this many seconds old. 0 always scans. Defaults to 120")
+@click.option('--cached-scan-max-age',
+              type=float,
+              default=20,
+              help="Use the kernel's cached scan results instead of "
+                   "scanning if enough were seen within this many "
+                   "seconds. 0 always scans. Defaults to 20")
+@click.option('--scan-samples',
+              type=click.IntRange(min=1),
+              default=1,
+              help="Choose the channel from statistics averaged over this "
+                   "many scans (and recent earlier runs) rather than a "
+                   "single scan. Defaults to 1")
+@click.option('--scan-window',
+              type=float,
+              default=30,
+              help="Seconds to spread --scan-samples scans over. "
+                   "Defaults to 30")
+@click.option('--scan-backend',
+              type=click.Choice(["auto", "nl80211", "iw"]),
+              default="auto",
+              help="How to scan: natively over nl80211, by running iw, or "
+                   "nl80211 with iw as a fallback (auto, the default)")
+@click.option('--band',
+              type=click.Choice([BAND_AUTO, "2.4GHz", "5GHz"]),
+              default=BAND_AUTO,
+              help="Band to run the access point in. auto (the default) "
+                   "uses 5GHz if the adapter and country allow it, or the "
+                   "band of --channel if it is given")
+@click.option('--live/--restart',
+              default=True,
+              help="Change the channel, ssid or passphrase of a running "
+                   "hostapd through its control socket, so clients stay "
+                   "connected (the default), or always restart it")
+@click.option('--import-times',
+              is_flag=True,
+              expose_value=False,
+              is_eager=True,
+              callback=cb_handle_import_times,
+              help="Report how long importing each module takes, "
+                   "then exit")
 
 # pylint: disable=too-many-arguments,too-many-locals
 def main(filename, interface, ssid, channel, output, wpa_passphrase, sync,
-         set_country_code):
+         set_country_code, scan_timeout, max_scan_age, cached_scan_max_age,
+         scan_samples, scan_window, scan_backend, band, live):
     """Generate a hostapd.conf for the ConnectBox WiFi access point.
 
     This is the primary entry point for the wifi-configurator CLI.  It reads
@@ -375,20 +487,34 @@ def main(filename, interface, ssid, channel, output, wpa_passphrase, sync,
     Processing sequence:
     1. Load existing hostapd.conf to provide defaults for any options not
        specified on the command line.
-    2. Identify the WiFi adapter via adapters.factory() so the correct
-       ht_capab/vht_capab flags are written into the template.
-    3. If --set-country-code or no channel given, run 'iw dev scan' to detect
-       the regulatory domain and find an uncontested channel.
+    2. At the same time (see the discovery module), each with a timeout:
+       - identify the WiFi adapter via adapters.factory() so the correct
+         ht_capab/vht_capab flags are written into the template
+       - load the legal channel table for the regulatory database
+       - if --set-country-code or no channel given, scan to detect the
+         regulatory domain and find an uncontested channel.
+    3. Choose the band: 5GHz if the adapter is 802.11ac capable and the
+       country allows an access point there, otherwise 2.4GHz.  DFS
+       channels are avoided unless everything else is busy.
     4. Validate the channel against the legal channel list for the country.
+       Adapters capable of 40MHz get a 40MHz channel pair if the scan shows
+       one that's clear and 20/40 coexistence rules allow it.
     5. Render hostapd.conf and wpa_supplicant.conf from Jinja2 templates.
-    6. Optionally sync the filesystem to prevent corruption on power loss.
-    7. Restart hostapd, wpa_supplicant, and dnsmasq so changes are live.
+    6. Atomically replace whichever of them have changed, syncing them to
+       disk to prevent corruption on power loss.
+    7. Make the changes live.  A new channel, SSID or passphrase is
+       passed to the running hostapd over its control socket, so clients
+       stay associated.  Otherwise the services whose configuration
+       changed (hostapd and dnsmasq, and/or wpa_supplicant) are
+       restarted.  Nothing is restarted if nothing changed.
 
     Parameters are supplied by Click from the decorated options above.
     """
     sys.path.append('/usr/local/connectbox/wifi_configurator_venv/lib/python3.9/site-packages/wifi_configurator')
     import adapters
     import scan
+    from wifi_configurator import ht40
+    from wifi_configurator import spectrum
 
     config = hostapd_conf_as_config(filename)
     # Could use a callback and access filename parameter in the decorator,
@@ -398,46 +524,133 @@ def main(filename, interface, ssid, channel, output, wpa_passphrase, sync,
 
     interface = get_current_interface(config)
 
-    wifi_adapter = adapters.factory(interface)
-    logging.info("ssid is"+str(ssid)+"interface is:"+str(interface)+"wifi adapter: "+str(wifi_adapter))
-    # We deliberately only instantiate pyw.getcard for as small a set of
-    #  parameters as possible because pyw gets sad if operations are
-    #  attempted on a device that does not support nl80211 and we want to
-    #  be to do as many things as possible in simulations
-    scan_output = ""
-    if set_country_code or not channel:
+    # The scan, identifying the adapter and loading the legal channel table
+    #  don't depend on each other, so they run at the same time. Only the
+    #  scan can stop early, so the other stages aren't waited for if they
+    #  time out
+    def detect_adapter(_):
+        return adapters.factory(interface)
+
+    def load_channel_table(_):
+        return scan.get_channel_table()
+
+    def scan_for_aps(cancelled):
+        """Return (stats, scan_result) to infer the country and channel from.
+
+        stats is aggregated over several scans if --scan-samples asks for
+        it, or else None.
+        """
+        if not set_country_code and channel:
+            return None, scan.ScanResult()
+
+        def stop_when(scan_result):
+            # If the channel is fixed, the scan is only for the country code
+            #  so we can stop as soon as the consensus is clear
+            return bool(channel) and \
+                scan.country_consensus_is_decisive(scan_result)
+        # We deliberately only instantiate pyw.getcard for as small a set of
+        #  parameters as possible because pyw gets sad if operations are
+        #  attempted on a device that does not support nl80211 and we want
+        #  to be to do as many things as possible in simulations
         try:
             if pyw.iswireless(interface):
                 wlan_if = pyw.getcard(interface)
-                scan_output = scan.get_scan_output(wlan_if)
-            else:
-                click.echo("Interface %s is not a wifi interface. Won't be "
-                           "able to infer country code or do automatic "
-                           "channel selection" % (interface,))
+                if scan_samples > 1 and not channel:
+                    return scan.sample_channel_stats(
+                        wlan_if, scan_samples, scan_window,
+                        timeout=scan_timeout, backend=scan_backend,
+                        cancelled=cancelled)
+                # Country detection and channel selection both query this
+                #  one ScanResult
+                return None, scan.get_scan_result(
+                    wlan_if, timeout=scan_timeout, stop_when=stop_when,
+                    backend=scan_backend,
+                    cached_max_age_s=cached_scan_max_age,
+                    max_scan_age_s=max_scan_age, cancelled=cancelled)
+            click.echo("Interface %s is not a wifi interface. Won't be "
+                       "able to infer country code or do automatic "
+                       "channel selection" % (interface,))
         except pyric.error:
             click.echo("Unable to query interface %s with pyw. Won't be "
                        "able to infer country code or do automatic "
                        "channel selection" % (interface,))
+        return None, scan.ScanResult()
+
+    scan_timeout_s = scan_timeout + SCAN_STAGE_GRACE_S
+    if scan_samples > 1:
+        scan_timeout_s += scan_window
+    found = discovery.run_stages([
+        discovery.Stage("scan", scan_for_aps, scan_timeout_s,
+                        (None, scan.ScanResult())),
+        discovery.Stage("adapter detection", detect_adapter,
+                        ADAPTER_STAGE_TIMEOUT_S,
+                        adapters.get_registry().default,
+                        cancel_timeout_s=0),
+        discovery.Stage("channel table", load_channel_table,
+                        CHANNEL_TABLE_STAGE_TIMEOUT_S, None,
+                        cancel_timeout_s=0),
+    ])
+    stats, scan_result = found["scan"]
+    wifi_adapter = found["adapter detection"]
+    table = found["channel table"]
+    if table is None:
+        # The stage is still building the table, so building it here too
+        #  would only take longer. Use one persisted by an earlier run
+        table = scan.load_channel_table()
+        if table is None:
+            raise click.ClickException(
+                "Timed out building the legal channel table. Exiting")
+    logging.info("ssid is"+str(ssid)+"interface is:"+str(interface)+"wifi adapter: "+str(wifi_adapter))
 
     # Retrieve the previous cc now, given we have so many fallback cases
     country_code = get_current_country_code(config)
     if set_country_code:
-        scanned_cc = scan.detect_regdomain(scan_output)
-        # Only use the scanned cc if it's non-empty
-        if scanned_cc[0]:
-            country_code = scanned_cc
-        else:
-            click.echo("Could not do wifi scan. Using previous country code")
+        country_code = choose_country_code(
+            scan.detect_regdomain(scan_result), country_code)
         click.echo("Country code is: %s" % (country_code,))
-    valid_channels_for_cc = scan.channels_for_country(country_code)
-    if not channel:
-        # Choose an uncontested channel, or a random one if there aren't any
-        # MEH that we respecify wlan_if when we've used it to scan just a bit
-        #  earlier
+    if band == BAND_AUTO:
+        if channel:
+            band = spectrum.channel_band(channel) or spectrum.BAND_2GHZ
+        else:
+            band = scan.choose_band(wifi_adapter.ac_active, country_code,
+                                    table=table)
+    click.echo("Band is: %s" % (band,))
+    valid_channels_for_cc = scan.channels_for_country(country_code, band=band,
+                                                      table=table)
+    dfs_channels = scan.dfs_channels_for_country(country_code, band=band,
+                                                 table=table)
+    ht_capab = wifi_adapter.ht_capab
+    if band == spectrum.BAND_5GHZ:
+        ht_capab = wifi_adapter.ht_capab_5ghz
+    # Use 40MHz if the adapter can and the scan shows a clear pair. Without
+    #  a scan there's nothing to check 20/40 coexistence against
+    ht40_pair = None
+    ht40_flags = ht40.supported_flags(ht_capab)
+    if ht40_flags and len(scan_result) and \
+            (not channel or channel in valid_channels_for_cc):
+        ht40_pair = scan.get_uncontested_ht40_pair(
+            scan.channels_for_country(country_code, band=band, width=40,
+                                      table=table),
+            stats or scan_result, scan_result, band,
+            scan.dfs_channels_for_country(country_code, band=band, width=40,
+                                          table=table),
+            primary=channel or None, flags=ht40_flags)
+    if ht40_pair:
+        channel = ht40_pair.primary
+    elif not channel:
+        # Choose an uncontested channel, or the least contested one if there
+        #  aren't any, or a random one if none could be scored
         channel = scan.get_available_uncontested_channel(
-            valid_channels_for_cc, scan_output
+            valid_channels_for_cc, stats or scan_result, band, dfs_channels
         )
-        if (not channel and len(valid_channels_for_cc) > 0):
+        least_contested = scan.get_least_contested_channel(
+            valid_channels_for_cc, stats or scan_result, band, dfs_channels
+        )
+        if not channel and least_contested:
+            channel = least_contested
+            click.echo("No uncontested channels. Choosing least contested "
+                       "channel %s" % (channel,))
+        elif (not channel and len(valid_channels_for_cc) > 0):
             channel = random.choice(valid_channels_for_cc)
             click.echo("No uncontested channels. Choosing %s at random" %
                        (channel,))
@@ -454,25 +667,22 @@ def main(filename, interface, ssid, channel, output, wpa_passphrase, sync,
                     country_code,
                     ",".join([str(i) for i in valid_channels_for_cc])))
     logging.info("AP channel is now: "+str(channel))
-    res = os.system( "ifdown "+interface)
-    res = os.system( "systemctl stop hostapd")
-    file_loader = jinja2.PackageLoader('wifi_configurator')
-    env = jinja2.Environment(
-        loader=file_loader,
-        trim_blocks=True,
-        lstrip_blocks=True,
-    )
-    template = env.get_template('hostapd.conf.j2')
-    rendered = template.stream(
+    env = templates.get_environment()
+    template = env.get_template(templates.HOSTAPD_TEMPLATE)
+    hostapd_conf = template.render(
         interface=interface,
         ssid=ssid,
         channel=channel,
         country_code=country_code,
         wifi_adapter=wifi_adapter,
         wpa_passphrase=wpa_passphrase,
-    )
-    rendered.dump(output)
-    res = os.system("systemctl stop wpa_supplicant")
+        hw_mode=spectrum.HW_MODES[band],
+        ht_capab=ht40.with_ht40_flag(ht_capab, ht40_pair),
+        # VHT is 5GHz only
+        ieee80211ac=band == spectrum.BAND_5GHZ and wifi_adapter.ac_active,
+        dfs=any(in_use in dfs_channels
+                for in_use in ht40_pair or (channel,)),
+    ).encode("utf-8")
 # get the version of python so we can use it in a directory refernce
     pipe = os.popen("ls /usr/local/connectbox/wifi_configurator_venv/lib").read()
     pipe = pipe.strip('\n')
@@ -481,22 +691,112 @@ def main(filename, interface, ssid, channel, output, wpa_passphrase, sync,
     res = os.system( pipe )
     if res < 0:
        click.echo("FAILED !! could not copy wpa_supplicant.conf to the template directory")
-    template = env.get_template('wpa_supplicant.conf')
-    rendered = template.stream(
-        country=country_code)
-    rendered.dump('/etc/wpa_supplicant/wpa_supplicant.conf')
-    # Some filesystems don't write to disk for a while, which can lead to
-    #  corruption in files. A corrupt hostapd.conf may well brick a device
-    #  in the field so let's avoid that risk.
+    template = env.get_template(templates.WPA_SUPPLICANT_TEMPLATE)
+    wpa_supplicant_conf = config_files.ConfigFile(
+        WPA_SUPPLICANT_CONF,
+        template.render(country=country_code).encode("utf-8"))
+
+    # Only restart the services whose configuration has changed, so a run
+    #  that changes nothing doesn't take the access point down
+    if output == sys.stdout:
+        # Nothing to restart for
+        sys.stdout.write(hostapd_conf.decode("utf-8"))
+        hostapd_changed = False
+    else:
+        hostapd_changed = config_files.is_changed(
+            config_files.ConfigFile(output, hostapd_conf))
+    wpa_supplicant_changed = config_files.is_changed(wpa_supplicant_conf)
+    if not hostapd_changed and not wpa_supplicant_changed:
+        click.echo("Configuration is unchanged. Not restarting anything")
+        return 0
+    # What the running hostapd was started with (or last reconfigured to)
+    running_hostapd_conf = None
+    if hostapd_changed:
+        try:
+            with open(output, "rb") as f:
+                running_hostapd_conf = f.read()
+        except OSError:
+            pass
+    # Each file is replaced atomically and, unless --no-sync, is on disk
+    #  before we carry on. A corrupt hostapd.conf may well brick a device
+    #  in the field.
     # Related: https://github.com/ConnectBox/connectbox-pi/issues/220
-    if sync and output != sys.stdout:
-        subprocess.run("/bin/sync")
-    res = os.system("systemctl start wpa_supplicant")
-    res = os.system("systemctl start hostapd")
-    res = os.system("ifup "+interface)
-    res = os.system("systemctl restart hostapd")
-    res = os.system("systemctl restart dnsmasq")
-    time.sleep(4)
+    if hostapd_changed:
+        config_files.write_atomically(output, hostapd_conf, sync)
+    if wpa_supplicant_changed:
+        config_files.write_atomically(
+            wpa_supplicant_conf.path, wpa_supplicant_conf.data, sync)
+    # A channel, SSID or passphrase change can be made without dropping
+    #  every client. Anything else, or if that fails, needs a restart
+    if hostapd_changed and live and hostapd_ctrl.reconfigure(
+            interface, running_hostapd_conf, hostapd_conf):
+        click.echo("Reconfigured hostapd without restarting it")
+        hostapd_changed = False
+    plan = services.ServicePlan()
+    if hostapd_changed:
+        # dnsmasq serves the interface's address, so it's restarted once
+        #  the interface is back up. ifdown fails if the interface is
+        #  already down, and the services need restarting for the new
+        #  configuration even if ifup fails, so they only follow them
+        ifdown = plan.add("ifdown", interface)
+        ifup = plan.add(
+            "ifup", interface, follows=[ifdown],
+            ready=functools.partial(scan.wait_for_interface_up, interface))
+        plan.add("restart", "hostapd", follows=[ifup],
+                 ready=functools.partial(hostapd_ctrl.wait_until_running,
+                                         interface))
+        plan.add("restart", "dnsmasq", follows=[ifup])
+    if wpa_supplicant_changed:
+        plan.add("restart", "wpa_supplicant")
+    # run() has reported every result, so interface failures are only
+    #  warnings
+    failures = [result.detail for result in services.run(plan)
+                if not result.ok
+                and result.action.verb not in services.INTERFACE_VERBS]
+    if failures:
+        raise click.ClickException(
+            "Unable to apply the new configuration: %s" %
+            ("; ".join(failures),))
+    return 0
+
+
+@click.command()
+@click.option('--regdb', 'regdb_path',
+              type=click.Path(exists=True, dir_okay=False),
+              help="Regulatory database to build from. Defaults to the "
+                   "installed regulatory.db or regulatory.bin")
+@click.option('--cache-dir',
+              type=click.Path(file_okay=False),
+              default="/var/cache/wifi-configurator",
+              help="Where to store the table")
+def build_channel_table(regdb_path, cache_dir):
+    """Precompute the legal channels of every country.
+
+    main() builds the table on first use anyway, and whenever the regulatory
+    database changes, but running this at install time takes that work off
+    the boot path.
+    """
+    from wifi_configurator import scan
+    table = scan.get_channel_table(regdb_path, cache_dir)
+    click.echo("Legal channel table for %d countries is in %s" %
+               (len(table.masks), cache_dir))
+    return 0
+
+
+@click.command()
+@click.option('--cache-dir',
+              type=click.Path(file_okay=False),
+              default="/var/cache/wifi-configurator",
+              help="Where to store the compiled templates")
+def compile_templates(cache_dir):
+    """Compile the hostapd.conf and wpa_supplicant.conf templates.
+
+    main() compiles and caches each template on first use anyway, and
+    whenever it changes, but running this at install time takes that work
+    off the boot path.
+    """
+    names = templates.precompile(cache_dir)
+    click.echo("Compiled %s into %s" % (", ".join(names), cache_dir))
     return 0
 
 
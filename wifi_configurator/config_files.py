@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""Change-aware, crash-safe writing of rendered configuration files.
+
+Configurations are rendered to memory first and compared, by content hash,
+with what's on disk, so that a run that changes nothing writes nothing and
+restarts nothing.  Changed files are replaced atomically: the new content
+is written and fsync'd to a temporary file in the same directory, renamed
+over the old file and the directory fsync'd.  After a power cut the file
+is either the old or the new version, never empty or half written, which
+is what the global /bin/sync used to guard against.
+"""
+
+import collections
+import hashlib
+import os
+import tempfile
+
+
+# Mode of files that didn't exist before
+DEFAULT_MODE = 0o644
+
+ConfigFile = collections.namedtuple("ConfigFile", [
+    "path",  # str, where the file lives
+    "data",  # bytes, its rendered content
+])
+
+
+def digest(data):
+    """Return the SHA-256 hex digest of data (bytes)."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_digest(path):
+    """Return the digest of the file at path, or None if it can't be read."""
+    try:
+        with open(path, "rb") as f:
+            return digest(f.read())
+    except OSError:
+        return None
+
+
+def is_changed(config_file):
+    """Return whether config_file's data differs from the file on disk."""
+    return digest(config_file.data) != file_digest(config_file.path)
+
+
+def fsync_directory(path):
+    """fsync the directory at path, so a rename within it is durable."""
+    fd = os.open(path, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_atomically(path, data, sync=True):
+    """Replace the file at path with data.
+
+    The file keeps its mode and ownership; new files get DEFAULT_MODE.
+
+    Parameters
+    ----------
+    path : str
+    data : bytes
+    sync : bool
+        Whether to fsync the file and its directory before returning, so
+        the new content survives a power cut.
+
+    Raises
+    ------
+    OSError
+        If the file can't be written. It's left as it was.
+    """
+    path = os.path.abspath(path)
+    directory = os.path.dirname(path)
+    try:
+        existing = os.stat(path)
+    except FileNotFoundError:
+        existing = None
+    tmp = tempfile.NamedTemporaryFile(dir=directory, prefix=".tmp-",
+                                      delete=False)
+    try:
+        with tmp:
+            tmp.write(data)
+            tmp.flush()
+            if existing is None:
+                os.fchmod(tmp.fileno(), DEFAULT_MODE)
+            else:
+                os.fchmod(tmp.fileno(), existing.st_mode & 0o7777)
+                if (existing.st_uid, existing.st_gid) != \
+                        (os.getuid(), os.getgid()):
+                    os.fchown(tmp.fileno(), existing.st_uid,
+                              existing.st_gid)
+            if sync:
+                os.fsync(tmp.fileno())
+        os.replace(tmp.name, path)
+    except BaseException:
+        try:
+            os.unlink(tmp.name)
+        except OSError:
+            pass
+        raise
+    if sync:
+        fsync_directory(directory)
+
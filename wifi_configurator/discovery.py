@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+"""Running the independent parts of discovery at the same time.
+
+Before it can choose a channel, main() needs a radio scan (seconds of
+radio time), the adapter's capabilities (a sysfs read, or an nl80211 probe)
+and the legal channel table (reading, and on a cold boot possibly
+rebuilding from, the regulatory database).  None of them needs the others,
+so they run as concurrent stages and time-to-config comes down to roughly
+the length of the scan.
+
+Each stage runs in its own daemon thread and has its own timeout.  A stage
+that overruns is cancelled: its threading.Event is set, which stages that
+can stop early check, and the caller carries on with the stage's default.
+A cancelled stage that checks its Event gets a grace period to stop
+(CANCEL_TIMEOUT_S by default), so that e.g. a scan has killed iw and put the
+interface back before main() restarts the services using it.  Stages that
+can't stop early have no grace.  A stage that's still running after its
+grace is abandoned rather than joined, so it can't hold up the rest of the
+run or the interpreter's exit.
+"""
+
+import collections
+import threading
+import time
+import click
+
+
+# How long a cancelled stage may take to stop, by default
+CANCEL_TIMEOUT_S = 5
+
+Stage = collections.namedtuple("Stage", [
+    "name",       # str, for messages
+    "func",       # callable(cancelled) returning the stage's result, where
+                  #  cancelled is a threading.Event set if it overruns
+    "timeout_s",  # float, from the start of the pipeline
+    "default",    # the result if the stage times out
+    "cancel_timeout_s",  # float, how long it may take to stop once
+                         #  cancelled. 0 if it doesn't check cancelled
+])
+Stage.__new__.__defaults__ = (CANCEL_TIMEOUT_S,)
+
+
+class _StageThread(threading.Thread):
+    """Runs a stage, keeping its result or exception."""
+
+    def __init__(self, stage):
+        super().__init__(name="discovery-%s" % (stage.name,), daemon=True)
+        self.stage = stage
+        self.cancelled = threading.Event()
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self.stage.func(self.cancelled)
+        except BaseException as e:  # pylint: disable=broad-except
+            self.error = e
+
+
+def run_stages(stages):
+    """Run stages concurrently and return their results.
+
+    Parameters
+    ----------
+    stages : iterable of Stage
+
+    Returns
+    -------
+    dict
+        {stage name: result, or the stage's default if it timed out}.
+
+    Raises
+    ------
+    Exception
+        Whatever a stage raised, once every stage has finished or timed
+        out.
+    """
+    start = time.monotonic()
+    threads = [_StageThread(stage) for stage in stages]
+    for thread in threads:
+        thread.start()
+    results = {}
+    error = None
+    for thread in threads:
+        stage = thread.stage
+        thread.join(max(0, start + stage.timeout_s - time.monotonic()))
+        if thread.is_alive():
+            thread.cancelled.set()
+            click.echo("%s timed out after %ss. Carrying on without it" %
+                       (stage.name.capitalize(), stage.timeout_s))
+            thread.join(stage.cancel_timeout_s)
+            if thread.is_alive() and stage.cancel_timeout_s:
+                click.echo("%s didn't stop when cancelled" %
+                           (stage.name.capitalize(),))
+            results[stage.name] = stage.default
+        elif thread.error is not None:
+            error = error or thread.error
+        else:
+            results[stage.name] = thread.result
+    if error is not None:
+        raise error
+    return results
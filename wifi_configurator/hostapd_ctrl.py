@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+
+"""Live reconfiguration of a running hostapd over its control socket.
+
+Restarting hostapd drops every associated client.  hostapd.conf enables the
+control interface (ctrl_interface=/var/run/hostapd), a Unix datagram socket
+per interface that takes the same commands as hostapd_cli, so some changes
+can be made without a restart:
+
+- A new channel, with CHAN_SWITCH.  hostapd announces the switch in its
+  beacons for a few beacon intervals (a CSA) and clients follow it.
+- A new SSID or passphrase, with SET then RELOAD.  Clients reassociate.
+
+Anything else (e.g. the country, band or turning WPA on or off), or a
+switch hostapd refuses (e.g. onto a DFS channel, which needs a CAC), still
+needs a restart.  reconfigure() decides which applies by comparing the old
+and new hostapd.conf, and verifies a live change with STATUS.
+"""
+
+import errno
+import itertools
+import os
+import socket
+import tempfile
+import time
+from wifi_configurator import bss
+from wifi_configurator import ht40
+from wifi_configurator import spectrum
+
+
+CTRL_DIR = "/var/run/hostapd"
+DEFAULT_TIMEOUT_S = 2
+RECV_BUFSZ = 4096
+# Beacons announcing a channel switch before it happens
+CSA_BEACONS = 5
+# How long a channel switch or reload may take to show up in STATUS
+VERIFY_TIMEOUT_S = 5
+VERIFY_INTERVAL_S = 0.1
+# STATUS states of a hostapd that's up. DFS is listening for radar before
+#  it starts beaconing, which can take minutes
+RUNNING_STATES = ("ENABLED", "DFS")
+
+# hostapd.conf keys that can be changed without a restart
+CHANNEL_KEYS = frozenset(["channel", "ht_capab"])
+RELOAD_KEYS = frozenset(["ssid", "wpa_passphrase"])
+HW_MODE_BANDS = {mode: band for band, mode in spectrum.HW_MODES.items()}
+
+_client_ids = itertools.count()
+
+
+class HostapdCtrlError(EnvironmentError):
+    """hostapd isn't reachable, or refused or failed a command."""
+
+
+def parse_conf(data):
+    """Return hostapd.conf data (bytes) as a {key: value} dict.
+
+    Comments, blank lines and lines without an = are skipped.
+    """
+    conf = {}
+    for line in data.decode("utf-8", "replace").splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        key, sep, value = line.partition("=")
+        if sep:
+            conf[key.strip()] = value.strip()
+    return conf
+
+
+def changed_keys(old_conf, new_conf):
+    """Return the keys whose values differ between two parsed confs."""
+    return {key for key in set(old_conf) | set(new_conf)
+            if old_conf.get(key) != new_conf.get(key)}
+
+
+class HostapdCtrl:
+    """A connection to hostapd's control socket for one interface.
+
+    Parameters
+    ----------
+    interface : str
+        The access point interface, which names the socket.
+    ctrl_dir : str
+        hostapd's ctrl_interface directory.
+    timeout : float
+        Seconds to wait for each reply.
+
+    Raises
+    ------
+    HostapdCtrlError
+        If hostapd's socket can't be connected to (e.g. it isn't running).
+    """
+
+    def __init__(self, interface, ctrl_dir=CTRL_DIR,
+                 timeout=DEFAULT_TIMEOUT_S):
+        self.path = os.path.join(ctrl_dir, interface)
+        # hostapd replies to the sender's address, so the socket needs one
+        self.local_path = os.path.join(
+            tempfile.gettempdir(),
+            "wifi-configurator-%d-%d" % (os.getpid(), next(_client_ids)))
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            self.sock.bind(self.local_path)
+            self.sock.settimeout(timeout)
+            self.sock.connect(self.path)
+        except OSError as e:
+            self.close()
+            raise HostapdCtrlError(
+                e.errno, "Unable to connect to %s: %s" % (self.path, e))
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.unlink(self.local_path)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def request(self, command):
+        """Send command and return hostapd's reply.
+
+        Raises
+        ------
+        HostapdCtrlError
+            If hostapd doesn't reply in time.
+        """
+        try:
+            self.sock.send(command.encode("utf-8"))
+            while True:
+                reply = self.sock.recv(RECV_BUFSZ).decode("utf-8",
+                                                          "replace")
+                # Unsolicited events, e.g. <3>AP-STA-CONNECTED, start with
+                #  their priority
+                if not reply.startswith("<"):
+                    return reply
+        except socket.timeout:
+            raise HostapdCtrlError(errno.ETIMEDOUT,
+                                   "hostapd didn't reply to %s" %
+                                   (command.split()[0],))
+        except OSError as e:
+            raise HostapdCtrlError(e.errno, "hostapd %s failed: %s" %
+                                   (command.split()[0], e))
+
+    def command(self, command):
+        """Send a command that hostapd answers with OK.
+
+        Raises
+        ------
+        HostapdCtrlError
+            If the reply is anything else (normally FAIL).
+        """
+        reply = self.request(command).strip()
+        if reply != "OK":
+            # Don't echo passphrases back
+            raise HostapdCtrlError(errno.EINVAL, "hostapd replied %s to %s" %
+                                   (reply, command.split()[0]))
+
+    def ping(self):
+        """Return whether hostapd is responding."""
+        return self.request("PING").strip() == "PONG"
+
+    def status(self):
+        """Return hostapd's STATUS as a {key: value} dict.
+
+        Keys include state ('ENABLED' once it's beaconing), freq, channel
+        and ssid[0].
+        """
+        return parse_conf(self.request("STATUS").encode("utf-8"))
+
+    def set(self, name, value):
+        """Change a configuration value, taking effect on reload()."""
+        self.command("SET %s %s" % (name, value))
+
+    def reload(self):
+        """Restart the BSS with the configuration as changed by set()."""
+        self.command("RELOAD")
+
+    def chan_switch(self, freq, cs_count=CSA_BEACONS, sec_channel_offset=0,
+                    center_freq1=None, bandwidth=None, ht=False, vht=False):
+        """Switch channel, announcing it for cs_count beacons first.
+
+        Parameters
+        ----------
+        freq : int
+            Primary channel centre frequency (MHz).
+        cs_count : int
+        sec_channel_offset : int
+            1 or -1 if the secondary channel is above or below the
+            primary, 0 for a 20MHz channel.
+        center_freq1 : int, optional
+            Centre frequency of the whole channel (MHz).
+        bandwidth : int, optional
+            Channel width (MHz).
+        ht, vht : bool
+            Whether to keep using HT and VHT on the new channel.
+        """
+        args = ["CHAN_SWITCH", str(cs_count), str(freq)]
+        if sec_channel_offset:
+            args.append("sec_channel_offset=%d" % (sec_channel_offset,))
+        if center_freq1:
+            args.append("center_freq1=%d" % (center_freq1,))
+        if bandwidth:
+            args.append("bandwidth=%d" % (bandwidth,))
+        if ht:
+            args.append("ht")
+        if vht:
+            args.append("vht")
+        self.command(" ".join(args))
+
+    def wait_for_status(self, expected, timeout=VERIFY_TIMEOUT_S):
+        """Return whether STATUS shows all of expected within timeout.
+
+        Parameters
+        ----------
+        expected : dict
+            {STATUS key: value}, e.g. {'state': 'ENABLED', 'channel': '6'}.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            status = self.status()
+            if all(status.get(key) == value
+                   for key, value in expected.items()):
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(VERIFY_INTERVAL_S)
+
+
+def wait_until_running(interface, deadline, ctrl_dir=CTRL_DIR):
+    """Wait until hostapd answers on its control socket and has started.
+
+    Parameters
+    ----------
+    interface : str
+    deadline : float
+        time.monotonic() to give up at.
+    ctrl_dir : str
+
+    Returns
+    -------
+    bool
+        Whether hostapd's state is one of RUNNING_STATES by deadline.
+    """
+    while True:
+        try:
+            with HostapdCtrl(interface, ctrl_dir) as ctrl:
+                if ctrl.status().get("state") in RUNNING_STATES:
+                    return True
+        except HostapdCtrlError:
+            # Not listening yet
+            pass
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(VERIFY_INTERVAL_S)
+
+
+def switch_channel(ctrl, conf):
+    """CHAN_SWITCH to the channel in conf (a parsed hostapd.conf)."""
+    channel = int(conf["channel"])
+    band = HW_MODE_BANDS[conf.get("hw_mode", "g")]
+    freq = spectrum.channel_to_freq(band, channel)
+    ht = conf.get("ieee80211n") == "1"
+    flags = ht40.supported_flags(conf.get("ht_capab", ""))
+    sec_channel_offset = 0
+    bandwidth = 20
+    if ht and flags:
+        sec_channel_offset = 1 if flags[0] == ht40.HT40_PLUS else -1
+        bandwidth = 40
+    # The secondary is a whole 20MHz channel away, so the centre is half
+    #  that
+    center_freq1 = freq + sec_channel_offset * bss.SUBCHANNEL_WIDTH_MHZ // 2
+    ctrl.chan_switch(freq, sec_channel_offset=sec_channel_offset,
+                     center_freq1=center_freq1, bandwidth=bandwidth, ht=ht,
+                     vht=conf.get("ieee80211ac") == "1")
+
+
+def reconfigure(interface, old_data, new_data, ctrl_dir=CTRL_DIR):
+    """Apply a change of hostapd.conf to the running hostapd, if possible.
+
+    Parameters
+    ----------
+    interface : str
+    old_data : bytes or None
+        The hostapd.conf hostapd is running with. None if unknown.
+    new_data : bytes
+        The new hostapd.conf.
+    ctrl_dir : str
+
+    Returns
+    -------
+    bool
+        True if hostapd is now running the new configuration. False if it
+        needs a restart, which is also the case if it wasn't running.
+    """
+    if old_data is None:
+        return False
+    old_conf = parse_conf(old_data)
+    new_conf = parse_conf(new_data)
+    keys = changed_keys(old_conf, new_conf)
+    if not keys or not keys <= CHANNEL_KEYS | RELOAD_KEYS:
+        return False
+    # Only the HT40 flag can change with the channel
+    if ht40.with_ht40_flag(old_conf.get("ht_capab", ""), None) != \
+            ht40.with_ht40_flag(new_conf.get("ht_capab", ""), None):
+        return False
+    # Turning WPA on or off needs more than the passphrase
+    if bool(old_conf.get("wpa_passphrase")) != \
+            bool(new_conf.get("wpa_passphrase")):
+        return False
+    try:
+        with HostapdCtrl(interface, ctrl_dir) as ctrl:
+            if not ctrl.wait_for_status({"state": "ENABLED"}, timeout=0):
+                return False
+            expected = {"state": "ENABLED"}
+            if keys & RELOAD_KEYS:
+                for key in sorted(keys & RELOAD_KEYS):
+                    ctrl.set(key, new_conf[key])
+                ctrl.reload()
+                expected["ssid[0]"] = new_conf["ssid"]
+            if keys & CHANNEL_KEYS:
+                switch_channel(ctrl, new_conf)
+                expected["channel"] = new_conf["channel"]
+            return ctrl.wait_for_status(expected)
+    except (HostapdCtrlError, KeyError, ValueError):
+        return False
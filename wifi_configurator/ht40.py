@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+"""HT40 (40MHz) primary/secondary channel pairs.
+
+A 40MHz channel is two adjacent 20MHz channels: the primary, which carries
+beacons and 20MHz traffic, and the secondary, 20MHz above (HT40+) or below
+(HT40-) it.  hostapd is told which with the [HT40+] or [HT40-] ht_capab
+flag, so at most one of them may be in the rendered ht_capab.
+
+Before starting a 40MHz BSS, an access point has to check that it won't
+upset its neighbours (802.11n 20/40 BSS coexistence):
+
+- 2.4GHz: every BSS with a primary or secondary channel within 25MHz of
+  the centre of the 40MHz channel must be a 20MHz BSS on our primary, or a
+  40MHz BSS with our primary and secondary.
+- 5GHz: our secondary mustn't be the primary channel of another BSS.
+
+Otherwise the access point has to run at 20MHz.  The 40MHz intolerant bit
+isn't checked, as scans don't record it; hostapd checks it again anyway.
+"""
+
+import collections
+from wifi_configurator import bss
+from wifi_configurator import spectrum
+
+
+HT40_PLUS = "[HT40+]"
+HT40_MINUS = "[HT40-]"
+HT40_FLAGS = (HT40_PLUS, HT40_MINUS)
+
+# Distance (MHz) from the 40MHz channel centre in which 2.4GHz BSSes have to
+#  be compatible
+AFFECTED_RANGE_MHZ = 25
+
+ChannelPair = collections.namedtuple("ChannelPair", [
+    "primary",    # int, 20MHz channel number
+    "secondary",  # int, 20MHz channel number, 4 above or below the primary
+])
+
+
+def ht_capab_flag(pair):
+    """Return the ht_capab flag selecting pair's secondary channel."""
+    return HT40_PLUS if pair.secondary > pair.primary else HT40_MINUS
+
+
+def centre_channel(pair):
+    """Return the channel number of the centre of pair's 40MHz channel."""
+    return (pair.primary + pair.secondary) // 2
+
+
+def channel_pairs(centres):
+    """Return both pairs for each 40MHz channel centre.
+
+    Parameters
+    ----------
+    centres : iterable of int
+        40MHz centre channel numbers, as from spectrum.legal_channels().
+
+    Returns
+    -------
+    list of ChannelPair
+        The HT40+ pair (primary below the centre) then the HT40- pair for
+        each centre, in order.
+    """
+    pairs = []
+    for centre in centres:
+        pairs.append(ChannelPair(centre - 2, centre + 2))
+        pairs.append(ChannelPair(centre + 2, centre - 2))
+    return pairs
+
+
+def supported_flags(ht_capab):
+    """Return the HT40 flags in an adapter's ht_capab, as a tuple."""
+    return tuple(flag for flag in HT40_FLAGS if flag in ht_capab)
+
+
+def with_ht40_flag(ht_capab, pair):
+    """Return ht_capab with only the HT40 flag for pair.
+
+    Parameters
+    ----------
+    ht_capab : str
+        The adapter's ht_capab, e.g. '[HT20][HT40-][HT40+][SHORT-GI-20]'.
+    pair : ChannelPair or None
+        None for a 20MHz channel, which removes both HT40 flags.
+    """
+    for flag in HT40_FLAGS:
+        ht_capab = ht_capab.replace(flag, "")
+    if pair is None:
+        return ht_capab
+    return ht_capab + ht_capab_flag(pair)
+
+
+def coexistence_permits(pair, band, scan_result):
+    """Return whether the BSSes in scan_result allow a 40MHz BSS on pair.
+
+    Parameters
+    ----------
+    pair : ChannelPair
+    band : str
+        One of spectrum.BANDS.
+    scan_result : ScanResult
+        BSSes outside band are ignored.
+    """
+    primary = spectrum.channel_to_freq(band, pair.primary)
+    secondary = spectrum.channel_to_freq(band, pair.secondary)
+    centre = (primary + secondary) / 2
+    for freq, offset in zip(scan_result.freqs,
+                            scan_result.ht_secondary_offsets):
+        if spectrum.freq_band(freq) != band:
+            continue
+        other_secondary = 0
+        if offset != bss.SECONDARY_NONE:
+            other_secondary = freq + offset * bss.SUBCHANNEL_WIDTH_MHZ
+        if band == spectrum.BAND_5GHZ:
+            if freq == secondary:
+                return False
+            continue
+        if abs(freq - centre) > AFFECTED_RANGE_MHZ and \
+                abs(other_secondary - centre) > AFFECTED_RANGE_MHZ:
+            continue
+        if other_secondary:
+            if (freq, other_secondary) != (primary, secondary):
+                return False
+        elif freq != primary:
+            return False
+    return True
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+"""Signal-weighted adjacent-channel interference scoring.
+
+2.4GHz channels are 5MHz apart but each transmission is 20MHz wide, so a
+strong AP on channel 6 interferes with everything from channel 3 to 9, not
+just channel 6.  Each candidate channel is given a cost: the received power
+(in mW) of every observed BSS, weighted by how much of the BSS's 20MHz
+spectral mask overlaps the candidate's.
+
+Received power is summed per frequency first (see
+ScanResult.power_mw_per_freq()), so scoring is a channels × frequencies
+calculation no matter how many BSSes were heard.
+"""
+
+import math
+from wifi_configurator import spectrum
+
+
+CHANNEL_WIDTH_MHZ = 20
+
+
+def dbm_to_mw(dbm):
+    """Convert a signal strength in dBm to milliwatts."""
+    return math.pow(10, dbm / 10)
+
+
+def spectral_overlap(freq_a, freq_b, width_mhz=CHANNEL_WIDTH_MHZ):
+    """Return the fraction (0 to 1) of two equal-width channels that overlaps.
+
+    Parameters
+    ----------
+    freq_a, freq_b : int
+        Channel centre frequencies in MHz.
+    width_mhz : int
+        Occupied bandwidth of each channel.
+
+    Returns
+    -------
+    float
+        1.0 for co-channel, falling linearly to 0.0 once the centres are
+        width_mhz or more apart.
+    """
+    return max(0.0, 1 - abs(freq_a - freq_b) / width_mhz)
+
+
+def channel_costs(candidate_channels, power_mw_per_freq,
+                  width_mhz=CHANNEL_WIDTH_MHZ, band=spectrum.BAND_2GHZ):
+    """Return {channel: interference cost in mW} for each candidate channel.
+
+    Parameters
+    ----------
+    candidate_channels : iterable of int
+        20MHz channel numbers to score. Channels not in band are skipped.
+    power_mw_per_freq : dict
+        {freq_MHz: total received power in mW on that frequency}.
+    width_mhz : int
+        Occupied bandwidth of the candidate and observed channels.
+    band : str
+        One of spectrum.BANDS.
+
+    Returns
+    -------
+    dict
+        Cost per channel; 0.0 means no observed BSS overlaps it at all.
+    """
+    costs = {}
+    known_channels = spectrum.band_channels(band)
+    for channel in candidate_channels:
+        if channel not in known_channels:
+            continue
+        candidate_freq = spectrum.channel_to_freq(band, channel)
+        costs[channel] = sum(
+            power_mw * spectral_overlap(candidate_freq, freq, width_mhz)
+            for freq, power_mw in power_mw_per_freq.items()
+        )
+    return costs
+
+
+def rank_channels(candidate_channels, power_mw_per_freq,
+                  width_mhz=CHANNEL_WIDTH_MHZ, band=spectrum.BAND_2GHZ,
+                  penalties_mw=None):
+    """Return [(channel, cost_mW), ...], least interfered-with first.
+
+    Channels with equal cost keep their order in candidate_channels, so the
+    ranking is deterministic.  penalties_mw ({channel: mW}) is added to the
+    cost of those channels for ranking, but not to the costs returned.
+    """
+    penalties_mw = penalties_mw or {}
+    costs = channel_costs(candidate_channels, power_mw_per_freq, width_mhz,
+                          band)
+    return sorted(costs.items(), key=lambda channel_cost: (
+        channel_cost[1] + penalties_mw.get(channel_cost[0], 0)))
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+"""Deferred imports, and what imports cost.
+
+The configurator runs at boot, often on a Pi Zero, where starting Python
+and importing click, jinja2, configobj and pyric takes a noticeable part of
+bringing the access point up.  Most runs need only some of them (--help
+needs none), so modules import the heavy ones with lazy_import(), which
+returns a module object that's loaded the first time one of its attributes
+is used.  Call sites and monkeypatching in tests are unchanged.
+
+import_times() measures imports with python -X importtime, which is what
+`wifi_configurator --import-times` reports.  A lazily imported module is
+loaded outside of any import statement, so -X importtime can't attribute
+its cost; setting WIFI_CONFIGURATOR_EAGER_IMPORTS makes lazy_import() an
+ordinary import so that every module's cost is measured.
+"""
+
+import collections
+import importlib.util
+import os
+import sys
+
+
+EAGER_IMPORTS_ENV = "WIFI_CONFIGURATOR_EAGER_IMPORTS"
+# What the console script imports before parsing the command line
+CLI_MODULE = "wifi_configurator.cli"
+# The modules main() imports on its way to rendering hostapd.conf, after
+#  the cli module itself
+MAIN_PATH_MODULES = (
+    CLI_MODULE,
+    "wifi_configurator.adapters",
+    "wifi_configurator.config_files",
+    "wifi_configurator.discovery",
+    "wifi_configurator.hostapd_ctrl",
+    "wifi_configurator.ht40",
+    "wifi_configurator.scan",
+    "wifi_configurator.services",
+    "wifi_configurator.spectrum",
+    "wifi_configurator.templates",
+    "configobj",
+    "jinja2",
+    "pyric.pyw",
+)
+
+ImportTime = collections.namedtuple("ImportTime", [
+    "module",         # str
+    "self_us",        # int, time spent in the module itself (microseconds)
+    "cumulative_us",  # int, including the modules it imported
+    "depth",          # int, 0 for modules imported by the measured code
+])
+
+
+def lazy_import(name):
+    """Return module name, deferring loading it until it's used.
+
+    Parameters
+    ----------
+    name : str
+        Absolute module name, e.g. 'pyric.pyw'. Parent packages are
+        imported immediately.
+
+    Returns
+    -------
+    module
+        The module itself if it's already imported.
+
+    Raises
+    ------
+    ImportError
+        If there's no such module.
+    """
+    try:
+        return sys.modules[name]
+    except KeyError:
+        pass
+    if os.environ.get(EAGER_IMPORTS_ENV):
+        return importlib.import_module(name)
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError("No module named %r" % (name,), name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    parent, _, child = name.rpartition(".")
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+def parse_importtime(output):
+    """Parse python -X importtime output.
+
+    Parameters
+    ----------
+    output : str
+        What -X importtime wrote to stderr.
+
+    Returns
+    -------
+    list of ImportTime
+        In the order the imports finished. Lines that aren't import times
+        (e.g. the header) are skipped.
+    """
+    times = []
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        try:
+            self_us, cumulative_us, name = \
+                line[len("import time:"):].split("|")
+            self_us = int(self_us)
+            cumulative_us = int(cumulative_us)
+        except ValueError:
+            continue
+        module = name.strip()
+        # Nested imports are indented by two spaces per level, after the
+        #  one space separating the columns
+        depth = (len(name.rstrip()) - len(module) - 1) // 2
+        times.append(ImportTime(module, self_us, cumulative_us, depth))
+    return times
+
+
+def import_times(modules, eager=False):
+    """Import modules, in order, in a fresh interpreter and time them.
+
+    Parameters
+    ----------
+    modules : iterable of str
+    eager : bool
+        Whether lazy_import() imports immediately, so that the cost of
+        every module the imports could need is measured.
+
+    Returns
+    -------
+    list of ImportTime
+        Every module the interpreter imported, including site and the
+        other modules loaded at startup.
+
+    Raises
+    ------
+    RuntimeError
+        If any of the imports fail.
+    """
+    import subprocess
+    modules = list(modules)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(p for p in sys.path if p)
+    env.pop(EAGER_IMPORTS_ENV, None)
+    if eager:
+        env[EAGER_IMPORTS_ENV] = "1"
+    code = "".join("import %s\n" % (module,) for module in modules)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env,
+        universal_newlines=True)
+    if result.returncode:
+        raise RuntimeError("Unable to import %s: %s" % (
+            ", ".join(modules), result.stderr.strip().splitlines()[-1]))
+    return parse_importtime(result.stderr)
+
+
+def cumulative_us(times, module):
+    """Return the cumulative import time of module, or 0 if not in times."""
+    for import_time in times:
+        if import_time.module == module:
+            return import_time.cumulative_us
+    return 0
+
+
+def package_costs(times):
+    """Return the total time spent importing each package, costliest first.
+
+    Parameters
+    ----------
+    times : iterable of ImportTime
+
+    Returns
+    -------
+    list of (str, int)
+        (package, microseconds) pairs.  Each of this package's modules is
+        counted separately, and other modules count towards their top level
+        package, e.g. jinja2.environment towards jinja2.
+    """
+    own_package = __name__.split(".")[0]
+    costs = collections.Counter()
+    for import_time in times:
+        parts = import_time.module.split(".")
+        package = ".".join(
+            parts[:2] if parts[0] == own_package else parts[:1])
+        costs[package] += import_time.self_us
+    return costs.most_common()
+
+
+def format_report(cold_start_us, times, limit=15):
+    """Return a human readable summary of import times.
+
+    Parameters
+    ----------
+    cold_start_us : int
+        How long importing the cli module takes.
+    times : list of ImportTime
+        Eager imports of everything main() uses.
+    limit : int
+        How many packages to list.
+    """
+    costs = package_costs(times)
+    lines = ["Cold start (imports for --help): %.1fms" %
+             (cold_start_us / 1000,),
+             "Imports main() may need, by package:"]
+    for package, cost_us in costs[:limit]:
+        lines.append("%8.1fms  %s" % (cost_us / 1000, package))
+    lines.append("%8.1fms  %s" % (sum(cost for _, cost in costs) / 1000,
+                                  "total, including interpreter startup"))
+    return "\n".join(lines)
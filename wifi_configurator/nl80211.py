@@ -0,0 +1,513 @@
+# -*- coding: utf-8 -*-
+
+"""Minimal nl80211 client for scans and wiphy (radio) capabilities.
+
+pyric covers the single request/response commands we use elsewhere
+(pyw.getcard, pyw.isup), but its libnl can't follow multi-part dumps or
+listen on multicast groups, both of which a scan needs.  This module speaks
+generic netlink directly over an AF_NETLINK socket, reusing pyric's
+netlink/genetlink/nl80211 constant definitions.
+
+Scan results are returned as bss.BSS records, the same as the 'iw dev scan'
+text parser produces, so everything downstream is backend-agnostic.
+"""
+
+import collections
+import errno
+import os
+import socket
+import struct
+import time
+import pyric.net.netlink_h as nlh
+import pyric.net.genetlink_h as genlh
+import pyric.net.wireless.nl80211_h as nl80211h
+from wifi_configurator import bss
+
+
+SOL_NETLINK = getattr(socket, "SOL_NETLINK", 270)
+RECV_BUFSZ = 65536
+# Generous, but triggering a scan and dumping results are normally < 5s
+DEFAULT_TIMEOUT_S = 10
+
+# struct nlmsghdr, struct genlmsghdr and struct nlattr
+_NLMSGHDR = struct.Struct("=LHHLL")
+_GENLMSGHDR = struct.Struct("=BBH")
+_NLATTR = struct.Struct("=HH")
+
+# 802.11 information element ids
+IE_SSID = 0
+IE_COUNTRY = 7
+IE_HT_OPERATION = 61
+IE_VHT_OPERATION = 192
+
+# HT operation element, 'secondary channel offset' field
+_HT_SECONDARY_OFFSETS = {
+    1: bss.SECONDARY_ABOVE,
+    3: bss.SECONDARY_BELOW,
+}
+
+
+# A wiphy's capabilities, from NL80211_CMD_GET_WIPHY
+Wiphy = collections.namedtuple("Wiphy", [
+    "index",    # int, phy index, as in phy0
+    "name",     # str, e.g. 'phy0'
+    "bands",    # dict, {NL80211_BAND_*: Band}
+    "iftypes",  # frozenset of supported NL80211_IFTYPE_* interface modes
+])
+
+Band = collections.namedtuple("Band", [
+    "ht_capa",   # int, HT capabilities info field, None if no HT
+    "vht_capa",  # int, VHT capabilities info field, None if no VHT
+])
+
+
+class NL80211Error(EnvironmentError):
+    """An nl80211 request failed, or netlink isn't usable on this system."""
+
+
+def _align(length):
+    return nlh.NLMSG_ALIGN(length)
+
+
+def pack_nla(attr_type, payload):
+    """Return a single netlink attribute (header, payload and padding)."""
+    length = _NLATTR.size + len(payload)
+    return _NLATTR.pack(length, attr_type) + payload + \
+        b"\0" * (_align(length) - length)
+
+
+def pack_nla_u32(attr_type, value):
+    return pack_nla(attr_type, struct.pack("=L", value))
+
+
+def pack_nla_string(attr_type, value):
+    return pack_nla(attr_type, value.encode("ascii") + b"\0")
+
+
+def pack_genlmsg(family_id, cmd, attrs=b"", flags=nlh.NLM_F_REQUEST,
+                 seq=0, pid=0):
+    """Return a generic netlink message: nlmsghdr + genlmsghdr + attrs."""
+    payload = _GENLMSGHDR.pack(cmd, 1, 0) + attrs
+    return _NLMSGHDR.pack(_NLMSGHDR.size + len(payload),
+                          family_id, flags, seq, pid) + payload
+
+
+def iter_nla(data):
+    """Yield (type, payload) for each netlink attribute in data."""
+    offset = 0
+    while offset + _NLATTR.size <= len(data):
+        length, attr_type = _NLATTR.unpack_from(data, offset)
+        if length < _NLATTR.size:
+            break
+        yield (attr_type & nlh.NLA_TYPE_MASK,
+               data[offset + _NLATTR.size:offset + length])
+        offset += _align(length)
+
+
+def nla_dict(data):
+    """Return {type: payload} for the netlink attributes in data."""
+    return dict(iter_nla(data))
+
+
+def iter_nlmsg(data):
+    """Yield (type, flags, seq, payload) for each netlink message in data."""
+    offset = 0
+    while offset + _NLMSGHDR.size <= len(data):
+        length, msg_type, flags, seq, _ = \
+            _NLMSGHDR.unpack_from(data, offset)
+        if length < _NLMSGHDR.size:
+            break
+        yield msg_type, flags, seq, data[offset + _NLMSGHDR.size:
+                                         offset + length]
+        offset += _align(length)
+
+
+def _u32(payload):
+    return struct.unpack_from("=L", payload)[0]
+
+
+def _s32(payload):
+    return struct.unpack_from("=l", payload)[0]
+
+
+def _u16(payload):
+    return struct.unpack_from("=H", payload)[0]
+
+
+def iter_ies(data):
+    """Yield (element_id, body) for each 802.11 information element."""
+    offset = 0
+    while offset + 2 <= len(data):
+        element_id, length = data[offset], data[offset + 1]
+        yield element_id, data[offset + 2:offset + 2 + length]
+        offset += 2 + length
+
+
+def bss_from_attrs(bss_attrs):
+    """Build a bss.BSS record from the nested NL80211_ATTR_BSS attributes.
+
+    Parameters
+    ----------
+    bss_attrs : dict
+        {NL80211_BSS_*: payload}, as returned by nla_dict().
+
+    Returns
+    -------
+    bss.BSS
+    """
+    fields = {
+        "bssid": ":".join(
+            "%02x" % (octet,)
+            for octet in bss_attrs.get(nl80211h.NL80211_BSS_BSSID, b"")),
+        "freq": 0,
+        "signal": 0.0,
+        "country": "",
+        "ssid": "",
+        "last_seen_ms": 0,
+        "ht_primary_channel": 0,
+        "ht_secondary_offset": bss.SECONDARY_NONE,
+        "ht_sta_channel_width": 0,
+        "vht_channel_width": bss.VHT_WIDTH_20_40,
+        "vht_center_seg1": 0,
+        "vht_center_seg2": 0,
+    }
+    if nl80211h.NL80211_BSS_FREQUENCY in bss_attrs:
+        fields["freq"] = _u32(bss_attrs[nl80211h.NL80211_BSS_FREQUENCY])
+    if nl80211h.NL80211_BSS_SIGNAL_MBM in bss_attrs:
+        # mBm (hundredths of a dBm)
+        fields["signal"] = \
+            _s32(bss_attrs[nl80211h.NL80211_BSS_SIGNAL_MBM]) / 100.0
+    if nl80211h.NL80211_BSS_SEEN_MS_AGO in bss_attrs:
+        fields["last_seen_ms"] = \
+            _u32(bss_attrs[nl80211h.NL80211_BSS_SEEN_MS_AGO])
+
+    # Probe response IEs are preferred, as they are what iw shows too
+    ies = bss_attrs.get(nl80211h.NL80211_BSS_INFORMATION_ELEMENTS) or \
+        bss_attrs.get(nl80211h.NL80211_BSS_BEACON_IES, b"")
+    for element_id, body in iter_ies(ies):
+        if element_id == IE_SSID:
+            fields["ssid"] = body.decode("utf-8", "replace")
+        elif element_id == IE_COUNTRY and len(body) >= 2:
+            fields["country"] = body[:2].decode("ascii", "replace")
+        elif element_id == IE_HT_OPERATION and len(body) >= 2:
+            fields["ht_primary_channel"] = body[0]
+            fields["ht_secondary_offset"] = \
+                _HT_SECONDARY_OFFSETS.get(body[1] & 0x03, bss.SECONDARY_NONE)
+            fields["ht_sta_channel_width"] = 40 if body[1] & 0x04 else 20
+        elif element_id == IE_VHT_OPERATION and len(body) >= 3:
+            fields["vht_channel_width"] = body[0]
+            fields["vht_center_seg1"] = body[1]
+            fields["vht_center_seg2"] = body[2]
+    return bss.BSS(**fields)
+
+
+class NL80211Socket:
+    """A generic netlink socket bound to the nl80211 family.
+
+    Parameters
+    ----------
+    sock : socket-like, optional
+        Anything with send(), recv(), settimeout(), setsockopt() and close().
+        Defaults to a new AF_NETLINK/NETLINK_GENERIC socket; tests pass a
+        stand-in that replays recorded kernel messages.
+    family_id : int, optional
+        nl80211 family id. Looked up from the generic netlink controller if
+        not given.
+    mcast_groups : dict, optional
+        {group name: group id}. Looked up along with family_id.
+    """
+
+    def __init__(self, sock=None, family_id=None, mcast_groups=None):
+        if sock is None:
+            try:
+                sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                     nlh.NETLINK_GENERIC)
+                sock.bind((0, 0))
+            except (AttributeError, OSError) as e:
+                raise NL80211Error(getattr(e, "errno", errno.ENOTSUP),
+                                   "netlink unavailable: %s" % (e,))
+        self.sock = sock
+        self.seq = int(time.time())
+        if family_id is None:
+            try:
+                family_id, mcast_groups = self._resolve_family()
+            except NL80211Error:
+                self.close()
+                raise
+        self.family_id = family_id
+        self.mcast_groups = mcast_groups or {}
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def send(self, family_id, cmd, attrs=b"", flags=nlh.NLM_F_REQUEST):
+        """Send a request and return its sequence number."""
+        self.seq += 1
+        self.sock.send(pack_genlmsg(family_id, cmd, attrs, flags, self.seq))
+        return self.seq
+
+    def recv_messages(self, deadline=None):
+        """Yield (type, flags, seq, payload) for received messages forever.
+
+        Raises NL80211Error(ETIMEDOUT) once deadline passes.
+        """
+        while True:
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise NL80211Error(errno.ETIMEDOUT, "nl80211 timed out")
+                self.sock.settimeout(remaining)
+            try:
+                data = self.sock.recv(RECV_BUFSZ)
+            except socket.timeout:
+                raise NL80211Error(errno.ETIMEDOUT, "nl80211 timed out")
+            for message in iter_nlmsg(data):
+                yield message
+
+    def request(self, family_id, cmd, attrs=b"", dump=False, deadline=None):
+        """Send a request and yield the genl payload of each reply.
+
+        Stops at the ack (or NLMSG_DONE for dumps).  A non-zero ack raises
+        NL80211Error with the kernel's errno, e.g. EBUSY when a scan is
+        already running.
+        """
+        flags = nlh.NLM_F_REQUEST | nlh.NLM_F_ACK
+        if dump:
+            flags |= nlh.NLM_F_DUMP
+        seq = self.send(family_id, cmd, attrs, flags)
+        for msg_type, _, msg_seq, payload in self.recv_messages(deadline):
+            if msg_seq != seq:
+                continue
+            if msg_type == nlh.NLMSG_DONE:
+                return
+            if msg_type == nlh.NLMSG_ERROR:
+                error = -_s32(payload)
+                if error:
+                    raise NL80211Error(error, os.strerror(error))
+                return
+            yield payload[_GENLMSGHDR.size:]
+
+    def _resolve_family(self):
+        """Return (family_id, {mcast group name: id}) for nl80211."""
+        attrs = pack_nla_string(genlh.CTRL_ATTR_FAMILY_NAME,
+                                nl80211h.NL80211_GENL_NAME)
+        deadline = time.monotonic() + DEFAULT_TIMEOUT_S
+        for payload in self.request(genlh.GENL_ID_CTRL,
+                                    genlh.CTRL_CMD_GETFAMILY, attrs,
+                                    deadline=deadline):
+            family_attrs = nla_dict(payload)
+            family_id = struct.unpack_from(
+                "=H", family_attrs[genlh.CTRL_ATTR_FAMILY_ID])[0]
+            groups = {}
+            for _, group in iter_nla(
+                    family_attrs.get(genlh.CTRL_ATTR_MCAST_GROUPS, b"")):
+                group_attrs = nla_dict(group)
+                name = group_attrs[genlh.CTRL_ATTR_MCAST_GRP_NAME]
+                groups[name.rstrip(b"\0").decode("ascii")] = \
+                    _u32(group_attrs[genlh.CTRL_ATTR_MCAST_GRP_ID])
+            return family_id, groups
+        raise NL80211Error(errno.ENOENT, "nl80211 family not found")
+
+    def join_group(self, name):
+        """Subscribe to an nl80211 multicast group, e.g. 'scan'."""
+        try:
+            group_id = self.mcast_groups[name]
+        except KeyError:
+            raise NL80211Error(errno.ENOENT,
+                               "No nl80211 multicast group %s" % (name,))
+        self.sock.setsockopt(SOL_NETLINK, nlh.NETLINK_ADD_MEMBERSHIP,
+                             group_id)
+
+    def trigger_scan(self, ifindex, deadline=None):
+        """Ask the kernel to start a scan on ifindex (NL80211_CMD_TRIGGER_SCAN).
+
+        Like iw, this asks for the wildcard (zero length) SSID, so the scan
+        is active: without any NL80211_ATTR_SCAN_SSIDS the kernel only
+        listens for beacons, which misses APs on quieter channels.
+        """
+        attrs = pack_nla_u32(nl80211h.NL80211_ATTR_IFINDEX, ifindex) + \
+            pack_nla(nl80211h.NL80211_ATTR_SCAN_SSIDS | nlh.NLA_F_NESTED,
+                     pack_nla(1, b""))
+        for _ in self.request(self.family_id,
+                              nl80211h.NL80211_CMD_TRIGGER_SCAN, attrs,
+                              deadline=deadline):
+            pass
+
+    def wait_for_scan(self, ifindex, deadline=None):
+        """Block until the scan on ifindex completes.
+
+        The socket must have joined the 'scan' multicast group before the
+        scan was triggered, or the completion event may be missed.
+
+        Returns True when NL80211_CMD_NEW_SCAN_RESULTS arrives, or False if
+        the kernel sent NL80211_CMD_SCAN_ABORTED.
+        """
+        for msg_type, _, _, payload in self.recv_messages(deadline):
+            if msg_type != self.family_id:
+                continue
+            cmd = payload[0]
+            attrs = nla_dict(payload[_GENLMSGHDR.size:])
+            if nl80211h.NL80211_ATTR_IFINDEX in attrs and \
+                    _u32(attrs[nl80211h.NL80211_ATTR_IFINDEX]) != ifindex:
+                continue
+            if cmd == nl80211h.NL80211_CMD_NEW_SCAN_RESULTS:
+                return True
+            if cmd == nl80211h.NL80211_CMD_SCAN_ABORTED:
+                return False
+        return False
+
+    def iter_scan_results(self, ifindex, deadline=None):
+        """Yield a bss.BSS for each entry in the kernel's BSS table.
+
+        This is the NL80211_CMD_GET_SCAN dump, i.e. the same as
+        'iw dev <if> scan dump'.
+        """
+        attrs = pack_nla_u32(nl80211h.NL80211_ATTR_IFINDEX, ifindex)
+        for payload in self.request(self.family_id,
+                                    nl80211h.NL80211_CMD_GET_SCAN, attrs,
+                                    dump=True, deadline=deadline):
+            bss_payload = nla_dict(payload).get(nl80211h.NL80211_ATTR_BSS)
+            if bss_payload is not None:
+                yield bss_from_attrs(nla_dict(bss_payload))
+
+    def get_wiphy(self, phy_index, deadline=None):
+        """Return the Wiphy for phy_index, or None if there's no such wiphy.
+
+        Uses a split dump (NL80211_ATTR_SPLIT_WIPHY_DUMP), as an unsplit
+        reply leaves out the VHT capabilities of some drivers.
+        """
+        attrs = pack_nla_u32(nl80211h.NL80211_ATTR_WIPHY, phy_index) + \
+            pack_nla(nl80211h.NL80211_ATTR_SPLIT_WIPHY_DUMP, b"")
+        return wiphy_from_payloads(
+            self.request(self.family_id, nl80211h.NL80211_CMD_GET_WIPHY,
+                         attrs, dump=True, deadline=deadline),
+            phy_index)
+
+
+def wiphy_from_payloads(payloads, phy_index):
+    """Build a Wiphy from the messages of a split NL80211_CMD_GET_WIPHY dump.
+
+    A split dump spreads a wiphy, and even a single band, over several
+    messages, so attributes are merged as they arrive.  Messages for other
+    wiphys are ignored.
+
+    Returns
+    -------
+    Wiphy or None
+        None if none of the messages were for phy_index.
+    """
+    name = None
+    ht_capas = {}
+    vht_capas = {}
+    iftypes = set()
+    found = False
+    for payload in payloads:
+        attrs = nla_dict(payload)
+        if nl80211h.NL80211_ATTR_WIPHY not in attrs or \
+                _u32(attrs[nl80211h.NL80211_ATTR_WIPHY]) != phy_index:
+            continue
+        found = True
+        if nl80211h.NL80211_ATTR_WIPHY_NAME in attrs:
+            name = attrs[nl80211h.NL80211_ATTR_WIPHY_NAME].rstrip(
+                b"\0").decode("ascii", "replace")
+        for band_id, band in iter_nla(
+                attrs.get(nl80211h.NL80211_ATTR_WIPHY_BANDS, b"")):
+            ht_capas.setdefault(band_id, None)
+            vht_capas.setdefault(band_id, None)
+            band_attrs = nla_dict(band)
+            if nl80211h.NL80211_BAND_ATTR_HT_CAPA in band_attrs:
+                ht_capas[band_id] = _u16(
+                    band_attrs[nl80211h.NL80211_BAND_ATTR_HT_CAPA])
+            if nl80211h.NL80211_BAND_ATTR_VHT_CAPA in band_attrs:
+                vht_capas[band_id] = _u32(
+                    band_attrs[nl80211h.NL80211_BAND_ATTR_VHT_CAPA])
+        iftypes.update(iftype for iftype, _ in iter_nla(
+            attrs.get(nl80211h.NL80211_ATTR_SUPPORTED_IFTYPES, b"")))
+    if not found:
+        return None
+    return Wiphy(phy_index, name or "phy%d" % (phy_index,),
+                 {band_id: Band(ht_capas[band_id], vht_capas[band_id])
+                  for band_id in ht_capas},
+                 frozenset(iftypes))
+
+
+def get_wiphy(phy_index, timeout=DEFAULT_TIMEOUT_S):
+    """Return the capabilities of wiphy phy_index, as 'iw phy info' shows.
+
+    Raises
+    ------
+    NL80211Error
+        If netlink is unavailable, there's no such wiphy (ENODEV) or the
+        dump does not complete in time.
+    """
+    deadline = time.monotonic() + timeout
+    with NL80211Socket() as commands:
+        wiphy = commands.get_wiphy(phy_index, deadline)
+    if wiphy is None:
+        raise NL80211Error(errno.ENODEV, "No wiphy phy%d" % (phy_index,))
+    return wiphy
+
+
+def iter_scan(ifindex, timeout=DEFAULT_TIMEOUT_S):
+    """Trigger a scan on ifindex, wait for it to finish and yield its BSSes.
+
+    Parameters
+    ----------
+    ifindex : int
+        Interface index, e.g. pyw.getcard(dev).idx.
+    timeout : float
+        Seconds allowed for the whole trigger/wait/dump sequence.
+
+    Yields
+    ------
+    bss.BSS
+
+    If the kernel refuses the trigger with EBUSY because another scan (e.g.
+    wpa_supplicant's) is already running, we wait for that scan's completion
+    event instead and use its results.
+
+    Raises
+    ------
+    NL80211Error
+        If netlink is unavailable, the trigger is refused for any reason
+        other than EBUSY, the scan is aborted (ECANCELED) or does not
+        complete in time (ETIMEDOUT).
+    """
+    deadline = time.monotonic() + timeout
+    with NL80211Socket() as events, NL80211Socket(
+            family_id=events.family_id,
+            mcast_groups=events.mcast_groups) as commands:
+        # Join before triggering so the completion event can't be missed
+        events.join_group(nl80211h.NL80211_MULTICAST_GROUP_SCAN)
+        try:
+            commands.trigger_scan(ifindex, deadline)
+        except NL80211Error as e:
+            if e.errno != errno.EBUSY:
+                raise
+        if not events.wait_for_scan(ifindex, deadline):
+            raise NL80211Error(errno.ECANCELED, "Scan aborted")
+        for record in commands.iter_scan_results(ifindex, deadline):
+            yield record
+
+
+def iter_scan_dump(ifindex, timeout=DEFAULT_TIMEOUT_S):
+    """Yield the BSSes the kernel already holds for ifindex, without scanning.
+
+    Equivalent to 'iw dev <if> scan dump'.  Each record's last_seen_ms says
+    how stale it is.
+
+    Raises
+    ------
+    NL80211Error
+        If netlink is unavailable or the dump does not complete in time.
+    """
+    deadline = time.monotonic() + timeout
+    with NL80211Socket() as commands:
+        for record in commands.iter_scan_results(ifindex, deadline):
+            yield record
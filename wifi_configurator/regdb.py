@@ -0,0 +1,533 @@
+# -*- coding: utf-8 -*-
+
+"""Indexed access to the wireless regulatory database.
+
+The kernel's regulatory.db (FirmwareRegDB) and CRDA's older
+regulatory.bin (CRDARegDB) are read directly: the file is memory-mapped
+and only the requested country's rules are decoded, so no helper process
+is forked and the rest of the database is never touched.  Signatures are
+not checked.  Whichever database is installed is used, preferring
+regulatory.db.
+
+If neither reader understands the file, the database is decoded with regdbdump and
+the text parsed into a dict of country code → Country (RegDB).  Either
+way, looking up a country can't match the wrong one, and get_regdb() keeps
+the database for the life of the process until the file changes.
+
+regdbdump prints each country as a header line followed by one line per
+rule, e.g.:
+
+    country AU: DFS-ETSI
+        (2402.000 - 2482.000 @ 40.000), (20.00), (N/A)
+        (5250.000 - 5330.000 @ 80.000), (24.00), (N/A), DFS, AUTO-BW
+
+i.e. (start - end @ max bandwidth) in MHz, (max EIRP) in dBm or mW,
+(DFS CAC time) in ms, then any flags.
+"""
+
+import collections
+import math
+import mmap
+import os
+import struct
+import click
+from wifi_configurator import lazy
+
+# Only needed for databases the readers don't understand
+subprocess = lazy.lazy_import("subprocess")
+
+
+REGULATORY_DB = "/lib/firmware/regulatory.db"
+REGULATORY_BIN = "/lib/crda/regulatory.bin"
+# In order of preference
+REGULATORY_DATABASES = (REGULATORY_DB, REGULATORY_BIN)
+REGDBDUMP = "/sbin/regdbdump"
+
+# Rule flags, as printed by regdbdump
+FLAG_NO_OFDM = "NO-OFDM"
+FLAG_NO_CCK = "NO-CCK"
+FLAG_NO_INDOOR = "NO-INDOOR"
+FLAG_NO_OUTDOOR = "NO-OUTDOOR"
+FLAG_DFS = "DFS"
+FLAG_PTP_ONLY = "PTP-ONLY"
+FLAG_PTMP_ONLY = "PTMP-ONLY"
+FLAG_NO_IR = "NO-IR"
+FLAG_AUTO_BW = "AUTO-BW"
+
+Rule = collections.namedtuple("Rule", [
+    "start_freq",     # float, MHz
+    "end_freq",       # float, MHz
+    "max_bandwidth",  # float, MHz
+    "max_eirp",       # float, dBm, or None if not given
+    "dfs_cac_ms",     # int, or None if not given
+    "flags",          # frozenset of FLAG_* strings
+])
+
+Country = collections.namedtuple("Country", [
+    "alpha2",      # str, e.g. 'AU', or '00' for the world domain
+    "dfs_region",  # str, e.g. 'DFS-ETSI'
+    "rules",       # tuple of Rule, in the order regdb lists them
+])
+
+# Parsed databases, keyed by the database file's path
+_regdb_cache = {}
+
+# Both binary formats start with 'RGDB'
+REGDB_MAGIC = 0x52474442
+CRDA_VERSION = 19
+
+# Indexed by the low two bits of a country's DFS requirements
+DFS_REGIONS = ("DFS-UNSET", "DFS-FCC", "DFS-ETSI", "DFS-JP")
+
+# regulatory.bin rule flag bits (CRDA's enum reg_rule_flags). NO-IBSS
+#  was merged into NO-IR
+_CRDA_FLAGS = (
+    (1 << 0, FLAG_NO_OFDM),
+    (1 << 1, FLAG_NO_CCK),
+    (1 << 2, FLAG_NO_INDOOR),
+    (1 << 3, FLAG_NO_OUTDOOR),
+    (1 << 4, FLAG_DFS),
+    (1 << 5, FLAG_PTP_ONLY),
+    (1 << 6, FLAG_PTMP_ONLY),
+    (1 << 7, FLAG_NO_IR),
+    (1 << 8, FLAG_NO_IR),
+    (1 << 11, FLAG_AUTO_BW),
+)
+
+# All regulatory.bin fields are big-endian, and pointers are file offsets
+_CRDA_HEADER = struct.Struct(">IIIII")  # magic, version, countries ptr,
+#                                          number of countries, sig length
+_CRDA_COUNTRY = struct.Struct(">2sxBI")  # alpha2, DFS reqs, collection ptr
+_CRDA_FREQ_RANGE = struct.Struct(">III")  # start, end, max bw (kHz)
+_CRDA_POWER_RULE = struct.Struct(">II")  # max antenna gain, max EIRP (mBm)
+_CRDA_RULE = struct.Struct(">III")  # freq range ptr, power rule ptr, flags
+_U32 = struct.Struct(">I")
+
+FWDB_VERSION = 20
+
+# regulatory.db rule flag bits (the kernel's enum fwdb_flags)
+_FWDB_FLAGS = (
+    (1 << 0, FLAG_NO_OFDM),
+    (1 << 1, FLAG_NO_OUTDOOR),
+    (1 << 2, FLAG_DFS),
+    (1 << 3, FLAG_NO_IR),
+    (1 << 4, FLAG_AUTO_BW),
+)
+
+# regulatory.db fields are big-endian too
+_FWDB_HEADER = struct.Struct(">II")  # magic, version
+_FWDB_COUNTRY = struct.Struct(">2sH")  # alpha2, collection ptr
+_FWDB_COLLECTION = struct.Struct(">BBB")  # length, rule count, DFS region
+_FWDB_RULE = struct.Struct(">BBHIII")  # length, flags, max EIRP (mBm),
+#                                         start, end, max bw (kHz)
+_U16 = struct.Struct(">H")
+
+
+def _parse_power(field):
+    """Parse '(20.00)', '(100 mW)' or '(N/A)' into dBm, or None."""
+    value = field.strip().strip("()").strip()
+    if value == "N/A" or not value:
+        return None
+    if value.endswith("mW"):
+        return 10 * math.log10(float(value[:-2]))
+    return float(value.split()[0])
+
+
+def parse_rule(line):
+    """Parse one regdbdump rule line into a Rule.
+
+    Raises
+    ------
+    ValueError
+        If line isn't a rule line.
+    """
+    line = line.strip()
+    if not line.startswith("("):
+        raise ValueError("Not a regdb rule: %r" % (line,))
+    freq_part, _, rest = line[1:].partition(")")
+    freqs, _, bandwidth = freq_part.partition("@")
+    start_freq, end_freq = [float(freq) for freq in freqs.split("-")]
+    fields = [field.strip() for field in rest.split(",") if field.strip()]
+    # Values are parenthesised; flags aren't
+    values = [field for field in fields if field.startswith("(")]
+    flags = frozenset(field for field in fields if not field.startswith("("))
+    max_eirp = _parse_power(values[0]) if values else None
+    dfs_cac_ms = None
+    if len(values) > 1 and values[1].strip("()") != "N/A":
+        dfs_cac_ms = int(values[1].strip("()"))
+    return Rule(start_freq, end_freq, float(bandwidth), max_eirp, dfs_cac_ms,
+                flags)
+
+
+def parse_country_header(line):
+    """Return (alpha2, dfs_region) for a 'country XX: DFS-...' line, or None."""
+    fields = line.split()
+    if len(fields) < 2 or fields[0] != "country" or \
+            not fields[1].endswith(":"):
+        return None
+    return fields[1][:-1], fields[2] if len(fields) > 2 else ""
+
+
+def parse_regdbdump(output):
+    """Parse regdbdump output into {alpha2: Country}.
+
+    Parameters
+    ----------
+    output : str or list of str
+        regdbdump stdout, or its lines.
+
+    Returns
+    -------
+    dict
+    """
+    if isinstance(output, str):
+        output = output.split("\n")
+    countries = {}
+    header = None
+    rules = []
+    for line in output:
+        if not line.strip():
+            continue
+        country = parse_country_header(line)
+        if country is not None:
+            if header is not None:
+                countries[header[0]] = Country(header[0], header[1],
+                                               tuple(rules))
+            header = country
+            rules = []
+        elif header is not None:
+            rules.append(parse_rule(line))
+    if header is not None:
+        countries[header[0]] = Country(header[0], header[1], tuple(rules))
+    return countries
+
+
+class RegDB:
+    """The regulatory database, indexed by country code.
+
+    Parameters
+    ----------
+    countries : dict
+        {alpha2: Country}, e.g. from parse_regdbdump().
+    """
+
+    def __init__(self, countries):
+        self.countries = countries
+
+    @classmethod
+    def from_regdbdump_output(cls, output):
+        """Build a RegDB from regdbdump's text output."""
+        return cls(parse_regdbdump(output))
+
+    @classmethod
+    def from_file(cls, path=REGULATORY_BIN, regdbdump=REGDBDUMP):
+        """Decode the database at path with regdbdump and parse it."""
+        regdump = subprocess.run([regdbdump, path], stdout=subprocess.PIPE,
+                                 check=True)
+        return cls.from_regdbdump_output(regdump.stdout.decode("utf-8"))
+
+    def __len__(self):
+        return len(self.countries)
+
+    def __contains__(self, alpha2):
+        return alpha2 in self.countries
+
+    def __repr__(self):
+        return "<RegDB: %d countries>" % (len(self),)
+
+    def country_codes(self):
+        """Return the country codes in the database."""
+        return list(self.countries)
+
+    def get(self, alpha2):
+        """Return the Country for alpha2, or None if it isn't listed."""
+        return self.countries.get(alpha2)
+
+    def rules(self, alpha2):
+        """Return the tuple of Rules for alpha2 (empty if it isn't listed)."""
+        country = self.countries.get(alpha2)
+        return country.rules if country is not None else ()
+
+
+def _decode_flags(flags, flag_bits):
+    """Return the frozenset of FLAG_* names for the bits set in flags."""
+    return frozenset(name for bit, name in flag_bits if flags & bit)
+
+
+def map_file(path):
+    """Return a read-only mmap of the file at path."""
+    with open(path, "rb") as db_file:
+        return mmap.mmap(db_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class BinaryRegDB:
+    """Base for the binary database readers, which decode on demand.
+
+    Subclasses parse their header in __init__ (raising ValueError if data
+    isn't in their format), then call _index_countries(), and implement
+    _iter_countries() and _decode_rules().
+
+    Parameters
+    ----------
+    data : bytes-like
+        The database, typically an mmap (see from_file()). Fields are
+        unpacked in place; nothing is decoded until it's asked for.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        # {alpha2: (alpha2, DFS region, collection ptr)}
+        self._countries = {}
+
+    @classmethod
+    def from_file(cls, path):
+        """Memory-map the database at path."""
+        return cls(map_file(path))
+
+    def __len__(self):
+        return sum(1 for _ in self._iter_countries())
+
+    def __contains__(self, alpha2):
+        return self._find(alpha2) is not None
+
+    def __repr__(self):
+        return "<%s: %d countries>" % (type(self).__name__, len(self))
+
+    def _iter_countries(self):
+        """Yield (alpha2, DFS region, collection ptr) for each country."""
+        raise NotImplementedError
+
+    def _decode_rules(self, collection_ptr):
+        """Return the tuple of Rules in the collection at collection_ptr."""
+        raise NotImplementedError
+
+    def _index_countries(self):
+        """Index the country list, so that lookups don't have to scan it.
+
+        Raises
+        ------
+        ValueError
+            If the list points outside the file.
+        """
+        try:
+            for country in self._iter_countries():
+                # The first entry wins, as it would in a scan of the list
+                self._countries.setdefault(country[0], country)
+        except struct.error as e:
+            raise ValueError("Corrupt country list: %s" % (e,))
+
+    def _find(self, alpha2):
+        return self._countries.get(alpha2)
+
+    def country_codes(self):
+        """Return the country codes in the database."""
+        return [country[0] for country in self._iter_countries()]
+
+    def get(self, alpha2):
+        """Return the Country for alpha2, or None if it isn't listed.
+
+        Raises
+        ------
+        ValueError
+            If the country's rules point outside the file.
+        """
+        country = self._find(alpha2)
+        if country is None:
+            return None
+        _, dfs_region, collection_ptr = country
+        try:
+            rules = self._decode_rules(collection_ptr)
+        except struct.error as e:
+            raise ValueError("Corrupt rules for %s: %s" % (alpha2, e))
+        return Country(alpha2, DFS_REGIONS[dfs_region & 0x03], rules)
+
+    def rules(self, alpha2):
+        """Return the tuple of Rules for alpha2 (empty if it isn't listed)."""
+        country = self.get(alpha2)
+        return country.rules if country is not None else ()
+
+
+class CRDARegDB(BinaryRegDB):
+    """Reader for CRDA's regulatory.bin.
+
+    Raises
+    ------
+    ValueError
+        If data isn't a regulatory.bin this reader understands.
+    """
+
+    def __init__(self, data):
+        super().__init__(data)
+        try:
+            magic, version, self._countries_ptr, self._country_num, \
+                signature_length = _CRDA_HEADER.unpack_from(data)
+        except struct.error as e:
+            raise ValueError("Truncated regulatory.bin: %s" % (e,))
+        if magic != REGDB_MAGIC or version != CRDA_VERSION:
+            raise ValueError("Not a version %d regulatory.bin" %
+                             (CRDA_VERSION,))
+        if self._countries_ptr + \
+                self._country_num * _CRDA_COUNTRY.size + \
+                signature_length > len(data):
+            raise ValueError("Truncated regulatory.bin country list")
+        self._index_countries()
+
+    @classmethod
+    def from_file(cls, path=REGULATORY_BIN):
+        return super().from_file(path)
+
+    def __len__(self):
+        return self._country_num
+
+    def _iter_countries(self):
+        for index in range(self._country_num):
+            alpha2, creqs, collection_ptr = _CRDA_COUNTRY.unpack_from(
+                self.data, self._countries_ptr + index * _CRDA_COUNTRY.size)
+            yield alpha2.decode("ascii", "replace"), creqs, collection_ptr
+
+    def _decode_rule(self, rule_ptr):
+        range_ptr, power_ptr, flags = _CRDA_RULE.unpack_from(self.data,
+                                                             rule_ptr)
+        start, end, max_bw = _CRDA_FREQ_RANGE.unpack_from(self.data,
+                                                          range_ptr)
+        _, max_eirp = _CRDA_POWER_RULE.unpack_from(self.data, power_ptr)
+        return Rule(start / 1000.0, end / 1000.0, max_bw / 1000.0,
+                    max_eirp / 100.0 if max_eirp else None, None,
+                    _decode_flags(flags, _CRDA_FLAGS))
+
+    def _decode_rules(self, collection_ptr):
+        rule_num, = _U32.unpack_from(self.data, collection_ptr)
+        return tuple(
+            self._decode_rule(_U32.unpack_from(
+                self.data, collection_ptr + (1 + index) * _U32.size)[0])
+            for index in range(rule_num)
+        )
+
+
+class FirmwareRegDB(BinaryRegDB):
+    """Reader for wireless-regdb's regulatory.db, as loaded by the kernel.
+
+    Pointers in this format are 16 bit offsets in units of 4 bytes, and
+    rules and collections carry their own length so that fields can be
+    appended in later versions.  The signature is in a separate .p7s file,
+    which isn't checked.
+
+    Raises
+    ------
+    ValueError
+        If data isn't a regulatory.db this reader understands.
+    """
+
+    def __init__(self, data):
+        super().__init__(data)
+        try:
+            magic, version = _FWDB_HEADER.unpack_from(data)
+        except struct.error as e:
+            raise ValueError("Truncated regulatory.db: %s" % (e,))
+        if magic != REGDB_MAGIC or version != FWDB_VERSION:
+            raise ValueError("Not a version %d regulatory.db" %
+                             (FWDB_VERSION,))
+        self._index_countries()
+
+    @classmethod
+    def from_file(cls, path=REGULATORY_DB):
+        return super().from_file(path)
+
+    def _iter_countries(self):
+        offset = _FWDB_HEADER.size
+        while offset + _FWDB_COUNTRY.size <= len(self.data):
+            alpha2, collection_ptr = _FWDB_COUNTRY.unpack_from(self.data,
+                                                               offset)
+            # The list ends with an all-zero entry
+            if not collection_ptr:
+                return
+            collection_ptr <<= 2
+            _, _, dfs_region = _FWDB_COLLECTION.unpack_from(self.data,
+                                                            collection_ptr)
+            yield alpha2.decode("ascii", "replace"), dfs_region, \
+                collection_ptr
+            offset += _FWDB_COUNTRY.size
+
+    def _decode_rule(self, rule_ptr):
+        length, flags, max_eirp, start, end, max_bw = \
+            _FWDB_RULE.unpack_from(self.data, rule_ptr)
+        if length < _FWDB_RULE.size:
+            raise struct.error("rule at %d is too short" % (rule_ptr,))
+        dfs_cac_ms = None
+        if length >= _FWDB_RULE.size + _U16.size:
+            cac_s, = _U16.unpack_from(self.data, rule_ptr + _FWDB_RULE.size)
+            dfs_cac_ms = cac_s * 1000 if cac_s else None
+        return Rule(start / 1000.0, end / 1000.0, max_bw / 1000.0,
+                    max_eirp / 100.0 if max_eirp else None, dfs_cac_ms,
+                    _decode_flags(flags, _FWDB_FLAGS))
+
+    def _decode_rules(self, collection_ptr):
+        length, rule_num, _ = _FWDB_COLLECTION.unpack_from(self.data,
+                                                           collection_ptr)
+        # Rule pointers follow the collection, aligned to 2 bytes
+        rules_ptr = collection_ptr + length + (length & 1)
+        return tuple(
+            self._decode_rule(_U16.unpack_from(
+                self.data, rules_ptr + index * _U16.size)[0] << 2)
+            for index in range(rule_num)
+        )
+
+
+def load_regdb(path=None, regdbdump=REGDBDUMP):
+    """Open the database at path with whichever reader understands it.
+
+    Parameters
+    ----------
+    path : str, optional
+        Defaults to the first of REGULATORY_DATABASES that exists.
+    regdbdump : str
+        Used to decode path if no native reader understands it (e.g. an
+        older regulatory.bin version).
+
+    Raises
+    ------
+    FileNotFoundError
+        If path is None and no database is installed.
+    """
+    if path is None:
+        path = find_regdb()
+    for reader in (FirmwareRegDB, CRDARegDB):
+        try:
+            return reader.from_file(path)
+        except ValueError:
+            continue
+    click.echo("Unable to read %s directly. Using %s" % (path, regdbdump))
+    return RegDB.from_file(path, regdbdump)
+
+
+def find_regdb():
+    """Return the path of the first of REGULATORY_DATABASES that exists.
+
+    Raises
+    ------
+    FileNotFoundError
+        If none of them exist.
+    """
+    for path in REGULATORY_DATABASES:
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError("No regulatory database in %s" %
+                            (", ".join(REGULATORY_DATABASES),))
+
+
+def get_regdb(path=None, regdbdump=REGDBDUMP):
+    """Return the database at path (see load_regdb()), opening it at most once.
+
+    The database is cached for the life of the process, and only reopened
+    if the file's size or modification time changes.
+    """
+    if path is None:
+        path = find_regdb()
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _regdb_cache.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    reg_db = load_regdb(path, regdbdump)
+    _regdb_cache[path] = (key, reg_db)
+    return reg_db
@@ -1,20 +1,148 @@
 import collections
-import functools
+import errno
+import os
 from pathlib import Path
-import subprocess
+import select
 import re
+import threading
 import time
 import click
-import configobj
-import pyric.pyw as pyw
 import pyric.utils.channels as channels
-import pprint
-import random
+from wifi_configurator import bss
+from wifi_configurator import channel_stats
+from wifi_configurator import channel_table
+from wifi_configurator import ht40
+from wifi_configurator import interference
+from wifi_configurator import lazy
+from wifi_configurator import nl80211
+from wifi_configurator import regdb
+from wifi_configurator import scan_cache
+from wifi_configurator import spectrum
+from wifi_configurator.scan_result import ScanResult
+
+# Only needed to scan and to read /etc/default/crda, which a run with an
+#  explicit --channel and no --set-country-code never does, so they're
+#  imported on first use rather than at startup
+configobj = lazy.lazy_import("configobj")
+pyw = lazy.lazy_import("pyric.pyw")
+subprocess = lazy.lazy_import("subprocess")
 
 
 # OFDM. We don't use DSSS, so their 22MHz width doesn't matter
 CHANNEL_WIDTH_MHZ_24 = 20
+# (band, width MHz) combinations in the precomputed legal channel table
+CHANNEL_PLANS = [
+    (band, width)
+    for band in spectrum.BANDS for width in spectrum.CHANNEL_WIDTHS
+    if spectrum.band_channels(band, width)
+]
 NO_CHANNEL = 0
+# A DFS channel ranks like a channel hearing an AP this strong (dBm), on top
+#  of whatever it actually hears
+DFS_PENALTY_DBM = -70
+
+# Legal channel tables, keyed by (regdb path, cache dir)
+_channel_table_cache = {}
+
+# Streaming scan limits. iw output is read in chunks and parsed as it
+#  arrives, so only one chunk plus one partial line is held at a time.
+SCAN_TIMEOUT_S = 20
+SCAN_READ_CHUNK = 4096
+SCAN_MAX_LINE_LEN = 4096
+SCAN_MAX_BSS = 1024
+# iw closes its output as it exits, so once that's read it should be gone
+#  within this long
+IW_EXIT_TIMEOUT_S = 1
+# How often a running iw is checked on in case the scan's been cancelled
+CANCEL_POLL_S = 0.1
+# The kernel's cached BSS table is used instead of a new scan when at least
+#  CACHED_BSS_MIN_COUNT entries are this fresh. cfg80211 expires entries
+#  after 30s anyway.
+CACHED_BSS_MAX_AGE_S = 20
+CACHED_BSS_MIN_COUNT = 3
+# Stop a country-code-only scan once the leader is this far ahead
+CONSENSUS_MARGIN = 3
+
+SCAN_BACKEND_AUTO = "auto"
+SCAN_BACKEND_NL80211 = "nl80211"
+SCAN_BACKEND_IW = "iw"
+SCAN_BACKENDS = (SCAN_BACKEND_AUTO, SCAN_BACKEND_NL80211, SCAN_BACKEND_IW)
+
+# Retries back off exponentially from SCAN_BACKOFF_INITIAL_S, but never
+#  wait longer than SCAN_BACKOFF_MAX_S between attempts or past the deadline
+SCAN_MAX_ATTEMPTS = 5
+SCAN_BACKOFF_INITIAL_S = 0.25
+SCAN_BACKOFF_MAX_S = 2
+# Scan failures that mean "try again shortly" rather than "this backend
+#  can't scan on this system"
+TRANSIENT_SCAN_ERRNOS = (errno.EBUSY, errno.ECANCELED, errno.ENETDOWN,
+                         errno.EAGAIN)
+
+IFF_UP = 0x1
+IF_UP_TIMEOUT_S = 3
+IF_UP_POLL_INITIAL_S = 0.01
+IF_UP_POLL_MAX_S = 0.2
+
+
+class ScanError(EnvironmentError):
+    """iw reported a failed scan, e.g. EBUSY while another scan is running."""
+
+
+def backoff_delays(initial=SCAN_BACKOFF_INITIAL_S, maximum=SCAN_BACKOFF_MAX_S):
+    """Yield an endless sequence of exponentially increasing, capped delays."""
+    delay = initial
+    while True:
+        yield delay
+        delay = min(delay * 2, maximum)
+
+
+def sleep_until(delay, deadline, cancelled=None):
+    """Sleep for delay seconds, but never past deadline (a monotonic time).
+
+    If cancelled (a threading.Event) is given, stop sleeping once it's set.
+    """
+    delay = max(0, min(delay, deadline - time.monotonic()))
+    if cancelled is None:
+        time.sleep(delay)
+    else:
+        cancelled.wait(delay)
+
+
+def _is_set(event):
+    """Return whether event, a threading.Event or None, is set."""
+    return event is not None and event.is_set()
+
+
+def interface_is_up(dev):
+    """Return True if dev is administratively up and its hardware is present.
+
+    operstate itself isn't a usable readiness signal for scanning: a managed
+    interface that isn't associated reports 'down' or 'dormant' even though
+    it can scan, so we only treat the states that mean the device itself is
+    missing as not ready.
+    """
+    sysfs = Path("/sys/class/net", dev)
+    try:
+        flags = int((sysfs / "flags").read_text().strip(), 16)
+        operstate = (sysfs / "operstate").read_text().strip()
+    except (OSError, ValueError):
+        return False
+    return bool(flags & IFF_UP) and \
+        operstate not in ("notpresent", "lowerlayerdown")
+
+
+def wait_for_interface_up(dev, deadline):
+    """Wait until interface_is_up(dev) or deadline passes.
+
+    Polls sysfs with a short, growing interval so a radio that comes up
+    quickly is used straight away.  Returns whether the interface is up.
+    """
+    for delay in backoff_delays(IF_UP_POLL_INITIAL_S, IF_UP_POLL_MAX_S):
+        if interface_is_up(dev):
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        sleep_until(delay, deadline)
 
 
 class ActiveWifiInterface:
@@ -58,11 +186,13 @@ class ActiveWifiInterface:
 
         Returns True if the interface is ready to scan (either was already up
         or was successfully brought up).  Returns False if it was already up
-        but pyw.isup() returned False, which should not happen in practice.
+        but pyw.isup() returned False, which should not happen in practice,
+        or if it didn't come up within IF_UP_TIMEOUT_S.
         """
         if not pyw.isup(self.wlan_if):
             pyw.up(self.wlan_if)
-            return True
+            return wait_for_interface_up(
+                self.wlan_if.dev, time.monotonic() + IF_UP_TIMEOUT_S)
 
         # Good to go if it's already active, but not otherwise
         return self.initial_state == self.STATE_ACTIVE
@@ -78,55 +208,69 @@ class ActiveWifiInterface:
             pyw.down(self.wlan_if)
 
 
-def get_country_count_from_iw_output(iw_output):
+def as_scan_result(scan_output):
+    """Return scan_output as a ScanResult, parsing it if needed.
+
+    Lets the scan helpers accept raw 'iw dev scan' output (bytes or str),
+    an iterable of already-parsed bss.BSS records, or a ScanResult, so callers
+    that already hold a ScanResult never pay for a second parse.
+
+    Parameters
+    ----------
+    scan_output : bytes, str, iterable of bss.BSS or ScanResult
+
+    Returns
+    -------
+    scan_result.ScanResult
+    """
+    if isinstance(scan_output, ScanResult):
+        return scan_output
+    if isinstance(scan_output, (bytes, str)):
+        scan_output = bss.iter_bss_records(scan_output)
+    return ScanResult.from_bss_records(scan_output)
+
+
+def get_country_count(scan_output):
     """Count how many nearby APs advertise each country code in their beacons.
 
-    Parses 'iw dev scan' output line-by-line looking for 'Country: XX' fields.
-    Each occurrence of a country code increments its counter.  Used by
-    get_consensus_regdomain_from_iw_output() to pick the most common code.
+    Each BSS that carries a 'Country: XX' element increments its counter.
+    Used by get_consensus_regdomain() to pick the most common code.
 
     Parameters
     ----------
-    iw_output : str
-        Raw stdout from 'iw dev <if> scan'.
+    scan_output : bytes, str, iterable of bss.BSS or ScanResult
+        Raw 'iw dev <if> scan' output, or the result of parsing it.
 
     Returns
     -------
     collections.Counter
         Mapping of country-code string to occurrence count.
     """
-    c = collections.Counter()
-    for line in iw_output.split("\n"):
-        # e.g. '        Country: TR     Environment: Indoor/Outdoor
-        line = line.strip()
-        if not line.startswith("Country:"):
-            continue
+    return as_scan_result(scan_output).country_counts()
 
-        fields = re.split(r'\s+', line)
-        if len(fields) > 1:
-            c[fields[1]] += 1
 
-    return c
+# Retained for callers that still pass raw scan output
+get_country_count_from_iw_output = get_country_count
 
 
-def get_consensus_regdomain_from_iw_output(iw_output):
+def get_consensus_regdomain(scan_output):
     """Return the most commonly advertised country code seen in nearby AP beacons.
 
-    Calls get_country_count_from_iw_output() to tally all country codes in the
-    scan, then picks the plurality winner.  Returns an empty string if no APs
-    were found or none advertised a country code.
+    Tallies all country codes in the scan, then picks the plurality winner.
+    Returns an empty string if no APs were found or none advertised a
+    country code.
 
     Parameters
     ----------
-    iw_output : str
-        Raw stdout from 'iw dev <if> scan'.
+    scan_output : bytes, str, iterable of bss.BSS or ScanResult
+        Raw 'iw dev <if> scan' output, or the result of parsing it.
 
     Returns
     -------
     str
         Two-letter ISO country code (e.g. 'US', 'TR') or '' if undetermined.
     """
-    cnter = get_country_count_from_iw_output(iw_output)
+    cnter = get_country_count(scan_output)
     most_common = cnter.most_common(1)
     if most_common:
         return most_common[0][0]
@@ -134,17 +278,23 @@ def get_consensus_regdomain_from_iw_output(iw_output):
     return ""
 
 
-@functools.lru_cache()
+# Retained for callers that still pass raw scan output
+get_consensus_regdomain_from_iw_output = get_consensus_regdomain
+
+
 def get_scan_output(wlan_if):
     """Run 'iw dev scan' and return the raw output, retrying up to 5 times.
 
     Uses ActiveWifiInterface to bring the interface up if needed.  Retries
-    with a 2-second sleep between attempts because the first scan after
-    bringing an interface up sometimes returns empty output.
+    with an exponential backoff (see backoff_delays()) because the first scan
+    after bringing an interface up sometimes returns empty output.
 
-    Results are cached with lru_cache so multiple callers in the same process
-    (country-code detection + channel selection) share the same scan output
-    without triggering a second radio scan.
+    This always scans. get_scan_result() is the cached path: it can reuse
+    a recent scan persisted by scan_cache, including one from an earlier
+    process.
+
+    The output is returned undecoded; the bss parser consumes bytes
+    directly so the text is only walked once.
 
     Parameters
     ----------
@@ -153,41 +303,475 @@ def get_scan_output(wlan_if):
 
     Returns
     -------
-    str
-        Raw 'iw dev scan' output, or '' if the interface could not be brought
+    bytes
+        Raw 'iw dev scan' output, or b'' if the interface could not be brought
         up or scan produced no output after 5 retries.
     """
     with ActiveWifiInterface(wlan_if) as awi:
         if not awi:
-            return ""
-        a = ""
+            return b""
+        a = b""
         b = 0
+        delays = backoff_delays()
         # Retry loop: a freshly-up interface may return empty on the first scan.
-        while a == "" and b < 5:
+        while a == b"" and b < SCAN_MAX_ATTEMPTS:
             iw = subprocess.run([
                 "/sbin/iw",
                 "dev",
                 wlan_if.dev,
                 "scan"
             ], stdout=subprocess.PIPE)
-            a = iw.stdout.decode("utf-8")
+            a = iw.stdout
             b += 1
-            if a == "": time.sleep(2)
+            if a == b"": time.sleep(next(delays))
     return a
 
 
+def stream_bss_records(stream, deadline=None):
+    """Yield BSS records from a pipe as the data arrives.
+
+    Reads raw chunks from stream and feeds complete lines to a
+    bss.BSSParser, so records are produced while the writer (normally
+    'iw dev scan') is still running.  Only the current chunk and at most
+    SCAN_MAX_LINE_LEN bytes of a partial line are held in memory.
+
+    If deadline passes before the writer closes the pipe, the records parsed
+    so far (including the block in progress) are yielded and iteration stops.
+
+    Parameters
+    ----------
+    stream : file object or int
+        Readable pipe, or its file descriptor.
+    deadline : float, optional
+        time.monotonic() value after which to stop reading.
+
+    Yields
+    ------
+    bss.BSS
+    """
+    fd = stream if isinstance(stream, int) else stream.fileno()
+    parser = bss.BSSParser()
+    partial = b""
+    while True:
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                click.echo("Scan timed out. Using partial results")
+                break
+        chunk = os.read(fd, SCAN_READ_CHUNK)
+        if not chunk:
+            break
+        lines = (partial + chunk).split(b"\n")
+        # Truncate pathological lines rather than buffering without bound
+        partial = lines.pop()[:SCAN_MAX_LINE_LEN]
+        for line in lines:
+            record = parser.feed_line(line)
+            if record is not None:
+                yield record
+    if partial:
+        record = parser.feed_line(partial)
+        if record is not None:
+            yield record
+    record = parser.close()
+    if record is not None:
+        yield record
+
+
+def country_consensus_is_decisive(scan_result, margin=CONSENSUS_MARGIN):
+    """Return True once the leading country code can't plausibly be overtaken.
+
+    Suitable as the stop_when callback for get_scan_result() when the scan
+    is only needed for country code detection.
+
+    Parameters
+    ----------
+    scan_result : ScanResult
+    margin : int
+        How many more BSSes must advertise the leading country than the
+        runner-up.
+    """
+    most_common = scan_result.country_counts().most_common(2)
+    if not most_common:
+        return False
+    runner_up_count = most_common[1][1] if len(most_common) > 1 else 0
+    return most_common[0][1] - runner_up_count >= margin
+
+
+def _collect_bss_records(records, scan_result, stop_when, max_bss):
+    """Append records to scan_result until stop_when or max_bss says stop.
+
+    Returns True if they stopped it before records ran out.
+    """
+    for record in records:
+        scan_result.append(record)
+        if len(scan_result) >= max_bss or \
+                (stop_when and stop_when(scan_result)):
+            scan_result.partial = True
+            return True
+    return False
+
+
+def _kill_when_cancelled(process, cancelled, finished):
+    """Kill process if cancelled is set before finished is."""
+    while not finished.wait(CANCEL_POLL_S):
+        if cancelled.is_set():
+            process.kill()
+            return
+
+
+def _iw_scan(wlan_if, scan_result, deadline, stop_when, max_bss,
+             dump=False, cancelled=None):
+    """One 'iw dev scan' attempt, streamed into scan_result.
+
+    With dump=True, runs 'iw dev scan dump' instead, which reports the
+    kernel's cached BSS table without touching the radio.  Setting
+    cancelled (a threading.Event) kills iw, keeping what it had reported.
+
+    Raises ScanError if iw fails without producing any results, with the
+    errno iw reported (e.g. EBUSY) so the caller can decide how to retry.
+    """
+    iw_cmd = [
+        "/sbin/iw",
+        "dev",
+        wlan_if.dev,
+        "scan"
+    ]
+    if dump:
+        iw_cmd.append("dump")
+    iw = subprocess.Popen(iw_cmd, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE)
+    finished = threading.Event()
+    if cancelled is not None:
+        # Killing iw ends its output, and so the read below
+        threading.Thread(target=_kill_when_cancelled,
+                         args=(iw, cancelled, finished), daemon=True).start()
+    try:
+        if not _collect_bss_records(stream_bss_records(iw.stdout, deadline),
+                                    scan_result, stop_when, max_bss):
+            # The stream ends at EOF, or at the deadline if iw hasn't
+            #  finished by then
+            if time.monotonic() >= deadline or _is_set(cancelled):
+                scan_result.partial = True
+            else:
+                try:
+                    iw.wait(timeout=IW_EXIT_TIMEOUT_S)
+                except subprocess.TimeoutExpired:
+                    pass
+    finally:
+        finished.set()
+        # Stops iw early if we're done before it is (or it's timed out)
+        if iw.poll() is None:
+            iw.kill()
+        iw.stdout.close()
+        stderr = iw.stderr.read()
+        iw.stderr.close()
+        iw.wait()
+    if iw.returncode > 0 and not len(scan_result):
+        # e.g. 'command failed: Device or resource busy (-16)'
+        match = re.search(rb"\((-\d+)\)", stderr)
+        error = -int(match.group(1)) if match else errno.EIO
+        raise ScanError(error, stderr.decode("utf-8", "replace").strip())
+
+
+def _nl80211_scan(wlan_if, scan_result, deadline, stop_when, max_bss,
+                  dump=False):
+    """One nl80211 trigger/wait/dump attempt, collected into scan_result.
+
+    With dump=True, only the kernel's cached BSS table is read.
+
+    Raises nl80211.NL80211Error if nothing could be collected.  A failure
+    part way through the dump keeps whatever had already arrived.
+    """
+    iter_records = nl80211.iter_scan_dump if dump else nl80211.iter_scan
+    records = iter_records(wlan_if.idx,
+                           timeout=max(0, deadline - time.monotonic()))
+    try:
+        _collect_bss_records(records, scan_result, stop_when, max_bss)
+    except nl80211.NL80211Error:
+        if not len(scan_result):
+            raise
+        click.echo("nl80211 scan incomplete. Using partial results")
+        scan_result.partial = True
+    finally:
+        records.close()
+
+
+def get_cached_scan_result(wlan_if, max_age_s=CACHED_BSS_MAX_AGE_S,
+                           timeout=SCAN_TIMEOUT_S, max_bss=SCAN_MAX_BSS,
+                           backend=SCAN_BACKEND_AUTO):
+    """Return the kernel's cached BSSes that were seen within max_age_s.
+
+    Reads the BSS table the kernel keeps from earlier scans (ours, or e.g.
+    wpa_supplicant's on the client interface) without triggering a radio
+    scan.  Failures are reported and treated as an empty cache.
+
+    Parameters
+    ----------
+    wlan_if : pyric card object
+        The wireless interface card, as returned by pyw.getcard().
+    max_age_s : float
+        Entries last seen longer ago than this are dropped.
+    timeout : float
+        Limit in seconds for reading the cache.
+    max_bss : int
+        Upper bound on the number of BSSes read.
+    backend : str
+        One of SCAN_BACKENDS.
+
+    Returns
+    -------
+    ScanResult
+    """
+    deadline = time.monotonic() + timeout
+    scan_result = ScanResult()
+    try:
+        if backend != SCAN_BACKEND_IW:
+            try:
+                _nl80211_scan(wlan_if, scan_result, deadline, None, max_bss,
+                              dump=True)
+                return scan_result.seen_within(max_age_s * 1000)
+            except nl80211.NL80211Error:
+                if backend != SCAN_BACKEND_AUTO:
+                    raise
+        _iw_scan(wlan_if, scan_result, deadline, None, max_bss, dump=True)
+    except (ScanError, nl80211.NL80211Error) as e:
+        click.echo("Unable to read cached scan results: %s" % (e,))
+    return scan_result.seen_within(max_age_s * 1000)
+
+
+def get_scan_result(wlan_if, timeout=SCAN_TIMEOUT_S, stop_when=None,
+                    max_bss=SCAN_MAX_BSS, backend=SCAN_BACKEND_AUTO,
+                    cached_max_age_s=None,
+                    cached_min_count=CACHED_BSS_MIN_COUNT,
+                    max_scan_age_s=None, cache_dir=scan_cache.CACHE_DIR,
+                    cancelled=None):
+    """Scan for nearby BSSes, collecting them into a ScanResult as they arrive.
+
+    Two backends are available:
+
+    - nl80211: triggers the scan over netlink, waits for the kernel's
+      scan-done event and dumps the results as binary attributes, without
+      forking anything or depending on iw's text format
+    - iw: runs 'iw dev scan' and parses its output while it is still being
+      written, so the whole scan text is never held in memory
+
+    SCAN_BACKEND_AUTO uses nl80211 and falls back to iw if netlink can't be
+    used (e.g. no permission, or an old kernel).
+
+    The scan is cut short when:
+
+    - stop_when(scan_result) returns True (e.g. country_consensus_is_decisive)
+    - max_bss BSSes have been collected
+    - timeout seconds have elapsed, in which case the partial result is
+      returned rather than waiting on a hung scan
+
+    With max_scan_age_s set, a scan persisted to disk by an earlier run (see
+    scan_cache) is returned if it's no older than max_scan_age_s, without
+    touching the interface at all.  Complete scans are written back to that
+    cache; scans cut short by stop_when or the timeout are not.
+
+    With cached_max_age_s set, the kernel's cached BSS table is checked
+    first (see get_cached_scan_result()).  If at least cached_min_count
+    BSSes were seen within cached_max_age_s, they're returned and the radio
+    scan is skipped entirely.
+
+    Failed or empty scans are retried (up to SCAN_MAX_ATTEMPTS) with an
+    exponential backoff, bounded by the overall timeout.  Where there's a
+    readiness signal we wait for that rather than sleeping: a scan that
+    fails because the interface is down waits for it to come up, and on
+    nl80211 a trigger refused with EBUSY waits for the in-flight scan to
+    finish and uses its results.
+
+    Parameters
+    ----------
+    wlan_if : pyric card object
+        The wireless interface card, as returned by pyw.getcard().
+    timeout : float
+        Overall limit in seconds, across all attempts.
+    stop_when : callable, optional
+        Called with the ScanResult after each BSS is added.
+    max_bss : int
+        Upper bound on the number of BSSes kept.
+    backend : str
+        One of SCAN_BACKENDS.
+    cached_max_age_s : float, optional
+        Freshness threshold for using cached results. None disables the
+        cache check.
+    cached_min_count : int
+        How many fresh cached BSSes are enough to skip scanning.
+    max_scan_age_s : float, optional
+        Oldest acceptable on-disk cached scan. None disables the on-disk
+        cache, for both reading and writing.
+    cache_dir : str
+        Directory for the on-disk cache.
+    cancelled : threading.Event, optional
+        Stops the scan once set, as the timeout would, e.g. when the caller
+        has given up waiting for it.  A running iw is killed; nl80211 stops
+        at the next BSS or its timeout.
+
+    Returns
+    -------
+    ScanResult
+        Possibly empty if the interface could not be brought up or nothing
+        was heard.
+    """
+    if max_scan_age_s:
+        mac = scan_cache.interface_mac(wlan_if.dev)
+        scan_result = scan_cache.load(wlan_if.dev, mac, max_scan_age_s,
+                                      cache_dir)
+        if scan_result is not None:
+            click.echo("Using cached scan of %d BSSes from %s" %
+                       (len(scan_result), cache_dir))
+            return scan_result
+        scan_result = _get_scan_result(wlan_if, timeout, stop_when, max_bss,
+                                       backend, cached_max_age_s,
+                                       cached_min_count, cancelled)
+        # Partial scans (stopped early or timed out) aren't worth keeping
+        if len(scan_result) and not scan_result.partial:
+            scan_cache.store(wlan_if.dev, mac, scan_result,
+                             cache_dir=cache_dir)
+        return scan_result
+    return _get_scan_result(wlan_if, timeout, stop_when, max_bss, backend,
+                            cached_max_age_s, cached_min_count, cancelled)
+
+
+def iter_scan_samples(wlan_if, samples, window_s, **kwargs):
+    """Scan samples times, spread evenly over window_s seconds.
+
+    Each sample is a fresh get_scan_result() (with kwargs), so the kernel's
+    and the on-disk scan caches aren't consulted.  Feed the results to a
+    channel_stats.ChannelStats to smooth out the noise in single scans.
+    Sampling stops early if kwargs' cancelled event is set.
+
+    Parameters
+    ----------
+    wlan_if : pyric card object
+        The wireless interface card, as returned by pyw.getcard().
+    samples : int
+        Number of scans.
+    window_s : float
+        Time from the start of the first scan to the start of the last.
+
+    Yields
+    ------
+    ScanResult
+    """
+    kwargs.update(cached_max_age_s=None, max_scan_age_s=None)
+    interval = window_s / (samples - 1) if samples > 1 else 0
+    cancelled = kwargs.get("cancelled")
+    start = time.monotonic()
+    for sample in range(samples):
+        if sample:
+            next_start = start + sample * interval
+            sleep_until(next_start - time.monotonic(), next_start, cancelled)
+        scan_result = get_scan_result(wlan_if, **kwargs)
+        # A scan cut short by cancelling would skew the statistics
+        if _is_set(cancelled):
+            return
+        yield scan_result
+
+
+def sample_channel_stats(wlan_if, samples, window_s,
+                         cache_dir=scan_cache.CACHE_DIR, **kwargs):
+    """Update the interface's persisted ChannelStats with samples new scans.
+
+    Stats saved by recent earlier runs (see channel_stats.load()) are built
+    on, and the updated stats are saved again for the next run.
+
+    Parameters
+    ----------
+    wlan_if : pyric card object
+        The wireless interface card, as returned by pyw.getcard().
+    samples : int
+        Number of scans, passed to iter_scan_samples() with window_s and
+        kwargs.
+    window_s : float
+        Time to spread the scans over.
+    cache_dir : str
+        Directory holding the persisted stats.
+
+    Returns
+    -------
+    (channel_stats.ChannelStats, ScanResult)
+        The updated stats, and the last non-empty scan (for country
+        detection).
+    """
+    mac = scan_cache.interface_mac(wlan_if.dev)
+    stats = channel_stats.load(wlan_if.dev, mac, cache_dir=cache_dir) or \
+        channel_stats.ChannelStats()
+    scan_result = ScanResult()
+    for sample in iter_scan_samples(wlan_if, samples, window_s, **kwargs):
+        stats.update(sample)
+        if len(sample):
+            scan_result = sample
+    click.echo("Channel statistics now cover %d scans" % (stats.samples,))
+    channel_stats.save(wlan_if.dev, mac, stats, cache_dir)
+    return stats, scan_result
+
+
+def _get_scan_result(wlan_if, timeout, stop_when, max_bss, backend,
+                     cached_max_age_s, cached_min_count, cancelled=None):
+    """get_scan_result(), minus the on-disk cache."""
+    deadline = time.monotonic() + timeout
+    if cancelled is not None:
+        caller_stop_when = stop_when
+
+        def stop_when(scan_result):
+            return cancelled.is_set() or \
+                bool(caller_stop_when and caller_stop_when(scan_result))
+    scan_result = ScanResult()
+    with ActiveWifiInterface(wlan_if) as awi:
+        if not awi:
+            return scan_result
+        if cached_max_age_s:
+            cached = get_cached_scan_result(wlan_if, cached_max_age_s,
+                                            timeout, max_bss, backend)
+            if len(cached) >= cached_min_count:
+                click.echo("Using %d cached BSSes seen in the last %ss" %
+                           (len(cached), cached_max_age_s))
+                return cached
+            click.echo("Cached scan results are stale or too sparse. "
+                       "Scanning")
+        delays = backoff_delays()
+        attempts = 0
+        while not len(scan_result) and attempts < SCAN_MAX_ATTEMPTS and \
+                time.monotonic() < deadline and not _is_set(cancelled):
+            attempts += 1
+            try:
+                if backend == SCAN_BACKEND_IW:
+                    _iw_scan(wlan_if, scan_result, deadline, stop_when,
+                             max_bss, cancelled=cancelled)
+                else:
+                    try:
+                        _nl80211_scan(wlan_if, scan_result, deadline,
+                                      stop_when, max_bss)
+                    except nl80211.NL80211Error as e:
+                        if backend != SCAN_BACKEND_AUTO or \
+                                e.errno in TRANSIENT_SCAN_ERRNOS:
+                            raise
+                        click.echo("nl80211 scan failed: %s. Falling back "
+                                   "to iw" % (e,))
+                        backend = SCAN_BACKEND_IW
+                        continue
+            except (ScanError, nl80211.NL80211Error) as e:
+                click.echo("Scan failed: %s" % (e,))
+                if e.errno == errno.ENETDOWN:
+                    wait_for_interface_up(wlan_if.dev, deadline)
+                    continue
+            if not len(scan_result):
+                sleep_until(next(delays), deadline, cancelled)
+    return scan_result
+
+
 def get_freq_signal_tuples_from_iw_output(iw_output):
-    """Parse 'iw dev scan' output into a list of (frequency_MHz, signal_dBm) tuples.
+    """Return a list of (frequency_MHz, signal_dBm) tuples, one per BSS.
 
-    Walks the output line by line, tracking the current BSS block.  Each time a
-    new 'BSS' header is encountered the previous block's (freq, signal) pair is
-    committed to the result list.  The final BSS block is committed after the
-    loop.
+    BSS blocks without both a frequency and a signal reading are skipped.
 
     Parameters
     ----------
-    iw_output : str
-        Raw stdout from 'iw dev <if> scan'.
+    iw_output : bytes, str, iterable of bss.BSS or ScanResult
+        Raw 'iw dev <if> scan' output, or the result of parsing it.
 
     Returns
     -------
@@ -196,36 +780,10 @@ def get_freq_signal_tuples_from_iw_output(iw_output):
         Duplicate frequencies (multiple APs on the same channel) are kept so
         the caller can identify congested channels.
     """
-    freq_signal_tuples = []
-    freq = 0
-    signal = 0.0
-    for line in iw_output.split("\n"):
-        line = line.strip()
-        if line.startswith("BSS"):
-            # New BSS block — commit the previous block's reading if we have one.
-            if freq and signal:
-                freq_signal_tuples.append((freq, signal))
-            continue
+    return as_scan_result(iw_output).freq_signal_tuples()
 
-        # freq: 2412
-        if line.startswith("freq:"):
-            _, freq_str = line.split(":")
-            freq = int(freq_str)
-            continue
-
-        # signal: -48.00 dBm
-        if line.startswith("signal:"):
-            _, signal_str = line.split(":")
-            signal = float(signal_str.strip().split(" ")[0])
-            continue
 
-    # Process the reading from the last BSS, assuming there was one
-    if freq and signal:
-        freq_signal_tuples.append((freq, signal))
-    return freq_signal_tuples
-
-
-def get_max_signal_at_each_freq(freq_signal_tuples):
+def get_max_signal_at_each_freq(scan_output):
     """Build a map of frequency → strongest observed signal level.
 
     When multiple APs occupy the same frequency, only the strongest signal is
@@ -234,95 +792,194 @@ def get_max_signal_at_each_freq(freq_signal_tuples):
 
     Parameters
     ----------
-    freq_signal_tuples : list of (int, float)
-        As returned by get_freq_signal_tuples_from_iw_output().
+    scan_output : bytes, str, iterable of bss.BSS or ScanResult
+        Raw 'iw dev <if> scan' output, or the result of parsing it.
 
     Returns
     -------
     dict mapping int → float
         {frequency_MHz: max_signal_dBm}
     """
-    freq_signal_map = {}
-    for freq, signal in freq_signal_tuples:
-        if freq in freq_signal_map:
-            if signal > freq_signal_map[freq]:
-                freq_signal_map[freq] = signal
-        else:
-            freq_signal_map[freq] = signal
+    return as_scan_result(scan_output).max_signal_per_freq()
 
 
-def channel_overlaps_with_others(all_channel, channel_list):
-    """Remove channels from all_channel that appear in channel_list and return a random survivor.
+def channel_overlaps_with_others(channel, channel_list):
+    """Return whether channel overlaps any of the channels in channel_list.
 
-    Mutates all_channel in place, removing every channel that is also in
-    channel_list (i.e. channels already in use by nearby APs).  Returns a
-    random choice from the remaining uncontested channels, or NO_CHANNEL (0)
-    if all channels are contested.
+    2.4GHz channels are 5MHz apart and 20MHz wide, so channels less than 4
+    apart overlap (e.g. 5 overlaps 2 to 8, but not 1 or 9).
 
     Parameters
     ----------
-    all_channel : list of int
-        Full list of channels available under the current regulatory domain.
-        Modified in place.
+    channel : int
+        2.4GHz channel number to check.
     channel_list : list of int
         Channels observed in use by nearby APs.
 
     Returns
     -------
-    int
-        A randomly selected uncontested channel, or NO_CHANNEL (0) if none remain.
-    """
-    # Remove each used channel from all_channel using index-walk so we can
-    # mutate the list safely without creating a copy.
-    for channel in channel_list:
-        x = 0
-        y = len(all_channel)
-        while (x < y):
-            if all_channel[x] == channel:
-                all_channel.pop(x)
-                y -= 1
-                x = y
-            else:
-                x += 1
+    bool
+        True if any channel in channel_list overlaps channel.
+    """
+    freq = channels.ISM_24_C2F[channel]
+    return any(
+        interference.spectral_overlap(freq, channels.ISM_24_C2F[other]) > 0
+        for other in channel_list
+    )
 
-    if len(all_channel) == 0:
-        return NO_CHANNEL
-    else:
-        return (random.choice(all_channel))
 
+def rank_channels(all_available_channels, scan_output,
+                  band=spectrum.BAND_2GHZ, dfs_channels=()):
+    """Rank channels by the interference they would receive from nearby APs.
 
-def get_available_uncontested_channel(all_available_channels, scan_output):
-    """Select a channel that is not currently used by any nearby AP.
+    Every observed BSS in band adds its received power, weighted by its
+    spectral overlap with the candidate channel, to that channel's cost (see
+    the interference module).  BSSes operating at 40MHz or wider count
+    against every 20MHz subchannel they occupy.
 
-    Extracts in-use channels from the scan output, logs available vs. used
-    sets for debugging, then delegates to channel_overlaps_with_others() for
-    the final selection.
+    Given ChannelStats aggregated over several scans, the averaged received
+    power is used instead, so one noisy scan can't swing the ranking.
+
+    DFS channels are ranked as if they also heard a DFS_PENALTY_DBM
+    neighbour, so they're only chosen when every other channel is busier
+    than that: hostapd can't transmit on them until a radar check finishes.
 
     Parameters
     ----------
     all_available_channels : list of int
         Channels permitted by the regulatory domain for this country code.
-    scan_output : str
-        Raw 'iw dev scan' output.
+    scan_output : bytes, str, iterable of bss.BSS, ScanResult or ChannelStats
+        Raw 'iw dev scan' output, the result of parsing it, or statistics
+        aggregated from several scans.
+    band : str
+        The band all_available_channels are in.
+    dfs_channels : iterable of int
+        Those of all_available_channels that need DFS.
+
+    Returns
+    -------
+    list of (int, float)
+        (channel, cost_mW) pairs, least interfered-with first.  A cost of 0
+        means no observed AP overlaps the channel.  Costs don't include the
+        DFS penalty.
+    """
+    if not isinstance(scan_output, channel_stats.ChannelStats):
+        scan_output = as_scan_result(scan_output)
+    # 40MHz neighbours occupy their secondary channel too
+    power_mw_per_freq = {
+        freq: power_mw
+        for freq, power_mw in scan_output.power_mw_per_occupied_freq().items()
+        if spectrum.freq_band(freq) == band
+    }
+    dfs_penalty_mw = interference.dbm_to_mw(DFS_PENALTY_DBM)
+    return interference.rank_channels(
+        all_available_channels, power_mw_per_freq, band=band,
+        penalties_mw={channel: dfs_penalty_mw for channel in dfs_channels})
+
+
+def get_available_uncontested_channel(all_available_channels, scan_output,
+                                      band=spectrum.BAND_2GHZ,
+                                      dfs_channels=()):
+    """Select the best channel that no nearby AP overlaps.
+
+    Parameters
+    ----------
+    all_available_channels : list of int
+        Channels permitted by the regulatory domain for this country code.
+    scan_output : bytes, str, iterable of bss.BSS, ScanResult or ChannelStats
+        See rank_channels().
+    band, dfs_channels
+        See rank_channels().
 
     Returns
     -------
     int
-        An uncontested channel number, or NO_CHANNEL (0) if all are in use.
+        An uncontested channel number, or NO_CHANNEL (0) if every channel
+        overlaps at least one AP.  See get_least_contested_channel() for a
+        fallback.
     """
-    freq_signal_tuples = get_freq_signal_tuples_from_iw_output(scan_output)
-    used_channels = [
-        channels.ISM_24_F2C[freq] for freq, _ in freq_signal_tuples
-        if freq in channels.ISM_24_F2C  # ignore non 2.4Ghz for the moment
-    ]
-    click.echo("Available channels are: %s" %
-               (",".join([str(c) for c in all_available_channels])))
-    click.echo("Used channels are: %s" %
-               (",".join([str(c) for c in used_channels])))
-    channel = channel_overlaps_with_others(all_available_channels, used_channels)
-    click.echo("slected channel is: %s" % channel)
+    ranked = rank_channels(all_available_channels, scan_output, band,
+                           dfs_channels)
+    click.echo("Channel interference (mW): %s" %
+               (", ".join(["%s=%.3g" % (c, cost) for c, cost in ranked]),))
+    if ranked and ranked[0][1] == 0:
+        channel = ranked[0][0]
+    else:
+        channel = NO_CHANNEL
+    click.echo("Selected channel is: %s" % channel)
     return channel
 
+
+def get_least_contested_channel(all_available_channels, scan_output,
+                                band=spectrum.BAND_2GHZ, dfs_channels=()):
+    """Return the channel with the lowest interference cost, even if nonzero.
+
+    Parameters are as for rank_channels().
+
+    Returns
+    -------
+    int
+        A channel number, or NO_CHANNEL (0) if no channels are available.
+    """
+    ranked = rank_channels(all_available_channels, scan_output, band,
+                           dfs_channels)
+    return ranked[0][0] if ranked else NO_CHANNEL
+
+
+def get_uncontested_ht40_pair(legal_centres, scan_output, scan_result,
+                              band=spectrum.BAND_2GHZ, dfs_centres=(),
+                              primary=None, flags=ht40.HT40_FLAGS):
+    """Select an HT40 channel pair that's clear across its full 40MHz.
+
+    40MHz only pays off when both halves are quiet, so a pair is only
+    chosen if no observed AP overlaps either of its 20MHz channels and
+    20/40 coexistence allows it (see the ht40 module).  Pairs on DFS
+    channels are chosen last.
+
+    Parameters
+    ----------
+    legal_centres : list of int
+        40MHz channels permitted by the regulatory domain, by centre
+        channel number.
+    scan_output : bytes, str, iterable of bss.BSS, ScanResult or ChannelStats
+        See rank_channels().
+    scan_result : ScanResult
+        The BSSes to check coexistence against.
+    band : str
+    dfs_centres : iterable of int
+        Those of legal_centres that need DFS.
+    primary : int, optional
+        Only consider pairs with this primary channel.
+    flags : tuple of str
+        The HT40 ht_capab flags the adapter supports.
+
+    Returns
+    -------
+    ht40.ChannelPair or None
+        None if no pair qualifies, meaning the access point should use
+        20MHz.
+    """
+    pairs = [pair for pair in ht40.channel_pairs(legal_centres)
+             if ht40.ht_capab_flag(pair) in flags and
+             primary in (None, pair.primary)]
+    subchannels = sorted({channel for pair in pairs for channel in pair})
+    costs = dict(rank_channels(subchannels, scan_output, band))
+    uncontested = [
+        pair for pair in pairs
+        if costs.get(pair.primary) == costs.get(pair.secondary) == 0 and
+        ht40.coexistence_permits(pair, band, scan_result)
+    ]
+    uncontested.sort(
+        key=lambda pair: ht40.centre_channel(pair) in dfs_centres)
+    if not uncontested:
+        click.echo("No uncontested 40MHz channel. Using 20MHz")
+        return None
+    pair = uncontested[0]
+    click.echo("Selected 40MHz channel is: %s%s" %
+               (pair.primary, ht40.ht_capab_flag(pair)))
+    return pair
+
+
 def detect_regdomain(scan_output):
     """Determine the regulatory domain (country code) to use for this device.
 
@@ -331,12 +988,13 @@ def detect_regdomain(scan_output):
     the device respects local law even if nearby APs advertise a different code.
 
     Falls back to scanning nearby AP beacons and picking the plurality country
-    code via get_consensus_regdomain_from_iw_output().
+    code via get_consensus_regdomain().
 
     Parameters
     ----------
-    scan_output : str
-        Raw 'iw dev scan' output, used only when no crda override is set.
+    scan_output : bytes, str, iterable of bss.BSS or ScanResult
+        Raw 'iw dev scan' output or the result of parsing it, used only when
+        no crda override is set.
 
     Returns
     -------
@@ -349,7 +1007,7 @@ def detect_regdomain(scan_output):
     regdomain = c.get("REGDOMAIN", "")
     if regdomain:
         return regdomain
-    return get_consensus_regdomain_from_iw_output(scan_output)
+    return get_consensus_regdomain(scan_output)
 
 def get_country_rules_block(country_code, lines):
     """Extract the lines belonging to a single country's entry in regdbdump output.
@@ -358,6 +1016,10 @@ def get_country_rules_block(country_code, lines):
     'country XX:' header and ends at the next blank line.  This function
     returns just the lines for the requested country_code, including the header.
 
+    Only header lines are matched, and only on their country code, so e.g.
+    'US' can't match a rule line or another country's DFS region.  See
+    regdb.RegDB for an indexed alternative when looking up many countries.
+
     Parameters
     ----------
     country_code : str
@@ -380,20 +1042,42 @@ def get_country_rules_block(country_code, lines):
             else:
                 # We're at the end of the country block
                 return country_lines
-        elif (not (line.find(country_code) >=0)):
+        header = regdb.parse_country_header(line)
+        if header is None or header[0] != country_code:
             continue
         in_country_block = True
         country_lines.append(line)
-        continue
     return country_lines
 
 
-def get_frequency_blocks_from_country_block(country_code, lines):
+def get_frequency_blocks_from_country_block(lines):
     """Parse a country's regdb rules block into (lower_MHz, upper_MHz) frequency ranges.
 
     Each frequency line in regdbdump output looks like:
         (2457.000 - 2482.000 @ 20.000), (20.00), (N/A), NO-IR, AUTO-BW
 
+    See get_frequency_blocks_from_rules() for how the lines are interpreted.
+
+    Parameters
+    ----------
+    lines : list of str
+        Country block lines as returned by get_country_rules_block(), including
+        the 'country XX:' header on lines[0].
+
+    Returns
+    -------
+    list of (float, float)
+        Each tuple is (lower_frequency_MHz, upper_frequency_MHz) for one
+        contiguous OFDM-capable band.
+    """
+    # Drop the line with the country definition — only frequency lines remain.
+    return get_frequency_blocks_from_rules(
+        [regdb.parse_rule(line) for line in lines[1:]])
+
+
+def get_frequency_blocks_from_rules(rules):
+    """Reduce a country's regdb rules to (lower_MHz, upper_MHz) frequency ranges.
+
     NO-OFDM ranges are excluded because we can only use OFDM channels.  When a
     NO-OFDM range overlaps the top of the previous block (e.g. Japan channel 14,
     or the 'world' 00 domain's channels 12-13), the previous block's upper
@@ -401,11 +1085,8 @@ def get_frequency_blocks_from_country_block(country_code, lines):
 
     Parameters
     ----------
-    country_code : str
-        Two-letter ISO country code (used only for logging).
-    lines : list of str
-        Country block lines as returned by get_country_rules_block(), including
-        the 'country XX:' header on lines[0].
+    rules : iterable of regdb.Rule
+        A country's rules, in regdb order.
 
     Returns
     -------
@@ -416,26 +1097,19 @@ def get_frequency_blocks_from_country_block(country_code, lines):
     freqency_blocks = []
     block_lower_point = 0
     block_upper_point = 0
-    # Drop the line with the country definition — only frequency lines remain.
-    frequency_lines = lines[1:]
-    for line in frequency_lines:
-        # Parse frequency range: strip whitespace, split on '@', drop leading '('.
-        freq_section = line.strip().split("@")[0][1:]
-        new_block_lower_point, new_block_upper_point = [
-            float(freq.strip()) for freq in freq_section.split("-")
-        ]
+    for rule in rules:
         # We can't use a frequency marked as NO-OFDM, so we must
         #  drop them. This includes channel 14 in JP and 12+13 in 00
         # NO-OFDM may overlap with the range on the previous line (strictly
         #  speaking it could be many lines of overlap, but let's ignore that
         #  given there's only 00 and JP with NO-OFDM and that doesn't go back
         #  more than one line.
-        if ("NO-OFDM" in line):
+        if regdb.FLAG_NO_OFDM in rule.flags:
             # If the NO-OFDM line encroaches on the top end of the previous
             #  block, redefine the top of the previous block to be where the
             #  NO-OFDM block starts
-            if new_block_lower_point < block_upper_point:
-                block_upper_point = new_block_lower_point
+            if rule.start_freq < block_upper_point:
+                block_upper_point = rule.start_freq
             continue
 
         # Commit the previous block before starting the new one.
@@ -443,13 +1117,11 @@ def get_frequency_blocks_from_country_block(country_code, lines):
             freqency_blocks.append((block_lower_point, block_upper_point))
 
         # Remember this block for the next iteration's processing.
-        block_lower_point = new_block_lower_point
-        block_upper_point = new_block_upper_point
+        block_lower_point = rule.start_freq
+        block_upper_point = rule.end_freq
 
     if block_lower_point and block_upper_point:
         freqency_blocks.append((block_lower_point, block_upper_point))
-    click.echo("Frequency blocks are {}" )
-    pprint.pprint(freqency_blocks)
     return freqency_blocks
 
 
@@ -496,10 +1168,12 @@ def flatten_frequency_blocks(blocks):
     return flattened_blocks
 
 
-def get_channel_list_from_frequency_blocks(freq_list):
-    """Return all 2.4 GHz channels whose full 20 MHz bandwidth fits inside freq_list.
+def get_channel_list_from_frequency_blocks(freq_list,
+                                           channel_freqs=channels.ISM_24_C2F,
+                                           width=CHANNEL_WIDTH_MHZ_24):
+    """Return the channels whose full bandwidth fits inside freq_list.
 
-    A channel is only included if its entire 20 MHz width (centre ± 10 MHz) is
+    A channel is only included if its entire width (centre ± width / 2) is
     contained within at least one of the allowed frequency blocks.  This ensures
     we never advertise a channel whose edges fall outside the regulatory limit.
 
@@ -507,6 +1181,12 @@ def get_channel_list_from_frequency_blocks(freq_list):
     ----------
     freq_list : list of (float, float)
         Flattened frequency ranges as returned by flatten_frequency_blocks().
+    channel_freqs : dict
+        {channel: centre frequency MHz} of the candidate channels. Defaults
+        to the 2.4 GHz channels; pass e.g. channels.UNII_5_C2F for 5 GHz.
+    width : int
+        Channel width in MHz, centred on the frequencies in channel_freqs.
+        20 for ordinary 2.4 GHz and 5 GHz channels.
 
     Returns
     -------
@@ -514,36 +1194,205 @@ def get_channel_list_from_frequency_blocks(freq_list):
         Channel numbers that are fully legal under the current regulatory domain.
     """
     allowed_channels = []
-    for channel, centre_freq in channels.ISM_24_C2F.items():
+    for channel, centre_freq in sorted(channel_freqs.items()):
         for start, end in freq_list:
-            # Channel is legal only if the full 20 MHz band fits inside the block.
-            if start <= centre_freq - (CHANNEL_WIDTH_MHZ_24 / 2) and \
-                   centre_freq + (CHANNEL_WIDTH_MHZ_24 / 2) <= end:
+            # Channel is legal only if its full width fits inside the block.
+            if start <= centre_freq - (width / 2) and \
+                   centre_freq + (width / 2) <= end:
                 allowed_channels.append(channel)
+                break
     return allowed_channels
 
 
-def channels_for_country(country_code):
-    """Return the list of legal 2.4 GHz channel numbers for the given country code.
+def legal_channels(rules, band=spectrum.BAND_2GHZ,
+                   width=CHANNEL_WIDTH_MHZ_24):
+    """Return the channels of width MHz in band that a country's rules allow.
 
-    Runs /sbin/regdbdump to decode the binary regulatory database, extracts the
-    country's frequency rules, flattens overlapping ranges, and filters to
-    channels whose full 20 MHz bandwidth fits within allowed frequencies.
+    See spectrum.legal_channels(), which also honours each rule's maximum
+    bandwidth.
+
+    Parameters
+    ----------
+    rules : iterable of regdb.Rule
+        The country's rules.
+    band : str
+        One of spectrum.BANDS.
+    width : int
+        Channel width in MHz.
+
+    Returns
+    -------
+    list of int
+        Centre channel numbers, sorted.
+    """
+    return spectrum.legal_channels(rules, band, width)
+
+
+def build_channel_table(reg_db, digest):
+    """Compute the legal channels of every country in reg_db in one pass.
+
+    Parameters
+    ----------
+    reg_db : regdb.RegDB, regdb.CRDARegDB or regdb.FirmwareRegDB
+    digest : bytes
+        Content hash of the database file, to key the table by.
+
+    Returns
+    -------
+    channel_table.ChannelTable
+    """
+    channel_lists = {}
+    dfs_lists = {}
+    for alpha2 in reg_db.country_codes():
+        rules = reg_db.rules(alpha2)
+        channel_lists[alpha2] = [legal_channels(rules, band, width)
+                                 for band, width in CHANNEL_PLANS]
+        dfs_lists[alpha2] = [spectrum.dfs_channels(rules, band, width)
+                             for band, width in CHANNEL_PLANS]
+    return channel_table.ChannelTable.from_channel_lists(
+        digest, CHANNEL_PLANS, channel_lists, dfs_lists)
+
+
+def _load_channel_table(digest, cache_dir):
+    """Return the persisted table for digest with our plans, or None."""
+    table = channel_table.load(digest, cache_dir)
+    if table is None or table.plans != CHANNEL_PLANS:
+        return None
+    return table
+
+
+def load_channel_table(regdb_path=None, cache_dir=scan_cache.CACHE_DIR):
+    """Return the persisted legal channel table, without ever building it.
+
+    Unlike get_channel_table(), this is quick even on a cold boot with a
+    new regulatory database, in which case there's no table to return.
+
+    Parameters are as for get_channel_table().
+
+    Returns
+    -------
+    channel_table.ChannelTable or None
+        None unless a table was persisted for this database.
+    """
+    if regdb_path is None:
+        regdb_path = regdb.find_regdb()
+    return _load_channel_table(channel_table.content_hash(regdb_path),
+                               cache_dir)
+
+
+def get_channel_table(regdb_path=None, cache_dir=scan_cache.CACHE_DIR):
+    """Return the legal channel table for the regulatory database.
+
+    The table persisted in cache_dir is used if it was built from a database
+    with the same content hash. Otherwise it's rebuilt and persisted.  The
+    result is also kept for the rest of the process, until the database
+    file changes.
+
+    Parameters
+    ----------
+    regdb_path : str, optional
+        Defaults to the installed database (see regdb.find_regdb()).
+    cache_dir : str
+        Directory holding the persisted table.
+
+    Returns
+    -------
+    channel_table.ChannelTable
+    """
+    if regdb_path is None:
+        regdb_path = regdb.find_regdb()
+    stat = os.stat(regdb_path)
+    key = (regdb_path, cache_dir)
+    cached = _channel_table_cache.get(key)
+    if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size):
+        return cached[1]
+    digest = channel_table.content_hash(regdb_path)
+    table = _load_channel_table(digest, cache_dir)
+    if table is None:
+        click.echo("Building legal channel table from %s" % (regdb_path,))
+        table = build_channel_table(regdb.get_regdb(regdb_path), digest)
+        channel_table.store(table, cache_dir)
+    _channel_table_cache[key] = ((stat.st_mtime_ns, stat.st_size), table)
+    return table
+
+
+def channels_for_country(country_code, reg_db=None, band=spectrum.BAND_2GHZ,
+                         width=CHANNEL_WIDTH_MHZ_24, table=None):
+    """Return the list of legal channel numbers for the given country code.
+
+    By default, 2.4 GHz channels whose full 20 MHz bandwidth fits within the
+    frequencies the country's regulatory rules allow (see legal_channels()).
 
     Parameters
     ----------
     country_code : str
         Two-letter ISO country code (e.g. 'US', 'DE').
+    reg_db : regdb.RegDB, optional
+        Compute the channels from this database.  By default they're read
+        from the precomputed table for the installed database (see
+        get_channel_table()).
+    band : str
+        One of spectrum.BANDS.
+    width : int
+        Channel width in MHz. Wide channels are identified by their centre
+        channel number.
+    table : channel_table.ChannelTable, optional
+        The precomputed table to read, if the caller already has it.
 
     Returns
     -------
     list of int
         Legal channel numbers for this country, e.g. [1, 2, 3, ..., 11] for 'US'.
     """
-    regdump = subprocess.run(["/sbin/regdbdump", "/lib/crda/regulatory.bin"],
-                             stdout=subprocess.PIPE)
-    lines = regdump.stdout.decode('utf-8').split("\n")
-    country_rules_block = get_country_rules_block(country_code, lines)
-    frequency_blocks = get_frequency_blocks_from_country_block(country_code, country_rules_block)
-    frequency_blocks = flatten_frequency_blocks(frequency_blocks)
-    return get_channel_list_from_frequency_blocks(frequency_blocks)
+    if reg_db is None:
+        if table is None:
+            table = get_channel_table()
+        return table.channels(country_code, band, width)
+    return legal_channels(reg_db.rules(country_code), band, width)
+
+
+def dfs_channels_for_country(country_code, reg_db=None,
+                             band=spectrum.BAND_5GHZ,
+                             width=CHANNEL_WIDTH_MHZ_24, table=None):
+    """Return the channels that need radar detection (DFS) in a country.
+
+    Parameters are as for channels_for_country().
+
+    Returns
+    -------
+    list of int
+        Channel numbers, e.g. 52 to 64 and 100 to 144 for 'US' at 20MHz.
+    """
+    if reg_db is None:
+        if table is None:
+            table = get_channel_table()
+        return table.dfs_channels(country_code, band, width)
+    return spectrum.dfs_channels(reg_db.rules(country_code), band, width)
+
+
+def choose_band(ac_active, country_code, reg_db=None, table=None):
+    """Return the band to run the access point in.
+
+    5GHz is much less contended than 2.4GHz, so it's used whenever the
+    adapter supports it (802.11ac adapters do) and the country allows an
+    access point there.
+
+    Parameters
+    ----------
+    ac_active : int
+        The adapter's ac_active flag.
+    country_code : str
+    reg_db : regdb.RegDB, optional
+    table : channel_table.ChannelTable, optional
+        See channels_for_country().
+
+    Returns
+    -------
+    str
+        spectrum.BAND_5GHZ or spectrum.BAND_2GHZ.
+    """
+    if ac_active and \
+            channels_for_country(country_code, reg_db, spectrum.BAND_5GHZ,
+                                 table=table):
+        return spectrum.BAND_5GHZ
+    return spectrum.BAND_2GHZ
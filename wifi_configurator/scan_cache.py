@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+"""Persistent, on-disk cache of scan results.
+
+Boot scripts and the admin UI often run the configurator several times
+within a few minutes.  Caching the ScanResult on disk (rather than in a
+per-process lru_cache) lets those runs reuse a recent scan instead of
+spending seconds of radio time on a new one.
+
+Entries are keyed by interface name and MAC address, so swapping a USB
+adapter invalidates the cache.  Each file holds the time of the scan and a
+TTL chosen by the writer, followed by the serialised ScanResult.
+"""
+
+import os
+from pathlib import Path
+import struct
+import tempfile
+import time
+import click
+from wifi_configurator.scan_result import ScanResult
+
+
+CACHE_DIR = "/var/cache/wifi-configurator"
+DEFAULT_TTL_S = 300
+
+# Scan time (seconds since the epoch) and TTL (seconds)
+_ENTRY_HEADER = struct.Struct("=dd")
+
+
+def interface_mac(dev):
+    """Return the MAC address of dev from sysfs, or '' if it's unreadable."""
+    try:
+        return Path("/sys/class/net", dev, "address").read_text().strip()
+    except OSError:
+        return ""
+
+
+def cache_path(dev, mac, cache_dir=CACHE_DIR):
+    """Return the cache file path for interface dev with the given MAC."""
+    return Path(cache_dir, "scan-%s-%s.bin" % (
+        dev, mac.replace(":", "").lower() or "unknown"))
+
+
+def load(dev, mac, max_age_s, cache_dir=CACHE_DIR, now=None):
+    """Return the cached ScanResult for dev/mac if it's fresh enough.
+
+    An entry is fresh if it's younger than both max_age_s and the TTL it
+    was stored with.
+
+    Parameters
+    ----------
+    dev : str
+        Interface name, e.g. 'wlan0'.
+    mac : str
+        Interface MAC address.
+    max_age_s : float
+        Oldest acceptable scan, in seconds.
+    cache_dir : str
+        Directory holding cache files.
+    now : float, optional
+        Current time.time(); for testing.
+
+    Returns
+    -------
+    ScanResult or None
+        None if there's no entry, it's stale or it can't be read.
+    """
+    try:
+        data = cache_path(dev, mac, cache_dir).read_bytes()
+        scanned_at, ttl_s = _ENTRY_HEADER.unpack_from(data)
+        age = (time.time() if now is None else now) - scanned_at
+        # A negative age means the clock has gone backwards. Don't trust it.
+        if not 0 <= age <= min(max_age_s, ttl_s):
+            return None
+        return ScanResult.from_bytes(data[_ENTRY_HEADER.size:])
+    except (OSError, ValueError, struct.error):
+        return None
+
+
+def write_atomically(path, data):
+    """Write data to path via a fsync'd temporary file and a rename.
+
+    Readers never see a partially written file.  Failures (e.g. a read-only
+    filesystem) are reported, not raised; the cache is only an optimisation.
+
+    Returns
+    -------
+    bool
+        Whether the file was written.
+    """
+    cache_dir = os.path.dirname(str(path))
+    tmp_name = None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=cache_dir, prefix=".tmp-",
+                                         delete=False) as tmp:
+            tmp_name = tmp.name
+            tmp.write(data)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        os.replace(tmp_name, str(path))
+        return True
+    except OSError as e:
+        click.echo("Unable to write cache file %s: %s" % (path, e))
+        if tmp_name is not None:
+            try:
+                os.unlink(tmp_name)
+            except OSError:
+                pass
+        return False
+
+
+def store(dev, mac, scan_result, ttl_s=DEFAULT_TTL_S, cache_dir=CACHE_DIR,
+          now=None):
+    """Atomically write scan_result to the cache for dev/mac.
+
+    See write_atomically().
+
+    Returns
+    -------
+    bool
+        Whether the entry was written.
+    """
+    header = _ENTRY_HEADER.pack(time.time() if now is None else now, ttl_s)
+    return write_atomically(cache_path(dev, mac, cache_dir),
+                            header + scan_result.to_bytes())
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+
+"""Compact, array-backed container for the BSSes seen in a scan."""
+
+import array
+import collections
+import struct
+import pyric.utils.channels as channels
+from wifi_configurator import bss
+
+
+class ScanResult:
+    """Parallel typed arrays holding one entry per observed BSS.
+
+    Storing each field in its own array.array keeps a scan of hundreds of
+    BSSes to a few kilobytes, rather than one namedtuple (and a handful of
+    boxed ints, floats and strs) per BSS:
+
+    - freqs:       uint16, primary channel centre frequency in MHz
+    - signals:     float32, signal strength in dBm
+    - country_ids: uint16, index into countries ('' is always index 0)
+    - last_seen_ms: uint32, age of the BSS when it was reported
+    - ht_secondary_offsets: int8, one of the bss.SECONDARY_* constants
+    - ht_widths:   uint8, HT STA channel width in MHz (0 if no HT)
+    - vht_widths:  uint8, one of the bss.VHT_WIDTH_* constants
+    - vht_center_segs1, vht_center_segs2: uint8, VHT centre channels
+    - bssids:      6 packed bytes per BSS
+
+    partial is set when the scan that filled the arrays was cut short.
+
+    Aggregate queries (max_signal_per_freq(), country_counts() etc) are
+    single passes over the arrays, so they can be shared by every consumer
+    instead of each one rebuilding its own list of tuples.
+    """
+
+    BSSID_LEN = 6
+    NO_COUNTRY = 0
+
+    # Serialised form: header, length-prefixed country codes, then the raw
+    #  arrays in native byte order (caches never leave the machine)
+    _MAGIC = b"WCSR"
+    _VERSION = 3
+    _HEADER = struct.Struct("=4sBxHL")
+
+    def __init__(self):
+        self.freqs = array.array("H")
+        self.signals = array.array("f")
+        # A merge of many scans can see more than 255 different codes, even
+        #  if most of them are junk
+        self.country_ids = array.array("H")
+        self.last_seen_ms = array.array("I")
+        self.ht_secondary_offsets = array.array("b")
+        self.ht_widths = array.array("B")
+        self.vht_widths = array.array("B")
+        self.vht_center_segs1 = array.array("B")
+        self.vht_center_segs2 = array.array("B")
+        self.bssids = bytearray()
+        self.countries = [""]
+        self._country_index = {"": self.NO_COUNTRY}
+        self.partial = False
+
+    @classmethod
+    def from_bss_records(cls, bss_records):
+        """Build a ScanResult from an iterable of bss.BSS records.
+
+        Every record is stored.  Queries that need a frequency and a signal
+        skip entries that lack either, but their country code still counts.
+        """
+        scan_result = cls()
+        for record in bss_records:
+            scan_result.append(record)
+        return scan_result
+
+    def _arrays(self):
+        """Return every per-BSS array except bssids, in serialisation order."""
+        return [self.freqs, self.signals, self.country_ids, self.last_seen_ms,
+                self.ht_secondary_offsets, self.ht_widths, self.vht_widths,
+                self.vht_center_segs1, self.vht_center_segs2]
+
+    def __len__(self):
+        return len(self.freqs)
+
+    def __repr__(self):
+        return "<ScanResult: %d BSSes>" % (len(self),)
+
+    def to_bytes(self):
+        """Serialise to a compact bytes form that from_bytes() can read."""
+        parts = [self._HEADER.pack(self._MAGIC, self._VERSION,
+                                   len(self.countries), len(self))]
+        for country in self.countries:
+            encoded = country.encode("utf-8")
+            parts.append(struct.pack("=B", len(encoded)) + encoded)
+        parts.extend(field.tobytes() for field in self._arrays())
+        parts.append(bytes(self.bssids))
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Inverse of to_bytes(). Raises ValueError if data is malformed."""
+        try:
+            magic, version, n_countries, count = \
+                cls._HEADER.unpack_from(data)
+        except struct.error as e:
+            raise ValueError("Truncated ScanResult: %s" % (e,))
+        if magic != cls._MAGIC or version != cls._VERSION:
+            raise ValueError("Not a version %d ScanResult" % (cls._VERSION,))
+        scan_result = cls()
+        offset = cls._HEADER.size
+        countries = []
+        for _ in range(n_countries):
+            if offset >= len(data):
+                raise ValueError("Truncated ScanResult countries")
+            length = data[offset]
+            countries.append(
+                data[offset + 1:offset + 1 + length].decode("utf-8"))
+            offset += 1 + length
+        scan_result.countries = countries
+        scan_result._country_index = {
+            country: country_id for country_id, country in enumerate(countries)
+        }
+        for field in scan_result._arrays():
+            size = count * field.itemsize
+            field.frombytes(data[offset:offset + size])
+            offset += size
+        scan_result.bssids = bytearray(
+            data[offset:offset + count * cls.BSSID_LEN])
+        offset += count * cls.BSSID_LEN
+        if offset != len(data) or len(scan_result.bssids) != \
+                count * cls.BSSID_LEN:
+            raise ValueError("ScanResult length mismatch")
+        return scan_result
+
+    def intern_country(self, country):
+        """Return the small-int id for a country code, allocating if new."""
+        try:
+            return self._country_index[country]
+        except KeyError:
+            country_id = len(self.countries)
+            self.countries.append(country)
+            self._country_index[country] = country_id
+            return country_id
+
+    def append(self, record):
+        """Add a single bss.BSS record."""
+        self.freqs.append(record.freq)
+        self.signals.append(record.signal)
+        self.country_ids.append(self.intern_country(record.country))
+        self.last_seen_ms.append(record.last_seen_ms)
+        self.ht_secondary_offsets.append(record.ht_secondary_offset)
+        self.ht_widths.append(record.ht_sta_channel_width)
+        self.vht_widths.append(record.vht_channel_width)
+        self.vht_center_segs1.append(record.vht_center_seg1)
+        self.vht_center_segs2.append(record.vht_center_seg2)
+        self.bssids += pack_bssid(record.bssid)
+
+    def subset(self, indices):
+        """Return a new ScanResult holding only the BSSes at indices."""
+        scan_result = ScanResult()
+        scan_result.countries = list(self.countries)
+        scan_result._country_index = dict(self._country_index)
+        fields = list(zip(self._arrays(), scan_result._arrays()))
+        for index in indices:
+            for field, subset_field in fields:
+                subset_field.append(field[index])
+            start = index * self.BSSID_LEN
+            scan_result.bssids += self.bssids[start:start + self.BSSID_LEN]
+        return scan_result
+
+    def seen_within(self, max_age_ms):
+        """Return a ScanResult of the BSSes last seen at most max_age_ms ago."""
+        return self.subset(
+            index for index, age in enumerate(self.last_seen_ms)
+            if age <= max_age_ms
+        )
+
+    def bssid(self, index):
+        """Return the BSSID at index in its usual colon-separated form."""
+        start = index * self.BSSID_LEN
+        return unpack_bssid(self.bssids[start:start + self.BSSID_LEN])
+
+    def country(self, index):
+        """Return the country code advertised by the BSS at index, or ''."""
+        return self.countries[self.country_ids[index]]
+
+    def occupied_freqs(self, index):
+        """Return the 20MHz subchannel centres the BSS at index may use.
+
+        See bss.occupied_freqs().
+        """
+        return bss.occupied_freqs(
+            self.freqs[index], self.ht_secondary_offsets[index],
+            self.ht_widths[index], self.vht_widths[index],
+            self.vht_center_segs1[index], self.vht_center_segs2[index])
+
+    def freq_signal_tuples(self):
+        """Return [(freq_MHz, signal_dBm), ...] for BSSes with both values."""
+        return [
+            (freq, signal) for freq, signal in zip(self.freqs, self.signals)
+            if freq and signal
+        ]
+
+    def max_signal_per_freq(self):
+        """Return {freq_MHz: strongest signal_dBm seen on that frequency}."""
+        freq_signal_map = {}
+        get = freq_signal_map.get
+        for freq, signal in zip(self.freqs, self.signals):
+            if freq and signal and signal > get(freq, float("-inf")):
+                freq_signal_map[freq] = signal
+        return freq_signal_map
+
+    def power_mw_per_freq(self):
+        """Return {freq_MHz: summed received power in mW of its BSSes}.
+
+        Unlike signals in dBm, powers in mW can be added: two -60dBm APs on
+        a channel are as loud as one -57dBm AP.
+        """
+        freq_power_map = {}
+        get = freq_power_map.get
+        for freq, signal in zip(self.freqs, self.signals):
+            if freq and signal:
+                freq_power_map[freq] = get(freq, 0.0) + 10 ** (signal / 10)
+        return freq_power_map
+
+    def power_mw_per_occupied_freq(self):
+        """Like power_mw_per_freq(), but spread over each BSS's whole width.
+
+        A 40MHz BSS contributes its received power to both its primary and
+        secondary 20MHz subchannels (and likewise for 80MHz and 160MHz), as
+        it may transmit on any of them.
+        """
+        freq_power_map = {}
+        get = freq_power_map.get
+        for index, signal in enumerate(self.signals):
+            if not signal:
+                continue
+            power_mw = 10 ** (signal / 10)
+            for freq in self.occupied_freqs(index):
+                freq_power_map[freq] = get(freq, 0.0) + power_mw
+        return freq_power_map
+
+    def country_counts(self):
+        """Return a Counter of advertised country code → number of BSSes."""
+        id_counts = collections.Counter(self.country_ids)
+        id_counts.pop(self.NO_COUNTRY, None)
+        return collections.Counter({
+            self.countries[country_id]: count
+            for country_id, count in id_counts.items()
+        })
+
+    def aps_per_freq(self):
+        """Return a Counter of frequency → number of BSSes on it."""
+        freq_counts = collections.Counter(self.freqs)
+        freq_counts.pop(0, None)
+        return freq_counts
+
+    def aps_per_channel(self):
+        """Return a Counter of channel number → number of BSSes on it.
+
+        Frequencies that don't map to a known 2.4GHz or 5GHz channel are
+        ignored.
+        """
+        channel_counts = collections.Counter()
+        for freq, count in self.aps_per_freq().items():
+            channel = channels.rf2ch(freq)
+            if channel is not None:
+                channel_counts[channel] += count
+        return channel_counts
+
+
+def pack_bssid(bssid):
+    """Pack 'aa:bb:cc:dd:ee:ff' into 6 bytes (all zeros if unparseable)."""
+    try:
+        packed = bytes.fromhex(bssid.replace(":", ""))
+    except ValueError:
+        packed = b""
+    if len(packed) != ScanResult.BSSID_LEN:
+        return bytes(ScanResult.BSSID_LEN)
+    return packed
+
+
+def unpack_bssid(packed):
+    """Inverse of pack_bssid()."""
+    return ":".join("%02x" % (octet,) for octet in packed)
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+"""Restarting the services that use the configuration, in parallel.
+
+A ServicePlan collects the actions a reconfiguration needs (restarting a
+systemd unit, taking an interface down or up), each with the actions it
+has to come after and, optionally, a readiness check.  Adding an action
+that's already planned merges the two, and stopping and starting a unit
+merges into one restart.
+
+run() executes the plan in waves: each wave is every action whose
+dependencies have finished.  A wave's systemd actions are batched into one
+systemctl call per verb, so systemd runs their jobs in parallel, and its
+other actions run concurrently alongside.  An action is finished once its
+command has succeeded and its readiness check has passed, e.g. hostapd
+answering on its control socket, rather than after a fixed sleep.  Actions
+that depend on a failed one are skipped, unless they only have to follow
+it, i.e. they're worth doing whether or not it worked.
+"""
+
+import collections
+import concurrent.futures
+import subprocess
+import time
+import click
+
+
+SYSTEMD_VERBS = ("start", "stop", "restart")
+INTERFACE_VERBS = ("ifup", "ifdown")
+# How long a command, and then its readiness check, may take
+COMMAND_TIMEOUT_S = 30
+READY_TIMEOUT_S = 15
+
+Action = collections.namedtuple("Action", [
+    "verb",    # str, one of SYSTEMD_VERBS or INTERFACE_VERBS
+    "target",  # str, systemd unit or interface name
+    "after",   # frozenset of (verb, target) keys this depends on
+    "ready",   # callable(deadline) returning whether the action has taken
+               #  effect by deadline (a monotonic time), or None
+    "follows",  # frozenset of keys this comes after but doesn't depend on
+])
+
+ActionResult = collections.namedtuple("ActionResult", [
+    "action",  # Action
+    "ok",      # bool
+    "detail",  # str, why it failed, or '' if it didn't
+])
+
+
+def action_key(action):
+    """Return the key identifying action in a plan: its verb and target."""
+    return (action.verb, action.target)
+
+
+def _merge_verbs(planned, added):
+    """Return the systemd verb that does what planned then added would."""
+    if planned == added:
+        return planned
+    if added == "stop":
+        # Only the end state matters
+        return "stop"
+    return "restart"
+
+
+def _rename(keys, old, new):
+    """Return keys (a frozenset) with old replaced by new."""
+    return keys - {old} | {new} if old in keys else keys
+
+
+class ServicePlan:
+    """The actions needed to make a new configuration live."""
+
+    def __init__(self):
+        # {key: Action}, in the order they were added
+        self.actions = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.actions)
+
+    def _find(self, verb, target):
+        """Return the key of the action verb on target merges with, or None."""
+        if verb in SYSTEMD_VERBS:
+            for planned in SYSTEMD_VERBS:
+                if (planned, target) in self.actions:
+                    return (planned, target)
+        return (verb, target) if (verb, target) in self.actions else None
+
+    def add(self, verb, target, after=(), ready=None, follows=()):
+        """Plan verb on target, after the actions with keys in after.
+
+        Parameters
+        ----------
+        verb : str
+        target : str
+        after : iterable of tuple
+            Keys of actions this depends on: if one fails, this is skipped.
+        ready : callable(deadline), optional
+        follows : iterable of tuple
+            Keys of actions this only has to be ordered after.
+
+        Returns
+        -------
+        tuple
+            The key of the planned action, to pass in a later after.
+        """
+        if verb not in SYSTEMD_VERBS + INTERFACE_VERBS:
+            raise ValueError("Unknown action %s" % (verb,))
+        after = frozenset(after)
+        follows = frozenset(follows)
+        key = self._find(verb, target)
+        if key is not None:
+            planned = self.actions.pop(key)
+            if verb in SYSTEMD_VERBS:
+                verb = _merge_verbs(planned.verb, verb)
+            after |= planned.after
+            follows |= planned.follows
+            ready = ready or planned.ready
+            # Anything that followed the merged action follows this one
+            for other_key, other in self.actions.items():
+                self.actions[other_key] = other._replace(
+                    after=_rename(other.after, key, (verb, target)),
+                    follows=_rename(other.follows, key, (verb, target)))
+        # Depending on an action is also following it
+        follows -= after
+        self.actions[(verb, target)] = Action(verb, target, after, ready,
+                                              follows)
+        return (verb, target)
+
+    def waves(self):
+        """Return the actions as a list of waves, each a list of Actions.
+
+        Every action comes in a later wave than the actions it has to
+        follow.  Dependencies that aren't in the plan are ignored.
+
+        Raises
+        ------
+        ValueError
+            If the dependencies are circular.
+        """
+        remaining = collections.OrderedDict(self.actions)
+        done = set()
+        waves = []
+        while remaining:
+            wave = [action for action in remaining.values()
+                    if all(key in done or key not in self.actions
+                           for key in action.after | action.follows)]
+            if not wave:
+                raise ValueError("Circular dependencies between %s" %
+                                 (", ".join("%s %s" % key
+                                            for key in remaining),))
+            for action in wave:
+                del remaining[action_key(action)]
+            done.update(action_key(action) for action in wave)
+            waves.append(wave)
+        return waves
+
+
+def commands(wave):
+    """Return the commands that carry out wave, with the actions of each.
+
+    Returns
+    -------
+    list of (list of str, list of Action)
+        One systemctl command per verb, then one command per interface
+        action.
+    """
+    by_verb = collections.OrderedDict()
+    others = []
+    for action in wave:
+        if action.verb in SYSTEMD_VERBS:
+            by_verb.setdefault(action.verb, []).append(action)
+        else:
+            others.append(([action.verb, action.target], [action]))
+    return [(["systemctl", verb] + [action.target for action in actions],
+             actions)
+            for verb, actions in by_verb.items()] + others
+
+
+def run_command(argv, timeout=COMMAND_TIMEOUT_S):
+    """Run argv, returning '' if it succeeded or why it didn't."""
+    try:
+        result = subprocess.run(argv, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, timeout=timeout,
+                                universal_newlines=True)
+    except subprocess.TimeoutExpired:
+        return "timed out after %ss" % (timeout,)
+    except OSError as e:
+        return str(e)
+    if result.returncode:
+        return "exited with %d: %s" % (result.returncode,
+                                       result.stdout.strip())
+    return ""
+
+
+def _carry_out(argv, actions, runner, ready_timeout):
+    """Run one command, then wait for its actions to be ready."""
+    failure = runner(argv)
+    if failure:
+        return [ActionResult(action, False, "%s %s" % (" ".join(argv),
+                                                       failure))
+                for action in actions]
+    results = []
+    deadline = time.monotonic() + ready_timeout
+    for action in actions:
+        if action.ready is None or action.ready(deadline):
+            results.append(ActionResult(action, True, ""))
+        else:
+            results.append(ActionResult(
+                action, False,
+                "%s %s didn't take effect within %ss" % (
+                    action.verb, action.target, ready_timeout)))
+    return results
+
+
+def run(plan, runner=run_command, ready_timeout=READY_TIMEOUT_S):
+    """Carry out plan, running independent actions concurrently.
+
+    Parameters
+    ----------
+    plan : ServicePlan
+    runner : callable(argv)
+        Runs a command, returning '' if it succeeded or why it didn't.
+    ready_timeout : float
+        How long each action's readiness check may wait.
+
+    Returns
+    -------
+    list of ActionResult
+        One per action, in the order they finished. Actions skipped because
+        one they depend on failed are included as failures.
+    """
+    results = []
+    failed = set()
+    for wave in plan.waves():
+        runnable = []
+        for action in wave:
+            blocked = [key for key in action.after if key in failed]
+            if blocked:
+                failed.add(action_key(action))
+                results.append(ActionResult(
+                    action, False, "skipped after %s %s failed" %
+                    blocked[0]))
+            else:
+                runnable.append(action)
+        if not runnable:
+            continue
+        with concurrent.futures.ThreadPoolExecutor(len(runnable)) as pool:
+            futures = [pool.submit(_carry_out, argv, actions, runner,
+                                   ready_timeout)
+                       for argv, actions in commands(runnable)]
+            for future in concurrent.futures.as_completed(futures):
+                for result in future.result():
+                    results.append(result)
+                    if not result.ok:
+                        failed.add(action_key(result.action))
+                    click.echo("%s %s: %s" % (
+                        result.action.verb, result.action.target,
+                        "done" if result.ok else result.detail))
+    return results
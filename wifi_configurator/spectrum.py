@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+"""Which channels, of which widths, a country's regulatory rules allow.
+
+A country's rules are reduced to a sorted list of non-overlapping allowed
+frequency intervals for each channel width: rules whose max bandwidth is
+narrower than the width (and that don't have AUTO-BW, which lets the
+kernel combine contiguous rules) are left out, as are NO-IR rules because
+an access point has to initiate radiation.  NO-OFDM spectrum is cut out
+altogether as we only transmit OFDM.  Whether a channel fits entirely
+inside the allowed spectrum is then a bisect over the interval starts.
+
+Channels overlapping a DFS rule are legal, but hostapd has to listen for
+radar (a channel availability check, usually 60 seconds) before using them,
+and has to move if radar turns up, so dfs_channels() lists them for
+channel selection to avoid.
+
+Channels are identified by the channel number of their centre, as hostapd
+and 802.11 do for wide channels: e.g. 80MHz channel 42 spans 5170-5250MHz,
+and 40MHz channel 3 in 2.4GHz spans 2402-2442MHz (primary channel 1 with
+the secondary above, or 5 with the secondary below).
+"""
+
+import bisect
+from wifi_configurator import regdb
+
+
+BAND_2GHZ = "2.4GHz"
+BAND_5GHZ = "5GHz"
+BANDS = (BAND_2GHZ, BAND_5GHZ)
+
+# hostapd hw_mode for each band
+HW_MODES = {
+    BAND_2GHZ: "g",
+    BAND_5GHZ: "a",
+}
+
+CHANNEL_WIDTHS = (20, 40, 80, 160)
+
+# 20MHz channels. Channel 14 is DSSS only, so it's never usable here
+_CHANNELS_2GHZ = tuple(range(1, 14))
+_CHANNELS_5GHZ = tuple(range(36, 65, 4)) + tuple(range(100, 145, 4)) + \
+    tuple(range(149, 166, 4))
+
+# 5GHz wide channels have fixed positions, identified by centre channel
+_WIDE_CHANNELS_5GHZ = {
+    40: (38, 46, 54, 62, 102, 110, 118, 126, 134, 142, 151, 159),
+    80: (42, 58, 106, 122, 138, 155),
+    160: (50, 114),
+}
+
+
+def channel_to_freq(band, channel):
+    """Return the centre frequency in MHz of channel in band."""
+    if band == BAND_2GHZ:
+        return 2484 if channel == 14 else 2407 + 5 * channel
+    return 5000 + 5 * channel
+
+
+def freq_band(freq):
+    """Return the band that freq (MHz) is in, or None if it's in neither."""
+    if 2400 <= freq < 2500:
+        return BAND_2GHZ
+    if 5150 <= freq < 5900:
+        return BAND_5GHZ
+    return None
+
+
+def channel_band(channel):
+    """Return the band of a 20MHz channel number, or None if it's unknown."""
+    for band in BANDS:
+        if channel in band_channels(band):
+            return band
+    return None
+
+
+def band_channels(band, width=20):
+    """Return the candidate channels of width MHz in band, sorted.
+
+    Returns
+    -------
+    tuple of int
+        Centre channel numbers. Empty if band doesn't have channels that
+        wide (2.4GHz stops at 40MHz).
+    """
+    if band == BAND_2GHZ:
+        if width == 20:
+            return _CHANNELS_2GHZ
+        if width == 40:
+            # Any two 20MHz channels 4 apart. The centre is midway
+            return tuple(channel + 2 for channel in _CHANNELS_2GHZ
+                         if channel + 4 in _CHANNELS_2GHZ)
+        return ()
+    if width == 20:
+        return _CHANNELS_5GHZ
+    return _WIDE_CHANNELS_5GHZ.get(width, ())
+
+
+class Spectrum:
+    """A sorted set of non-overlapping (start_MHz, end_MHz) intervals.
+
+    Parameters
+    ----------
+    intervals : iterable of (float, float)
+        In any order; overlapping and touching intervals are merged.
+    """
+
+    def __init__(self, intervals):
+        merged = []
+        for start, end in sorted(intervals):
+            if merged and start <= merged[-1][1]:
+                if end > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], end)
+            else:
+                merged.append((start, end))
+        self.intervals = merged
+        self._starts = [start for start, _ in merged]
+
+    def __repr__(self):
+        return "<Spectrum: %s>" % (self.intervals,)
+
+    @classmethod
+    def from_rules(cls, rules, width=20):
+        """Return the spectrum usable by OFDM channels of width MHz.
+
+        Parameters
+        ----------
+        rules : iterable of regdb.Rule
+        width : int
+            Channel width in MHz. Rules with a narrower max bandwidth and
+            no AUTO-BW flag are excluded.
+        """
+        allowed = []
+        no_ofdm = []
+        for rule in rules:
+            if regdb.FLAG_NO_OFDM in rule.flags:
+                no_ofdm.append((rule.start_freq, rule.end_freq))
+            elif regdb.FLAG_NO_IR in rule.flags:
+                continue
+            elif rule.max_bandwidth >= width or \
+                    regdb.FLAG_AUTO_BW in rule.flags:
+                allowed.append((rule.start_freq, rule.end_freq))
+        return cls(allowed).subtract(no_ofdm)
+
+    def subtract(self, intervals):
+        """Return a new Spectrum without the given intervals."""
+        remaining = self.intervals
+        for cut_start, cut_end in intervals:
+            pieces = []
+            for start, end in remaining:
+                if cut_end <= start or end <= cut_start:
+                    pieces.append((start, end))
+                    continue
+                if start < cut_start:
+                    pieces.append((start, cut_start))
+                if cut_end < end:
+                    pieces.append((cut_end, end))
+            remaining = pieces
+        return Spectrum(remaining)
+
+    def contains(self, low, high):
+        """Return whether [low, high] lies entirely inside one interval."""
+        index = bisect.bisect_right(self._starts, low) - 1
+        return index >= 0 and high <= self.intervals[index][1]
+
+    def overlaps(self, low, high):
+        """Return whether (low, high) overlaps an interval, not just its edge."""
+        index = bisect.bisect_left(self._starts, high) - 1
+        return index >= 0 and low < self.intervals[index][1]
+
+
+def legal_channels(rules, band, width=20):
+    """Return the channels of width MHz in band that rules allow.
+
+    Parameters
+    ----------
+    rules : iterable of regdb.Rule
+        A country's rules.
+    band : str
+        One of BANDS.
+    width : int
+        One of CHANNEL_WIDTHS.
+
+    Returns
+    -------
+    list of int
+        Centre channel numbers, sorted and without duplicates.
+    """
+    spectrum = Spectrum.from_rules(rules, width)
+    legal = []
+    for channel in band_channels(band, width):
+        centre = channel_to_freq(band, channel)
+        if spectrum.contains(centre - width / 2, centre + width / 2):
+            legal.append(channel)
+    return legal
+
+
+def dfs_channels(rules, band, width=20):
+    """Return the channels of width MHz in band that overlap a DFS rule.
+
+    Parameters
+    ----------
+    rules : iterable of regdb.Rule
+        A country's rules.
+    band : str
+        One of BANDS.
+    width : int
+        One of CHANNEL_WIDTHS.
+
+    Returns
+    -------
+    list of int
+        Centre channel numbers, sorted. Not all of them are necessarily
+        legal; see legal_channels().
+    """
+    dfs = Spectrum((rule.start_freq, rule.end_freq) for rule in rules
+                   if regdb.FLAG_DFS in rule.flags)
+    channels = []
+    for channel in band_channels(band, width):
+        centre = channel_to_freq(band, channel)
+        if dfs.overlaps(centre - width / 2, centre + width / 2):
+            channels.append(channel)
+    return channels
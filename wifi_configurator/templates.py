@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+"""hostapd.conf and wpa_supplicant.conf templates, with compiled bytecode
+cached on disk.
+
+Parsing and compiling a template takes much longer than rendering it, so
+the compiled templates are kept in the cache directory by Jinja2's
+FileSystemBytecodeCache.  Each entry records a checksum of the template
+source and the Jinja2 and Python versions that compiled it, and is
+recompiled if any of them change; an edited (or, for wpa_supplicant.conf,
+recopied) template never renders stale.
+
+precompile() fills the cache at install time, so even the first run
+after boot loads bytecode.
+"""
+
+import functools
+import os
+import click
+import jinja2
+from wifi_configurator import scan_cache
+
+
+HOSTAPD_TEMPLATE = "hostapd.conf.j2"
+WPA_SUPPLICANT_TEMPLATE = "wpa_supplicant.conf"
+CACHE_SUBDIR = "templates"
+
+
+class BytecodeCache(jinja2.FileSystemBytecodeCache):
+    """A FileSystemBytecodeCache that treats unusable entries as missing.
+
+    The cache is only an optimisation, so a broken or read-only cache
+    directory mustn't stop a template from rendering.
+    """
+
+    def load_bytecode(self, bucket):
+        try:
+            super().load_bytecode(bucket)
+        except OSError:
+            bucket.reset()
+
+    def dump_bytecode(self, bucket):
+        try:
+            super().dump_bytecode(bucket)
+        except OSError as e:
+            click.echo("Unable to cache compiled template %s: %s" %
+                       (bucket.key, e))
+
+
+def bytecode_cache(cache_dir):
+    """Return a BytecodeCache in cache_dir, or None if it can't be created."""
+    directory = os.path.join(cache_dir, CACHE_SUBDIR)
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError as e:
+        click.echo("Unable to cache compiled templates in %s: %s" %
+                   (directory, e))
+        return None
+    return BytecodeCache(directory)
+
+
+@functools.lru_cache()
+def get_environment(cache_dir=scan_cache.CACHE_DIR):
+    """Return the Jinja2 environment for the package's templates.
+
+    Parameters
+    ----------
+    cache_dir : str or None
+        Where compiled templates are cached. None compiles every template
+        from source.
+
+    Returns
+    -------
+    jinja2.Environment
+    """
+    return jinja2.Environment(
+        loader=jinja2.PackageLoader("wifi_configurator"),
+        trim_blocks=True,
+        lstrip_blocks=True,
+        bytecode_cache=cache_dir and bytecode_cache(cache_dir),
+    )
+
+
+def precompile(cache_dir=scan_cache.CACHE_DIR):
+    """Compile every template into the bytecode cache.
+
+    Returns
+    -------
+    list of str
+        The names of the templates.
+    """
+    env = get_environment(cache_dir)
+    names = env.list_templates()
+    for name in names:
+        env.get_template(name)
+    return names